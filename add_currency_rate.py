@@ -1,41 +1,188 @@
 #!/usr/bin/python3
 
 import csv
+import os
+import re
+import time
 from datetime import datetime
 
+from build_rate_table import default_currency_dir, find_corrected_files
+from stream_io import describe, open_input, open_output, status_stream
+
+# Large batches for writing, so that huge date lists are streamed through
+# instead of being read into memory.
+BATCH_LINES = 10000
+
+def load_currency_rates(csv_file):
+    """Read currency rates from CSV database into a {date: rate} index."""
+    with open(csv_file, 'r', newline='') as f:
+        csv_reader = csv.reader(f, delimiter=',')
+        return {row[0]: row[1] for row in csv_reader if len(row) >= 2}
+
+def load_rates_for(csv_file_or_code):
+    """
+    Load the rate index from a CSV file or, when a currency code such as "USD" is
+    given instead of an existing file, from all *_corrected.csv files of that
+    currency in currency_rates.
+    """
+    if not os.path.isfile(csv_file_or_code) and re.fullmatch(r'[A-Za-z]{3}', csv_file_or_code):
+        code = csv_file_or_code.upper()
+        paths = find_corrected_files(default_currency_dir()).get(code)
+        if not paths:
+            raise FileNotFoundError(2, "No currency rate files found", f"{code}_*_corrected.csv")
+        rates = {}
+        for path in paths:
+            rates.update(load_currency_rates(path))
+        return rates
+    return load_currency_rates(csv_file_or_code)
+
+def make_multi_currency_index(rates_dir):
+    """
+    Return a get_rate(code, date) function backed by one index of all currencies
+    in rates_dir. The *_corrected.csv files of a currency are loaded the first
+    time that currency is seen, so only the currencies in the input are read.
+    """
+    files_by_currency = find_corrected_files(rates_dir)
+    rates_by_currency = {}
+
+    def get_rate(code, date):
+        code = code.strip().upper()
+        if code == "BGN":
+            return "1"
+        if code == "EUR":
+            return "1.95583"
+        rates = rates_by_currency.get(code)
+        if rates is None:
+            rates = {}
+            for path in files_by_currency.get(code, []):
+                rates.update(load_currency_rates(path))
+            rates_by_currency[code] = rates
+        return rates.get(date, "N/A")
+
+    return get_rate
+
+def report_throughput(line_count, start_time, file=None):
+    elapsed = time.perf_counter() - start_time
+    rate = line_count / elapsed if elapsed > 0 else 0
+    print(f"Processed {line_count} lines in {elapsed:.2f} s ({rate:,.0f} lines/s)", file=file)
+
 def main(csv_file, input_file, output_file):
+    status = status_stream(output_file)
     try:
-        # Read currency rates from CSV database
-        with open(csv_file, 'r') as csv_file:
-            csv_reader = csv.reader(csv_file, delimiter=',')
-            currency_rates = {row[0]: row[1] for row in csv_reader}
-
-        # Read dates from input file
-        with open(input_file, 'r') as file:
-            input_dates = file.readlines()
-
-        # Write results to output file
-        with open(output_file, 'w') as file:
-            file.write("Date,Currency Rate\n")
-            for input_date in input_dates:
+        start_time = time.perf_counter()
+
+        currency_rates = load_rates_for(csv_file)
+        get_rate = currency_rates.get
+
+        line_count = 0
+
+        # Stream dates from input file and write results in large batches
+        with open_input(input_file) as infile, \
+             open_output(output_file) as outfile:
+            outfile.write("Date,Currency Rate\n")
+            batch = []
+            for input_date in infile:
                 input_date = input_date.strip()
-                currency_rate = currency_rates.get(input_date, "N/A")
-                file.write(f"{input_date},{currency_rate}\n")
+                batch.append(f"{input_date},{get_rate(input_date, 'N/A')}\n")
+                if len(batch) >= BATCH_LINES:
+                    outfile.write("".join(batch))
+                    line_count += len(batch)
+                    batch.clear()
+            outfile.write("".join(batch))
+            line_count += len(batch)
+
+        print(f"Conversion completed. Results written to {describe(output_file)}", file=status)
+        report_throughput(line_count, start_time, file=status)
+
+    except FileNotFoundError as e:
+        print(f"Error: File not found - {e.filename}", file=status)
+    except Exception as e:
+        print(f"Error: {e}", file=status)
+
+def main_multi(input_file, output_file, rates_dir, currency_column=None, date_column="Date"):
+    """
+    Add the currency rate to every line of a ledger that mixes currencies.
+    Without currency_column each input line is "date,currency". With
+    currency_column the input is a CSV file with a header, and a
+    "Currency Rate" column is appended to every row.
+    """
+    status = status_stream(output_file)
+    try:
+        start_time = time.perf_counter()
+
+        get_rate = make_multi_currency_index(rates_dir)
+
+        line_count = 0
 
-        print(f"Conversion completed. Results written to {output_file}")
+        with open_input(input_file, newline='') as infile, \
+             open_output(output_file, newline='') as outfile:
+            if currency_column:
+                reader = csv.reader(infile)
+                writer = csv.writer(outfile, lineterminator="\n")
+                header = next(reader)
+                for column in (date_column, currency_column):
+                    if column not in header:
+                        raise ValueError(f"Column '{column}' not found in the header of {input_file}: {header}")
+                date_index = header.index(date_column)
+                currency_index = header.index(currency_column)
+                writer.writerow(header + ["Currency Rate"])
+                batch = []
+                for row in reader:
+                    if not row:
+                        continue
+                    row.append(get_rate(row[currency_index], row[date_index].strip()))
+                    batch.append(row)
+                    if len(batch) >= BATCH_LINES:
+                        writer.writerows(batch)
+                        line_count += len(batch)
+                        batch.clear()
+                writer.writerows(batch)
+                line_count += len(batch)
+            else:
+                outfile.write("Date,Currency,Currency Rate\n")
+                batch = []
+                for line in infile:
+                    input_date, _, currency = line.strip().partition(",")
+                    input_date = input_date.strip()
+                    currency = currency.strip().upper()
+                    batch.append(f"{input_date},{currency},{get_rate(currency, input_date)}\n")
+                    if len(batch) >= BATCH_LINES:
+                        outfile.write("".join(batch))
+                        line_count += len(batch)
+                        batch.clear()
+                outfile.write("".join(batch))
+                line_count += len(batch)
 
-    except FileNotFoundError:
-        print(f"Error: File not found - {csv_file}, {input_file}")
+        print(f"Conversion completed. Results written to {describe(output_file)}", file=status)
+        report_throughput(line_count, start_time, file=status)
+
+    except FileNotFoundError as e:
+        print(f"Error: File not found - {e.filename}", file=status)
     except Exception as e:
-        print(f"Error: {e}")
+        print(f"Error: {e}", file=status)
 
 if __name__ == "__main__":
-    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        usage="add_currency_rate.py currency_rates.csv|CURRENCY input_file output_file.csv\n"
+              "       add_currency_rate.py --multi [--currency-column NAME] [--date-column NAME] input_file output_file.csv",
+        epilog="Use - as input_file / output_file for stdin / stdout, e.g.: convert_date.py dates.txt - | add_currency_rate.py USD - -")
+    parser.add_argument("files", nargs="+", help=argparse.SUPPRESS)
+    parser.add_argument("--multi", action="store_true",
+                        help="Input lines are 'date,currency' (or see --currency-column); rates for all currencies are taken from --rates-dir")
+    parser.add_argument("--currency-column", help="With --multi: the input is a CSV file with a header and this column holds the currency code")
+    parser.add_argument("--date-column", default="Date", help="With --currency-column: the column holding the date (default: Date)")
+    parser.add_argument("--rates-dir", default=default_currency_dir(), help="With --multi: directory with the *_corrected.csv files (default: currency_rates)")
+    args = parser.parse_args()
 
-    if len(sys.argv) != 4:
-        print("Usage: add_currency_rate.py currency_rates.csv input_file output_file.csv")
+    if args.multi:
+        if len(args.files) != 2:
+            parser.error("--multi needs input_file and output_file")
+        input_file, output_file = args.files
+        main_multi(input_file, output_file, args.rates_dir, args.currency_column, args.date_column)
     else:
-        csv_file = sys.argv[1]
-        input_file = sys.argv[2]
-        output_file = sys.argv[3]
+        if len(args.files) != 3:
+            parser.error("currency_rates.csv, input_file and output_file are required")
+        csv_file, input_file, output_file = args.files
         main(csv_file, input_file, output_file)
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+
+"""
+Compare the Flex Query XML parser backends of flex_ingest on a large
+synthetic file: wall time and peak memory (RSS) of extracting all records
+the exporter needs. Every backend runs in a fresh process so the memory
+numbers don't influence each other.
+
+    $ ./benchmark_flex_parsers.py --trades 200000
+"""
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+# The ways the exporter used to read the files, with the whole tree in memory:
+# ET.parse + findall() and lxml parse + XPath (for the open positions)
+BENCHMARK_BACKENDS = ("ET.parse", "lxml.parse")
+
+
+def write_synthetic_flex_query(path, trades, seed=1):
+    """Write a Flex Query file with about `trades` Trade/Lot records plus some cash transactions."""
+    rnd = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<FlexQueryResponse queryName="benchmark" type="AF">\n<FlexStatements count="1">\n')
+        f.write('<FlexStatement accountId="U0000000" fromDate="20150101" toDate="20241231" period="Custom">\n<Trades>\n')
+        for i in range(trades):
+            symbol = f"SYM{rnd.randint(0, 499)}"
+            price = rnd.uniform(1, 500)
+            qty = rnd.randint(1, 100)
+            date = f"20{rnd.randint(15, 24)}{rnd.randint(1, 12):02d}{rnd.randint(1, 28):02d}"
+            tag, open_close = ("Trade", "O") if i % 3 else ("Lot", "C")
+            f.write(f'<{tag} accountId="U0000000" currency="USD" fxRateToBase="1" assetCategory="STK" subCategory="COMMON" '
+                    f'symbol="{symbol}" description="{symbol} INC" conid="{i % 500}" securityID="US{i % 500:010d}" '
+                    f'securityIDType="ISIN" cusip="" isin="US{i % 500:010d}" listingExchange="NYSE" underlyingConid="" '
+                    f'tradeID="{i}" transactionID="{1000000 + i}" ibOrderID="{2000000 + i}" ibExecID="0000.{i}" '
+                    f'reportDate="{date}" tradeDate="{date}" dateTime="{date};101500 EST" settleDateTarget="{date}" '
+                    f'transactionType="ExchTrade" exchange="NYSE" quantity="{qty}" tradePrice="{price:.4f}" '
+                    f'tradeMoney="{qty * price:.2f}" proceeds="{-qty * price:.2f}" taxes="0" ibCommission="-1" '
+                    f'ibCommissionCurrency="USD" netCash="{-qty * price - 1:.2f}" closePrice="{price:.4f}" '
+                    f'openCloseIndicator="{open_close}" notes="" cost="{qty * price:.2f}" fifoPnlRealized="0" '
+                    f'mtmPnl="0" origTradePrice="0" origTradeDate="" origTradeID="" origOrderID="0" '
+                    f'clearingFirmID="" buySell="BUY" ibOrderID2="" orderTime="{date};101500 EST" '
+                    f'openDateTime="" levelOfDetail="EXECUTION" changeInPrice="0" changeInQuantity="0" orderType="LMT" />\n')
+        f.write('</Trades>\n<CashTransactions>\n')
+        for i in range(trades // 100):
+            f.write(f'<CashTransaction accountId="U0000000" currency="USD" symbol="SYM{i % 500}" isin="US{i % 500:010d}" '
+                    f'description="SYM{i % 500} CASH DIVIDEND" dateTime="20240115" amount="1.23" type="Dividends" '
+                    f'actionID="{i}" transactionID="{3000000 + i}" levelOfDetail="DETAIL" />\n')
+        f.write('</CashTransactions>\n</FlexStatement>\n</FlexStatements>\n</FlexQueryResponse>\n')
+
+
+def run_backend(backend, path):
+    """Extract the records with one backend; prints 'seconds records peak_rss_kb'."""
+    from flex_ingest import FlexData, FlexDispatcher, extract_flex_file
+
+    start = time.perf_counter()
+    if backend == "ET.parse":
+        import xml.etree.ElementTree as ET
+        root = ET.parse(path).getroot()
+        records = root.findall('.//Trades/*') + root.findall('.//CashTransaction')
+        count = len(records)
+    elif backend == "lxml.parse":
+        from lxml import etree
+        from flex_ingest import LXML_PARSER_OPTIONS
+        root = etree.parse(path, etree.XMLParser(**LXML_PARSER_OPTIONS))
+        count = len(etree.XPath('//Trades/*')(root)) + len(etree.XPath('//CashTransaction')(root))
+    else:
+        dispatcher = FlexDispatcher(backend)
+        FlexData().register(dispatcher)
+        count = len(extract_flex_file(path, dispatcher.wanted_tags(), backend).records)
+    elapsed = time.perf_counter() - start
+
+    try:
+        import resource
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        peak_kb = 0
+    print(f"{elapsed:.3f} {count} {peak_kb}")
+
+
+def main():
+    from flex_ingest import XML_BACKENDS
+
+    parser = argparse.ArgumentParser(description="Benchmark the Flex Query XML parser backends")
+    parser.add_argument("--trades", type=int, default=100000, help="Number of Trade/Lot records in the synthetic file (default: 100000)")
+    parser.add_argument("--file", help="Use this Flex Query file instead of a synthetic one")
+    parser.add_argument("--run", nargs=2, metavar=("BACKEND", "FILE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_backend(*args.run)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.file
+        if not path:
+            path = os.path.join(tmp, "synthetic_flex_query.xml")
+            write_synthetic_flex_query(path, args.trades)
+        size_mb = os.path.getsize(path) / (1 << 20)
+        print(f"File: {path} ({size_mb:.1f} MB)\n")
+        print(f"{'backend':<12} {'seconds':>8} {'records':>9} {'peak RSS MB':>12}")
+
+        for backend in BENCHMARK_BACKENDS + XML_BACKENDS:
+            result = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", backend, path],
+                                    capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)))
+            if result.returncode != 0:
+                print(f"{backend:<12} failed: {result.stderr.strip().splitlines()[-1] if result.stderr.strip() else result.returncode}")
+                continue
+            seconds, count, peak_kb = result.stdout.split()
+            print(f"{backend:<12} {float(seconds):>8.2f} {int(count):>9} {int(peak_kb) / 1024:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+
+"""
+Build one wide, calendar-aligned table of all currency rates:
+
+    Date,AUD,BRL,CAD,...
+    01.01.2000,0.0.....,N/A,...
+
+Every currency is placed on one shared daily calendar (from the earliest to the
+latest date found in any currency). Days for which a currency has no data (e.g.
+BRL before 2008) are marked with N/A instead of being forward-filled from nothing.
+Row N of the table is always the day start_date + N days, so consumers can index
+a row per day without searching.
+"""
+
+import os
+import re
+import sys
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+DATE_FORMAT = '%d.%m.%Y'
+MISSING = 'N/A'
+
+CORRECTED_FILE_PATTERN = re.compile(r'^([A-Z]{3})_(\d{4})_corrected\.csv$')
+DATE_PATTERN = re.compile(r'\d{2}\.\d{2}\.\d{4}')
+
+def default_currency_dir():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(script_dir, "currency_rates")
+
+def find_corrected_files(currency_dir):
+    """Return {currency code: [paths of the yearly *_corrected.csv files, sorted by year]}."""
+    files_by_currency = {}
+    for fname in sorted(os.listdir(currency_dir)):
+        match = CORRECTED_FILE_PATTERN.match(fname)
+        if match:
+            files_by_currency.setdefault(match.group(1), []).append(os.path.join(currency_dir, fname))
+    return files_by_currency
+
+def read_rates(paths):
+    """Read DD.MM.YYYY,rate lines from the files (header lines are skipped). Returns {date: rate string}."""
+    rates = {}
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                date_str, _, rate_str = line.strip().partition(',')
+                if not DATE_PATTERN.fullmatch(date_str):
+                    continue
+                rate_str = rate_str.strip()
+                if not rate_str:
+                    continue
+                date = datetime.strptime(date_str, DATE_FORMAT).date()
+                previous = rates.get(date)
+                if previous is not None and Decimal(previous) != Decimal(rate_str):
+                    print(f"Warning: {path}: rate for {date_str} is {rate_str}, but {previous} was already read from another file. Using {rate_str}.")
+                rates[date] = rate_str
+    return rates
+
+def build_rate_table(currency_dir):
+    """
+    Align all currencies onto one daily calendar.
+    Returns (start_date, currencies, rows) where rows[i] holds the rate strings
+    (or None for missing) of every currency for the day start_date + i days.
+    """
+    files_by_currency = find_corrected_files(currency_dir)
+    if not files_by_currency:
+        raise ValueError(f"No *_corrected.csv files found in {currency_dir}")
+
+    currencies = sorted(files_by_currency)
+    rates_by_currency = [read_rates(files_by_currency[code]) for code in currencies]
+
+    all_dates = [date for rates in rates_by_currency for date in rates]
+    start_date = min(all_dates)
+    end_date = max(all_dates)
+
+    rows = []
+    day = start_date
+    while day <= end_date:
+        rows.append([rates.get(day) for rates in rates_by_currency])
+        day += timedelta(days=1)
+
+    return start_date, currencies, rows
+
+def write_rate_table(output_file, start_date, currencies, rows):
+    with open(output_file, 'w', encoding='utf-8', newline='') as f:
+        f.write("Date," + ",".join(currencies) + "\n")
+        for offset, row in enumerate(rows):
+            day = start_date + timedelta(days=offset)
+            cells = [rate if rate is not None else MISSING for rate in row]
+            f.write(day.strftime(DATE_FORMAT) + "," + ",".join(cells) + "\n")
+
+def read_rate_table(path):
+    """
+    Load a table written by write_rate_table().
+    Returns (start_date, columns, rows) with the rates as Decimal (None for N/A)
+    and columns mapping every currency code to its index in the rows.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        header = f.readline().strip().split(',')
+        if not header or header[0] != 'Date':
+            raise ValueError(f"Unexpected header in {path}: {header}")
+        columns = {code: index for index, code in enumerate(header[1:])}
+
+        start_date = None
+        rows = []
+        for line in f:
+            cells = line.strip().split(',')
+            if len(cells) != len(header):
+                continue
+            day = datetime.strptime(cells[0], DATE_FORMAT).date()
+            if start_date is None:
+                start_date = day
+            elif day != start_date + timedelta(days=len(rows)):
+                raise ValueError(f"{path}: the table is not a contiguous daily calendar at {cells[0]}")
+            rows.append([Decimal(cell) if cell != MISSING else None for cell in cells[1:]])
+
+    return start_date, columns, rows
+
+def rate_from_table(table, code, date):
+    """Return the rate (Decimal) for currency code on date (a datetime.date), or None if missing."""
+    start_date, columns, rows = table
+    offset = (date - start_date).days
+    column = columns.get(code)
+    if offset < 0 or offset >= len(rows) or column is None:
+        return None
+    return rows[offset][column]
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build one calendar-aligned CSV table with the rates of all currencies")
+    parser.add_argument('output_file', help="Output CSV file (Date,<currency>,<currency>,...)")
+    parser.add_argument('--currency-dir', default=default_currency_dir(), help="Directory with the *_corrected.csv files (default: currency_rates next to this script)")
+    args = parser.parse_args()
+
+    try:
+        start_date, currencies, rows = build_rate_table(args.currency_dir)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    write_rate_table(args.output_file, start_date, currencies, rows)
+
+    end_date = start_date + timedelta(days=len(rows) - 1)
+    print(f"{len(currencies)} currencies ({', '.join(currencies)}) from {start_date.strftime(DATE_FORMAT)} to {end_date.strftime(DATE_FORMAT)} written to {args.output_file}")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,16 @@
 #!/usr/bin/python3
 
-from datetime import datetime
+import re
+from datetime import date, datetime
+from itertools import chain, islice
+
+from stream_io import describe, open_input, open_output, status_stream
+
+# Number of lines used to detect the date format of a file
+SAMPLE_LINES = 100
+
+# Upper bound for the memo of converted dates (ledgers have few distinct dates)
+MAX_CACHED_DATES = 100000
 
 def convert_date(date_str):
     try:
@@ -13,32 +23,106 @@ def convert_date(date_str):
     # Format the date as DD.MM.YYYY
     return date_obj.strftime('%d.%m.%Y')
 
+def _parse_iso(match):
+    year, month, day = match.groups()
+    return date(int(year), int(month), int(day))
+
+def _parse_us_short(match):
+    month, day, year = match.groups()
+    year = int(year)
+    # Same pivot as strptime's %y: 69-99 -> 1969-1999, 00-68 -> 2000-2068
+    year += 1900 if year >= 69 else 2000
+    return date(year, int(month), int(day))
+
+# Direct parsers for the supported input formats: format -> (pattern, parser)
+DATE_PARSERS = {
+    '%Y-%m-%d': (re.compile(r'(\d{4})-(\d{2})-(\d{2})'), _parse_iso),
+    '%m/%d/%y': (re.compile(r'(\d{2})/(\d{2})/(\d{2})'), _parse_us_short),
+}
+
+def detect_date_format(sample):
+    """Return the first supported format that parses every non-empty line of the sample, or None."""
+    dates = [line.strip() for line in sample if line.strip()]
+    if not dates:
+        return None
+    for date_format in DATE_PARSERS:
+        try:
+            for date_str in dates:
+                datetime.strptime(date_str, date_format)
+            return date_format
+        except ValueError:
+            continue
+    return None
+
+def make_date_converter(date_format=None):
+    """
+    Return a convert(date_str) function for the given input format. Results are
+    memoized per distinct input string. Strings that don't match the direct
+    parser (or when date_format is None) fall back to convert_date().
+    """
+    if date_format in DATE_PARSERS:
+        pattern, parse = DATE_PARSERS[date_format]
+        fullmatch = pattern.fullmatch
+    else:
+        fullmatch = None
+
+    cache = {}
+
+    def convert(date_str):
+        result = cache.get(date_str)
+        if result is not None:
+            return result
+
+        match = fullmatch(date_str) if fullmatch else None
+        if match:
+            try:
+                result = parse(match).strftime('%d.%m.%Y')
+            except ValueError:
+                result = convert_date(date_str)
+        else:
+            result = convert_date(date_str)
+
+        if len(cache) >= MAX_CACHED_DATES:
+            cache.clear()
+        cache[date_str] = result
+        return result
+
+    return convert
+
+def sniff_lines(lines):
+    """
+    Detect the date format from the first SAMPLE_LINES lines of an iterable of lines.
+    Returns (convert function, lines), where lines still yields every line (the
+    sample included), so it works for streams that can't be rewound.
+    """
+    sample = list(islice(lines, SAMPLE_LINES))
+    convert = make_date_converter(detect_date_format(sample))
+    return convert, chain(sample, lines)
+
 def main(input_file, output_file):
+    status = status_stream(output_file)
     try:
-        # Read dates from input file
-        with open(input_file, 'r') as file:
-            lines = file.readlines()
-
-        # Convert dates and write to output file
-        with open(output_file, 'w') as file:
+        # Convert dates and write to output file ("-" means stdin/stdout)
+        with open_input(input_file) as infile, \
+             open_output(output_file) as file:
+            convert, lines = sniff_lines(infile)
             for line in lines:
-                converted_date = convert_date(line.strip())
+                converted_date = convert(line.strip())
                 file.write(converted_date + '\n')
 
-        print(f"Conversion completed. Results written to {output_file}")
+        print(f"Conversion completed. Results written to {describe(output_file)}", file=status)
 
     except FileNotFoundError:
-        print(f"Error: File not found - {input_file}")
+        print(f"Error: File not found - {input_file}", file=status)
     except Exception as e:
-        print(f"Error: {e}")
+        print(f"Error: {e}", file=status)
 
 if __name__ == "__main__":
     import sys
 
     if len(sys.argv) != 3:
-        print("Usage: conver_date.py input_file output_file")
+        print("Usage: convert_date.py input_file output_file   (use - for stdin/stdout)")
     else:
         input_file = sys.argv[1]
         output_file = sys.argv[2]
         main(input_file, output_file)
-
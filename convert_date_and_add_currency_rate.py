@@ -1,51 +1,51 @@
 #!/usr/bin/python3
 
-import csv
-from datetime import datetime
+import time
 
-def convert_date(date_str):
-    try:
-        # Try parsing as YYYY-MM-DD format
-        date_obj = datetime.strptime(date_str, '%Y-%m-%d')
-    except ValueError:
-        # If not in YYYY-MM-DD format, try parsing as MM/DD/YY format
-        date_obj = datetime.strptime(date_str, '%m/%d/%y')
-
-    # Format the date as DD.MM.YYYY
-    return date_obj.strftime('%d.%m.%Y')
+from add_currency_rate import BATCH_LINES, load_rates_for, report_throughput
+from convert_date import sniff_lines
+from stream_io import describe, open_input, open_output, status_stream
 
 def main(csv_file, input_file, output_file):
+    status = status_stream(output_file)
     try:
-        # Read currency rates from CSV database
-        with open(csv_file, 'r') as csv_file:
-            csv_reader = csv.reader(csv_file, delimiter=',')
-            currency_rates = {row[0]: row[1] for row in csv_reader}
-
-        # Read dates from input file
-        with open(input_file, 'r') as file:
-            input_dates = file.readlines()
-
-        # Write results to output file
-        with open(output_file, 'w') as file:
-            file.write("Original Date,Converted Date,Currency Rate\n")
-            for input_date in input_dates:
-                input_date = input_date.strip()
-                converted_date = convert_date(input_date)
-                currency_rate = currency_rates.get(converted_date, "N/A")
-                file.write(f"{input_date},{converted_date},{currency_rate}\n")
+        start_time = time.perf_counter()
 
-        print(f"Conversion completed. Results written to {output_file}")
+        currency_rates = load_rates_for(csv_file)
+        get_rate = currency_rates.get
 
-    except FileNotFoundError:
-        print(f"Error: File not found - {csv_file}, {input_file}")
+        line_count = 0
+
+        # Stream dates from input file and write results in large batches
+        with open_input(input_file) as infile, \
+             open_output(output_file) as outfile:
+            outfile.write("Original Date,Converted Date,Currency Rate\n")
+            convert, lines = sniff_lines(infile)
+            batch = []
+            for input_date in lines:
+                input_date = input_date.strip()
+                converted_date = convert(input_date)
+                batch.append(f"{input_date},{converted_date},{get_rate(converted_date, 'N/A')}\n")
+                if len(batch) >= BATCH_LINES:
+                    outfile.write("".join(batch))
+                    line_count += len(batch)
+                    batch.clear()
+            outfile.write("".join(batch))
+            line_count += len(batch)
+
+        print(f"Conversion completed. Results written to {describe(output_file)}", file=status)
+        report_throughput(line_count, start_time, file=status)
+
+    except FileNotFoundError as e:
+        print(f"Error: File not found - {e.filename}", file=status)
     except Exception as e:
-        print(f"Error: {e}")
+        print(f"Error: {e}", file=status)
 
 if __name__ == "__main__":
     import sys
 
     if len(sys.argv) != 4:
-        print("Usage: convert_date_and_add_currency_rate.py currency_rates.csv input_file output_file.csv")
+        print("Usage: convert_date_and_add_currency_rate.py currency_rates.csv|CURRENCY input_file output_file.csv   (use - for stdin/stdout)")
     else:
         csv_file = sys.argv[1]
         input_file = sys.argv[2]
@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+
+"""
+State of incremental exporter runs (ibkr_ods_exporter.py --incremental).
+
+The extracted records of every Flex Query file are already cached by content
+hash (flex_ingest.FlexCache). This module keeps the other half: the sheet rows
+computed on the previous run, for every unit of work (a closing trade with its
+lots, a dividend actionID, a month of interest), keyed by a hash of the unit's
+input records. On the next run only the units whose records changed (or are
+new) are computed again; all others reuse their rows, so adding a weekly Flex
+Query costs the new trades, dividends and interest months only.
+
+All rows are dropped when the fingerprint of the run changes: the scripts,
+the currency rate files or options like --convert-date.
+
+The warnings and errors logged while a unit was computed are stored with its
+rows and repeated when the rows are reused, so an incremental run reports the
+same problems as a full one.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+from collections import Counter
+from pathlib import Path
+
+from log_setup import recording_messages, replay_messages
+
+log = logging.getLogger(__name__)
+
+# Bump when the layout of the state file changes
+STATE_VERSION = 2
+
+
+def fingerprint(*parts, files=(), directories=()) -> str:
+    """
+    Hash of parts (reprs), the content of files and the listing (name, size,
+    modification time) of directories; changes whenever any of them does.
+    """
+    digest = hashlib.sha256(repr(parts).encode("utf-8"))
+    for path in files:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    for directory in directories:
+        try:
+            entries = sorted((e.name, e.stat().st_size, e.stat().st_mtime_ns) for e in os.scandir(directory) if e.is_file())
+        except FileNotFoundError:
+            entries = []
+        digest.update(repr(entries).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ExportState:
+    """
+    Rows computed by earlier runs, stored in a pickle file. Use rows() for
+    every unit of work and save() at the end; units that were not asked for
+    during the run (e.g. from a removed file) are not saved again.
+    """
+
+    def __init__(self, path, run_fingerprint, logger, warnings=None):
+        self.path = Path(path)
+        self.fingerprint = run_fingerprint
+        self.logger = logger
+        self.warnings = warnings
+        self.files = {}
+        self.previous_files = {}
+        self.previous_units = {}
+        self.units = {}
+        self.reused = Counter()
+        self.computed = Counter()
+        self.fingerprint_changed = False
+
+        state = self._load()
+        if state:
+            self.previous_files = state["files"]
+            if state["fingerprint"] == run_fingerprint:
+                self.previous_units = state["units"]
+            else:
+                self.fingerprint_changed = True
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (EOFError, pickle.UnpicklingError, AttributeError, ImportError, ValueError, TypeError) as e:
+            log.warning(f"[warning] Ignoring unreadable incremental state {self.path}: {e}")
+            return None
+        if not isinstance(state, dict) or state.get("version") != STATE_VERSION:
+            return None
+        return state
+
+    def changed_files(self, files):
+        """The files that are new or were modified since the previous run (by size and modification time)."""
+        self.files = {Path(f).name: self._file_signature(f) for f in files}
+        return [name for name, signature in self.files.items() if self.previous_files.get(name) != signature]
+
+    @staticmethod
+    def _file_signature(fpath):
+        stat = os.stat(fpath)
+        return (stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def key(inputs) -> bytes:
+        """The key of a unit whose input records are inputs (anything with a stable repr)."""
+        return hashlib.blake2b(repr(inputs).encode("utf-8"), digest_size=16).digest()
+
+    def previous(self, kind, key):
+        """The entry (result, recorded messages) of the unit from the previous run, or None."""
+        return self.previous_units.get(kind, {}).get(key)
+
+    def keep(self, kind, key, entry, reused):
+        """Keep the entry of a unit of this run (taken from the previous run if reused)."""
+        self.units.setdefault(kind, {})[key] = entry
+        if reused:
+            self.reused[kind] += 1
+        else:
+            self.computed[kind] += 1
+
+    def rows(self, kind, inputs, compute):
+        """
+        The result of compute() for a unit of the given kind (e.g. "closing
+        trades") whose input records are inputs. It is taken from the previous
+        run when the same inputs were seen there.
+        """
+        key = self.key(inputs)
+        entry = self.previous(kind, key)
+        reused = entry is not None
+        if reused:
+            replay_messages(self.logger, entry[1], self.warnings)
+        else:
+            with recording_messages(self.logger, self.warnings) as messages:
+                result = compute()
+            entry = (result, messages)
+        self.keep(kind, key, entry, reused)
+        return entry[0]
+
+    def report(self):
+        """Log how many units of each kind were reused and computed again."""
+        if self.fingerprint_changed:
+            log.info("Incremental run: the scripts, currency rates or options changed since the last run, all rows were computed again")
+        for kind in sorted(set(self.reused) | set(self.computed)):
+            total = self.reused[kind] + self.computed[kind]
+            log.info(f"Incremental run: {self.computed[kind]} of {total} {kind} computed, {self.reused[kind]} reused")
+
+    def save(self):
+        state = {
+            "version": STATE_VERSION,
+            "fingerprint": self.fingerprint,
+            "files": self.files,
+            "units": self.units,
+        }
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = self.path.with_name(f"{self.path.name}.tmp{os.getpid()}")
+            with open(temp_path, 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            log.warning(f"[warning] Could not write the incremental state {self.path}: {e}")
@@ -1,33 +1,233 @@
 #!/usr/bin/python3
 
+import os
 import sys
+from datetime import datetime, timedelta
 
-if len(sys.argv) != 3:
-    print("Usage: fill_gaps_in_currency_rates.py input_file_rates_with_gaps.csv output_file_rates_corrected.csv")
-    exit()
-else:
-    input_file = sys.argv[1]
-    output_file = sys.argv[2]
+DATE_FORMAT = '%d.%m.%Y'
 
-import pandas as pd
+RAW_SUFFIX = '_with_gaps.csv'
+CORRECTED_SUFFIX = '_corrected.csv'
+STATE_FILE_NAME = '.fill_gaps_state.json'
 
-df = pd.read_csv(input_file, header=None, names=['Date', 'Rate'], parse_dates=['Date'], dayfirst=True)
+def parse_rate_line(line):
+    """Parse a 'DD.MM.YYYY,rate' line. Returns (date, rate) or None for blank/header lines."""
+    line = line.strip()
+    if not line:
+        return None
 
-# Ensure the 'Date' column is in datetime format
-df['Date'] = pd.to_datetime(df['Date'], dayfirst=True)
+    date_str, _, rate_str = line.partition(',')
+    try:
+        date = datetime.strptime(date_str.strip(), DATE_FORMAT).date()
+    except ValueError:
+        return None  # header or garbage line
 
-# Create a DataFrame with all dates in the range, including weekends
-date_range = pd.date_range(start=df['Date'].min(), end=df['Date'].max())
-all_dates_df = pd.DataFrame({'Date': date_range})
+    rate_str = rate_str.strip()
+    rate = float(rate_str) if rate_str else None
+    return date, rate
 
-# Merge the original DataFrame with the full date range DataFrame to fill in missing dates
-result_df = pd.merge(all_dates_df, df, on='Date', how='left')
+def fill_gaps(lines):
+    """
+    Read (date, rate) records line by line and yield (date, rate, filled) for every day
+    between the first and the last date. Missing days (and empty rates) are
+    forward-filled with the previous published rate. Only the previous record is
+    kept in memory, so the input can be arbitrarily long.
 
-# Forward-fill missing values
-result_df['Rate'].fillna(method='ffill', inplace=True)
+    The input must be sorted by date (ascending), as the BNB files are.
+    """
+    previous_date = None
+    previous_rate = None
 
-# Write the result to another CSV file with the original date format
-result_df.to_csv(output_file, index=False, date_format='%d.%m.%Y', float_format='%.5f')
+    for line_number, line in enumerate(lines, start=1):
+        record = parse_rate_line(line)
+        if record is None:
+            continue
 
-print(f"Result has been written to {output_file}")
+        date, rate = record
 
+        if previous_date is not None:
+            if date <= previous_date:
+                raise ValueError(f"Date {date.strftime(DATE_FORMAT)} on line {line_number} is not after {previous_date.strftime(DATE_FORMAT)} (the input must be sorted by date)")
+
+            day = previous_date + timedelta(days=1)
+            while day < date:
+                yield day, previous_rate, True
+                day += timedelta(days=1)
+
+        if rate is None:
+            rate = previous_rate
+
+        yield date, rate, False
+
+        previous_date = date
+        previous_rate = rate
+
+def fill_gaps_in_file(input_file, output_file):
+    """
+    Fill the gaps in input_file and write the result to output_file. Returns the number of filled days.
+    The output is written to a temporary file first and renamed over output_file, so a
+    failed run never leaves a half-written rates file behind.
+    """
+    filled_days = 0
+    temp_file = f"{output_file}.tmp{os.getpid()}"
+
+    try:
+        with open(input_file, 'r', encoding='utf-8') as infile, \
+             open(temp_file, 'w', encoding='utf-8', newline='') as outfile:
+            outfile.write("Date,Rate\n")
+            for date, rate, filled in fill_gaps(infile):
+                if filled:
+                    filled_days += 1
+                rate_output = '%.5f' % rate if rate is not None else ''
+                outfile.write(f"{date.strftime(DATE_FORMAT)},{rate_output}\n")
+        os.replace(temp_file, output_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+    return filled_days
+
+def file_sha256(path):
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def find_raw_rate_files(directory):
+    """Return (raw_file, corrected_file) pairs for every *_with_gaps.csv file in the directory."""
+    pairs = []
+    for fname in sorted(os.listdir(directory)):
+        if fname.endswith(RAW_SUFFIX):
+            corrected = fname[:-len(RAW_SUFFIX)] + CORRECTED_SUFFIX
+            pairs.append((os.path.join(directory, fname), os.path.join(directory, corrected)))
+    return pairs
+
+def load_state(state_path):
+    import json
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        print(f"Warning: ignoring unreadable state file {state_path}")
+        return {}
+
+def save_state(state_path, state):
+    import json
+    temp_file = f"{state_path}.tmp{os.getpid()}"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(temp_file, state_path)
+
+def is_up_to_date(raw_file, corrected_file, entry):
+    """
+    Decide whether raw_file must be processed again. The cheap mtime check is done
+    first; the hash is only computed when the mtime differs from the recorded one.
+    Returns (up_to_date, sha256 or None).
+    """
+    mtime = os.stat(raw_file).st_mtime
+
+    if not os.path.exists(corrected_file):
+        return False, None
+
+    if entry is None:
+        # No record from a previous run: trust an existing corrected file that is
+        # newer than its source (it may have been corrected by hand).
+        return os.stat(corrected_file).st_mtime >= mtime, None
+
+    if entry.get('mtime') == mtime:
+        return True, entry.get('sha256')
+
+    sha256 = file_sha256(raw_file)
+    return sha256 == entry.get('sha256'), sha256
+
+def fill_gaps_in_directory(directory, jobs=None, force=False):
+    """
+    Fill the gaps in every *_with_gaps.csv file in the directory and write
+    *_corrected.csv siblings, using a process pool. Only files whose source
+    changed since the last run are processed (unless force is True).
+    Returns a dict {raw file name: filled days} for the processed files.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    state_path = os.path.join(directory, STATE_FILE_NAME)
+    state = load_state(state_path)
+
+    todo = []
+    skipped = 0
+    for raw_file, corrected_file in find_raw_rate_files(directory):
+        name = os.path.basename(raw_file)
+        up_to_date, sha256 = (False, None) if force else is_up_to_date(raw_file, corrected_file, state.get(name))
+        if up_to_date:
+            state[name] = {'mtime': os.stat(raw_file).st_mtime, 'sha256': sha256 or file_sha256(raw_file)}
+            skipped += 1
+        else:
+            todo.append((raw_file, corrected_file))
+
+    summary = {}
+    errors = 0
+
+    if todo:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [(raw_file, executor.submit(fill_gaps_in_file, raw_file, corrected_file))
+                       for raw_file, corrected_file in todo]
+            for raw_file, future in futures:
+                name = os.path.basename(raw_file)
+                try:
+                    summary[name] = future.result()
+                except Exception as e:
+                    print(f"Error: {name}: {e}")
+                    errors += 1
+                    continue
+                state[name] = {'mtime': os.stat(raw_file).st_mtime, 'sha256': file_sha256(raw_file)}
+
+    save_state(state_path, state)
+
+    for name, filled_days in summary.items():
+        print(f"{name}: filled {filled_days} days")
+    print(f"Processed {len(summary)} file(s), skipped {skipped} unchanged file(s), {errors} error(s).")
+
+    return summary
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fill the gaps (weekends and holidays) in BNB currency rate files")
+    parser.add_argument('input_file', nargs='?', help="Input CSV file with gaps (DD.MM.YYYY,rate)")
+    parser.add_argument('output_file', nargs='?', help="Output CSV file with the gaps filled")
+    parser.add_argument('--dir', help="Process every *_with_gaps.csv file in this directory into *_corrected.csv siblings")
+    parser.add_argument('--jobs', type=int, default=None, help="Number of worker processes in --dir mode (default: number of CPUs)")
+    parser.add_argument('--force', action='store_true', help="In --dir mode, process all files even if they are unchanged")
+    args = parser.parse_args()
+
+    if args.dir:
+        if args.input_file or args.output_file:
+            parser.error("--dir can't be combined with input_file/output_file")
+        if not os.path.isdir(args.dir):
+            print(f"Error: Directory not found - {args.dir}")
+            sys.exit(1)
+        fill_gaps_in_directory(args.dir, jobs=args.jobs, force=args.force)
+        return
+
+    if not args.input_file or not args.output_file:
+        parser.error("input_file and output_file are required (or use --dir)")
+
+    input_file = args.input_file
+    output_file = args.output_file
+
+    try:
+        fill_gaps_in_file(input_file, output_file)
+    except FileNotFoundError:
+        print(f"Error: File not found - {input_file}")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    print(f"Result has been written to {output_file}")
+
+if __name__ == "__main__":
+    main()
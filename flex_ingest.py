@@ -0,0 +1,757 @@
+#!/usr/bin/env python3
+# flex_ingest.py
+
+"""
+Single-pass ingestion of IBKR Flex Query XML files.
+
+Every file is read once. The records we need (Trade, Lot, OpenPosition,
+CashTransaction, SecurityInfo, ...) and the attributes of the enclosing
+FlexStatement are routed to the consumers registered for their tag.
+
+Several files are parsed in parallel by a process pool, but their records are
+always dispatched in sorted file order, so the result is the same as reading
+the files one by one.
+
+Extracted records can be cached on disk, keyed by the content hash of each
+file (see FlexCache), so unchanged files are not parsed again on the next run.
+
+Files are read as a stream (lxml or expat parser callbacks, or iterparse with
+the elements cleared as soon as they are handled): each record is turned into
+a tuple of the attributes its consumers declared, so the memory used does not
+depend on the size of the XML file (Flex Queries covering ten years can be
+hundreds of MB).
+"""
+
+import hashlib
+import logging
+import marshal
+import os
+import re
+import sys
+import xml.etree.ElementTree as ET
+from collections import Counter, defaultdict
+from itertools import repeat
+from operator import itemgetter
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+log = logging.getLogger(__name__)
+
+
+class FlexRecord:
+    """
+    The attributes of one Flex Query record (e.g. a <Trade> or <Lot>) without
+    the element itself. Supports el.tag / el.get() / el.attrib like an
+    ElementTree element.
+
+    When only some attributes were extracted, values is a tuple laid out by
+    fields (attribute name -> index, shared by all records of the tag); this
+    is much smaller than a dict per record. Otherwise fields is None and
+    values is the attribute dict.
+    """
+    __slots__ = ("tag", "fields", "values")
+
+    def __init__(self, tag: str, values, fields: Optional[Dict[str, int]] = None):
+        self.tag = tag
+        self.fields = fields
+        self.values = values
+
+    def get(self, key, default=None):
+        if self.fields is None:
+            return self.values.get(key, default)
+        index = self.fields.get(key)
+        if index is None:
+            return default
+        value = self.values[index]
+        return default if value is None else value
+
+    @property
+    def attrib(self) -> Dict[str, str]:
+        if self.fields is None:
+            return self.values
+        return {name: value for name, value in zip(self.fields, self.values) if value is not None}
+
+    def __repr__(self):
+        attrs = " ".join(f'{k}="{v}"' for k, v in self.attrib.items())
+        return f"<{self.tag} {attrs} />"
+
+
+class FlexContext:
+    """Where a record was found: the file, the section (e.g. 'Trades') and the FlexStatement attributes."""
+    __slots__ = ("path", "section", "statement")
+
+    def __init__(self, path, section=None, statement=None):
+        self.path = path
+        self.section = section
+        self.statement = statement if statement is not None else {}
+
+
+# Bump when the extracted records change, to invalidate cached extracts
+PARSER_VERSION = 2
+
+# Available XML parser backends for extract_flex_file(). etree is the default
+# (no extra dependency); lxml and expat are low-memory alternatives that stream
+# through parser callbacks. None of them is faster than reading the whole tree
+# with ET.parse: streaming saves memory, not time (see benchmark_flex_parsers.py)
+XML_BACKENDS = ("etree", "expat", "lxml")
+DEFAULT_XML_BACKEND = "etree"
+
+# The one lxml parser configuration used for all Flex Query files: no size
+# limits for multi-year statements, and no DTD loading, entity expansion or
+# network access (the files come from outside)
+LXML_PARSER_OPTIONS = dict(huge_tree=True, load_dtd=False, resolve_entities=False, no_network=True)
+
+
+def resolve_backend(backend: str) -> str:
+    """Check that the backend name is one of XML_BACKENDS."""
+    if backend not in XML_BACKENDS:
+        raise ValueError(f"Unknown XML backend '{backend}' (available: {', '.join(XML_BACKENDS)})")
+    return backend
+
+
+def flex_query_files(xml_dir) -> List[Path]:
+    """All .xml files in the directory, sorted by name."""
+    return sorted(p for p in Path(xml_dir).iterdir() if p.suffix.lower() == '.xml')
+
+
+class FlexFileExtract:
+    """
+    The records extracted from one file: statements is a list of FlexStatement
+    attribute dicts and records a list of (tag, section, values, statement index)
+    tuples in document order. values is a tuple laid out by the attribute names
+    in tags[tag], or the full attribute dict when tags[tag] is None.
+    """
+    __slots__ = ("path", "tags", "statements", "records")
+
+    def __init__(self, path, tags, statements, records):
+        self.path = path
+        self.tags = tags
+        self.statements = statements
+        self.records = records
+
+
+def project_attributes(attrib, attributes, pool):
+    """
+    The values of the given attributes as a tuple (None if missing), or a copy
+    of all attributes if attributes is None. Equal values share one string
+    object through pool (most values, like currency, symbol or dates, repeat).
+    """
+    if attributes is None:
+        return dict(attrib)
+    values = list(map(attrib.get, attributes))
+    return tuple(map(pool.setdefault, values, values))
+
+
+def extract_flex_file(fpath, tags, backend=DEFAULT_XML_BACKEND) -> FlexFileExtract:
+    """
+    Extract the records with the given tags from one Flex Query file.
+    tags maps a tag to the attribute names to keep (None = all).
+    Raises ET.ParseError for malformed files.
+    """
+    backend = resolve_backend(backend)
+    if backend == "expat":
+        return _extract_flex_file_expat(fpath, tags)
+    if backend == "lxml":
+        return _extract_flex_file_lxml(fpath, tags)
+    return _extract_flex_file_etree(fpath, tags)
+
+
+def _extract_flex_file_etree(fpath, tags) -> FlexFileExtract:
+    """
+    Stream the file with iterparse. Every element is cleared as soon as it has
+    been handled, so the tree is never held in memory.
+    """
+    statements = []
+    records = []
+    pool = {}
+
+    depth = 0
+    statement_depth = None
+    section = None
+    section_tag = None
+
+    for event, el in ET.iterparse(fpath, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if el.tag == "FlexStatement":
+                statement_depth = depth
+                statements.append(dict(el.attrib))
+            elif statement_depth is not None and depth == statement_depth + 1:
+                section = el
+                section_tag = el.tag
+            continue
+
+        # "end" event
+        if statement_depth is not None and depth == statement_depth + 2:
+            if el.tag in tags:
+                records.append((el.tag, section_tag, project_attributes(el.attrib, tags[el.tag], pool), len(statements) - 1))
+            # Drop the record and every already handled sibling
+            el.clear()
+            section.clear()
+        elif statement_depth is not None and depth == statement_depth + 1:
+            el.clear()
+            section = section_tag = None
+        elif depth == statement_depth:
+            el.clear()
+            statement_depth = None
+        depth -= 1
+
+    return FlexFileExtract(Path(fpath), tags, statements, records)
+
+
+def _extract_flex_file_expat(fpath, tags) -> FlexFileExtract:
+    """
+    Read the file with expat start-element callbacks: a constant-memory
+    fallback (no element objects are created, the attributes of the wanted
+    records are projected straight into tuples), not a faster parser. expat
+    still builds the attribute dict of every element and calls back into
+    Python for each one, so it is slower than the etree backend.
+    """
+    from xml.parsers import expat
+
+    statements = []
+    records = []
+    append = records.append
+    pool = {}
+
+    # depth, statement depth, current section
+    state = [0, None, None]
+
+    def start_element(name, attrs):
+        state[0] += 1
+        depth = state[0]
+        statement_depth = state[1]
+        if name == "FlexStatement":
+            state[1] = depth
+            statements.append(attrs)
+        elif statement_depth is not None:
+            if depth == statement_depth + 2:
+                if name in tags:
+                    append((name, state[2], project_attributes(attrs, tags[name], pool), len(statements) - 1))
+            elif depth == statement_depth + 1:
+                state[2] = name
+
+    def end_element(name):
+        if state[0] == state[1]:
+            state[1] = None
+        state[0] -= 1
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+
+    try:
+        with open(fpath, 'rb') as f:
+            parser.ParseFile(f)
+    except expat.ExpatError as e:
+        raise ET.ParseError(str(e)) from e
+
+    return FlexFileExtract(Path(fpath), tags, statements, records)
+
+
+class _FlexTarget:
+    """
+    lxml parser target: receives the start/end events of the parser directly,
+    so (as with expat) no element tree is built, while the parsing itself is
+    done by libxml2. A low-memory option, not a faster one: every element
+    still costs a Python callback, so it is slower than parsing the whole
+    tree (an lxml iterparse with a tag filter was no faster either).
+    """
+
+    def __init__(self, tags):
+        self.tags = tags
+        self.statements = []
+        self.records = []
+        self.pool = {}
+        self.depth = 0
+        self.statement_depth = None
+        self.section = None
+
+    def start(self, name, attrs):
+        self.depth += 1
+        depth = self.depth
+        statement_depth = self.statement_depth
+        if name == "FlexStatement":
+            self.statement_depth = depth
+            self.statements.append(dict(attrs))
+        elif statement_depth is not None:
+            if depth == statement_depth + 2:
+                if name in self.tags:
+                    self.records.append((name, self.section, project_attributes(attrs, self.tags[name], self.pool),
+                                         len(self.statements) - 1))
+            elif depth == statement_depth + 1:
+                self.section = name
+
+    def end(self, name):
+        if self.depth == self.statement_depth:
+            self.statement_depth = None
+        self.depth -= 1
+
+    def close(self):
+        return self
+
+
+def _extract_flex_file_lxml(fpath, tags) -> FlexFileExtract:
+    """Feed the file in chunks to an lxml parser configured with LXML_PARSER_OPTIONS."""
+    from lxml import etree
+
+    parser = etree.XMLParser(target=_FlexTarget(tags), **LXML_PARSER_OPTIONS)
+    try:
+        with open(fpath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                parser.feed(chunk)
+        target = parser.close()
+    except etree.XMLSyntaxError as e:
+        raise ET.ParseError(str(e)) from e
+
+    return FlexFileExtract(Path(fpath), tags, target.statements, target.records)
+
+
+def _extract_or_error(fpath, tags, backend="etree"):
+    """extract_flex_file() for the worker pool: returns (extract, None) or (None, error message)."""
+    try:
+        return extract_flex_file(fpath, tags, backend), None
+    except ET.ParseError as e:
+        return None, f"[ERROR] Failed to parse XML file '{Path(fpath).name}': {e}"
+    except Exception as e:
+        return None, f"[ERROR] Unexpected error processing file '{Path(fpath).name}': {e}"
+
+
+# Cache entries not used by this many runs are deleted (see FlexCache.prune())
+CACHE_MAX_IDLE_RUNS = 10
+
+# Names of cache entries of any parser version; prune() never touches other files
+CACHE_ENTRY_NAME = re.compile(r"v\d+_[0-9a-f]{64}\.bin")
+
+
+class FlexCache:
+    """
+    On-disk cache of extracted Flex Query records. Entries are keyed by the
+    SHA-256 of the file content, the parser version and the extracted tags and
+    attributes, and stored with marshal (compact and fast to load). A file that
+    didn't change is therefore never parsed again; renamed copies hit the cache too.
+
+    Entries of edited or replaced files are never hit again, so after every
+    run prune() deletes the entries of other parser versions and the ones not
+    used by the last CACHE_MAX_IDLE_RUNS runs.
+    """
+
+    INDEX_NAME = "cache_runs.marshal"  # run counter and the last run using each entry
+
+    def __init__(self, directory, max_idle_runs=CACHE_MAX_IDLE_RUNS):
+        self.directory = Path(directory)
+        self.max_idle_runs = max_idle_runs
+
+    @staticmethod
+    def entry_name(key) -> str:
+        return f"v{PARSER_VERSION}_{key}.bin"
+
+    def key(self, fpath, tags) -> str:
+        digest = hashlib.sha256()
+        with open(fpath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        signature = repr((PARSER_VERSION, sys.version_info[:2], sorted(tags.items())))
+        digest.update(signature.encode("utf-8"))
+        return digest.hexdigest()
+
+    def load(self, key, fpath, tags) -> Optional[FlexFileExtract]:
+        try:
+            with open(self.directory / self.entry_name(key), 'rb') as f:
+                statements, records = marshal.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except (EOFError, ValueError, TypeError) as e:
+            log.warning(f"[warning] Ignoring corrupt cache entry for {Path(fpath).name}: {e}")
+            return None
+        return FlexFileExtract(Path(fpath), tags, statements, records)
+
+    def store(self, key, extract: FlexFileExtract):
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = self.directory / self.entry_name(key)
+            temp_path = self.directory / f"{key}.tmp{os.getpid()}"
+            with open(temp_path, 'wb') as f:
+                f.write(marshal.dumps((extract.statements, extract.records)))
+            os.replace(temp_path, path)
+        except OSError as e:
+            log.warning(f"[warning] Could not write Flex Query cache entry for {extract.path.name}: {e}")
+
+    def prune(self, used_keys):
+        """
+        Count a run that used the entries of used_keys and delete the entries
+        written by another PARSER_VERSION or not used by the last
+        max_idle_runs runs. Only files named like cache entries
+        (CACHE_ENTRY_NAME) or listed in the index are ever deleted.
+        """
+        index_path = self.directory / self.INDEX_NAME
+        try:
+            with open(index_path, 'rb') as f:
+                run, last_used = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            run, last_used = 0, {}
+        run += 1
+        for key in used_keys:
+            last_used[self.entry_name(key)] = run
+
+        prefix = f"v{PARSER_VERSION}_"
+        kept = {}
+        removed = 0
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            for path in self.directory.glob("*.bin"):
+                if not (CACHE_ENTRY_NAME.fullmatch(path.name) or path.name in last_used):
+                    continue  # not ours: the directory may be shared with other files
+                # Entries from before the index existed start counting now
+                used = last_used.get(path.name, run)
+                if path.name.startswith(prefix) and run - used < self.max_idle_runs:
+                    kept[path.name] = used
+                    continue
+                path.unlink()
+                removed += 1
+            temp_path = self.directory / f"{self.INDEX_NAME}.tmp{os.getpid()}"
+            with open(temp_path, 'wb') as f:
+                f.write(marshal.dumps((run, kept)))
+            os.replace(temp_path, index_path)
+        except OSError as e:
+            log.warning(f"[warning] Could not prune the Flex Query cache in {self.directory}: {e}")
+            return
+        if removed:
+            log.debug("[debug] Flex Query cache: removed %s stale entr%s", removed, "y" if removed == 1 else "ies")
+
+
+class FlexDispatcher:
+    """
+    Reads Flex Query files and routes every record to the consumers registered
+    for its tag. A consumer is called as consumer(record, context).
+    Consumers registered for "FlexStatement" are called once per statement,
+    before the records of that statement.
+    """
+
+    def __init__(self, backend: str = DEFAULT_XML_BACKEND):
+        self.backend = resolve_backend(backend)
+        self.consumers: Dict[str, List[Callable]] = defaultdict(list)
+        self.attributes: Dict[str, Optional[set]] = {}
+
+    def register(self, tag: str, consumer: Callable, section: Optional[str] = None, attributes=None):
+        """
+        Register consumer for records with this tag (optionally only inside the
+        given section). attributes lists the attribute names the consumer reads;
+        only those are extracted (None = all attributes).
+        """
+        if section is not None:
+            wrapped = consumer
+
+            def consumer(record, context, _wrapped=wrapped):
+                if context.section == section:
+                    _wrapped(record, context)
+
+        self.consumers[tag].append(consumer)
+
+        if attributes is None or (tag in self.attributes and self.attributes[tag] is None):
+            self.attributes[tag] = None
+        else:
+            self.attributes[tag] = self.attributes.get(tag, set()) | set(attributes)
+
+    def wanted_tags(self) -> Dict[str, Optional[tuple]]:
+        """tag -> attribute names to extract (None = all) for every registered record tag."""
+        return {tag: (tuple(sorted(attrs)) if attrs is not None else None)
+                for tag, attrs in self.attributes.items() if tag != "FlexStatement"}
+
+    def dispatch_extract(self, extract: FlexFileExtract):
+        """Route the records of one extracted file to the consumers, in document order."""
+        contexts = [FlexContext(extract.path, statement=statement) for statement in extract.statements]
+        fields = {tag: ({name: index for index, name in enumerate(names)} if names is not None else None)
+                  for tag, names in extract.tags.items()}
+
+        statement_consumers = self.consumers.get("FlexStatement", [])
+        next_statement = 0
+
+        for tag, section, values, statement_index in extract.records:
+            # Announce the statements up to (and including) the one of this record
+            while next_statement <= statement_index:
+                for consumer in statement_consumers:
+                    consumer(FlexRecord("FlexStatement", extract.statements[next_statement]), contexts[next_statement])
+                next_statement += 1
+
+            context = contexts[statement_index]
+            context.section = section
+            record = FlexRecord(tag, values, fields[tag])
+            for consumer in self.consumers[tag]:
+                consumer(record, context)
+
+        while next_statement < len(extract.statements):
+            for consumer in statement_consumers:
+                consumer(FlexRecord("FlexStatement", extract.statements[next_statement]), contexts[next_statement])
+            next_statement += 1
+
+    def ingest_file(self, fpath) -> bool:
+        """Parse one file and dispatch its records. Returns False if the file was skipped."""
+        fpath = Path(fpath)
+        if fpath.stat().st_size == 0:
+            log.warning(f"[warning] Skipping empty file: {fpath}")
+            return False
+
+        log.debug("[debug] Processing XML file: %s", fpath.name)
+
+        try:
+            extract = extract_flex_file(fpath, self.wanted_tags(), self.backend)
+        except ET.ParseError as e:
+            log.error(f"[ERROR] Failed to parse XML file '{fpath.name}': {e}")
+            return False
+
+        # Records are only dispatched once the whole file was parsed, so a
+        # malformed file is skipped entirely instead of being half-read.
+        self.dispatch_extract(extract)
+        return True
+
+    def ingest(self, files, jobs=None, cache=None):
+        """
+        Parse all files and dispatch their records in the given order. With more
+        than one file and jobs != 1 the files are parsed by a pool of jobs
+        worker processes (None = one per CPU); only the extracted records are
+        sent back, and they are dispatched here in the original file order.
+        With a FlexCache, files whose content was already extracted are loaded
+        from the cache and only new or modified files are parsed; stale entries
+        are pruned afterwards (see FlexCache.prune()).
+        """
+        readable = []
+        for fpath in map(Path, files):
+            if fpath.stat().st_size == 0:
+                log.warning(f"[warning] Skipping empty file: {fpath}")
+                continue
+            readable.append(fpath)
+
+        tags = self.wanted_tags()
+
+        results = [None] * len(readable)
+        keys = [None] * len(readable)
+        to_parse = []
+        for i, fpath in enumerate(readable):
+            if cache is not None:
+                keys[i] = cache.key(fpath, tags)
+                extract = cache.load(keys[i], fpath, tags)
+                if extract is not None:
+                    results[i] = (extract, None)
+                    continue
+            to_parse.append(i)
+
+        if to_parse:
+            parsed = self._parse_files([readable[i] for i in to_parse], tags, jobs)
+            for i, (extract, error) in zip(to_parse, parsed):
+                results[i] = (extract, error)
+                if cache is not None and extract is not None:
+                    cache.store(keys[i], extract)
+
+        if cache is not None:
+            log.debug("[debug] Flex Query cache: %s file(s) loaded from cache, %s parsed", len(readable) - len(to_parse), len(to_parse))
+
+        self._dispatch_results(readable, results)
+
+        if cache is not None:
+            cache.prune(key for key, (extract, error) in zip(keys, results) if extract is not None)
+
+    def _parse_files(self, files, tags, jobs):
+        """Return the (extract, error) of every file, in the order of files."""
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        jobs = min(jobs, len(files))
+
+        if jobs <= 1:
+            return [_extract_or_error(fpath, tags, self.backend) for fpath in files]
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            # executor.map() yields the results in the order of the input files
+            return list(executor.map(_extract_or_error, files, repeat(tags), repeat(self.backend)))
+
+    def _dispatch_results(self, files, results):
+        for fpath, (extract, error) in zip(files, results):
+            log.debug("[debug] Processing XML file: %s", fpath.name)
+            if error:
+                log.error(error)
+                continue
+            try:
+                self.dispatch_extract(extract)
+            except Exception as e:
+                log.error(f"[ERROR] Unexpected error processing file '{fpath.name}': {e}")
+
+
+# The attributes the exporter reads from each record type
+TRADE_ATTRIBUTES = (
+    "accountId", "assetCategory", "subCategory", "symbol", "description", "conid", "isin",
+    "exchange", "currency", "fxRateToBase", "transactionID", "tradeID", "ibOrderID", "ibExecID",
+    "levelOfDetail", "openCloseIndicator", "buySell", "tradeDate", "dateTime", "orderTime",
+    "settleDateTarget", "quantity", "tradePrice", "tradeMoney", "proceeds", "cost", "netCash",
+    "closePrice", "fifoPnlRealized", "mtmPnl", "ibCommission", "openDateTime", "realizedPnL",
+)
+OPEN_POSITION_ATTRIBUTES = (
+    "accountId", "assetCategory", "subCategory", "symbol", "description", "conid", "isin",
+    "currency", "side", "levelOfDetail", "position", "costBasisMoney", "openDateTime",
+    "originatingTransactionID", "issuerCountryCode", "reportDate",
+)
+CASH_TRANSACTION_ATTRIBUTES = (
+    "accountId", "type", "levelOfDetail", "actionID", "transactionID", "amount", "currency",
+    "dateTime", "description", "symbol", "conid", "isin", "issuerCountryCode",
+)
+SECURITY_INFO_ATTRIBUTES = (
+    "assetCategory", "symbol", "description", "conid", "isin", "issuerCountryCode",
+)
+
+
+# The attributes identifying a record for FlexDedup. The first one is the id:
+# records without it are never dropped. Every key includes accountId, so
+# statements of different accounts whose ids collide never drop each other's
+# records.
+#  - <Trade>: transactionID, IBKR's unique id of the execution (the ORDER and
+#    EXECUTION rows share it, so the level of detail is part of the key)
+#  - closing <Lot>: carries the transactionID of the trade that opened it, and
+#    one opening trade can be closed by several sales, so the lot is identified
+#    by that id together with its closing order, time and quantity
+#  - <CashTransaction>: (actionID, transactionID); the SUMMARY and DETAIL rows
+#    share the ids
+#  - <OpenPosition>: the lot (its originating trade, open time and size) in the
+#    statement ending on toDate (added by FlexDedup)
+TRADE_KEY = ("transactionID", "accountId", "levelOfDetail")
+LOT_KEY = ("transactionID", "accountId", "ibOrderID", "ibExecID", "dateTime", "quantity")
+CASH_TRANSACTION_KEY = ("transactionID", "accountId", "actionID", "levelOfDetail")
+OPEN_POSITION_KEY = ("originatingTransactionID", "accountId", "levelOfDetail", "conid", "isin", "side", "openDateTime", "position")
+
+
+def key_getter(fields, names) -> Callable:
+    """A function returning the tuple of the given attributes from the values of a record laid out by fields."""
+    if fields is None:
+        return lambda values: tuple(values.get(name) for name in names)
+    if all(name in fields for name in names):
+        return itemgetter(*(fields[name] for name in names))
+    indexes = [fields.get(name) for name in names]
+    return lambda values: tuple(values[index] if index is not None else None for index in indexes)
+
+
+class FlexDedup:
+    """
+    Drops records that were already read from an earlier file, so Flex Queries
+    with overlapping periods can be combined. Every kind of record (trades,
+    lots, ...) is identified by a tuple of its attributes (see TRADE_KEY etc.);
+    the keys of each file are kept in a set per kind and checked by membership.
+
+    Only repeats from earlier files are dropped: records within one file are
+    always kept, and so are records without an id.
+    """
+
+    def __init__(self):
+        self.seen: Dict[str, set] = defaultdict(set)     # kind -> keys from the earlier files
+        self.current: Dict[str, set] = defaultdict(set)  # kind -> keys from the current file
+        self.path = None
+        self.dropped = defaultdict(Counter)              # file name -> kind -> dropped records
+
+    def unique(self, kind: str, key_attributes: tuple, consumer: Callable,
+               per_statement: bool = False, reported: bool = True) -> Callable:
+        """
+        Wrap consumer so it is only called for records not seen in an earlier
+        file. With per_statement the toDate of the FlexStatement is part of the
+        key. reported=False leaves the dropped records out of report() (for a
+        second view of records that are already counted).
+        """
+        seen = self.seen[kind]
+        current = self.current[kind]
+        # The getter for the fields layout of the current file's records
+        layout = [object(), None]
+
+        def dedup_consumer(record, context):
+            if context.path is not self.path:
+                self._start_file(context.path)
+            if record.fields is not layout[0]:
+                layout[:] = [record.fields, key_getter(record.fields, key_attributes)]
+            key = layout[1](record.values)
+            if key[0]:
+                if per_statement:
+                    key = (context.statement.get("toDate", ""),) + key
+                if key in seen:
+                    if reported:
+                        self.dropped[context.path.name][kind] += 1
+                    return
+                current.add(key)
+            consumer(record, context)
+
+        return dedup_consumer
+
+    def _start_file(self, path):
+        for kind, keys in self.current.items():
+            self.seen[kind].update(keys)
+            keys.clear()
+        self.path = path
+
+    def report(self):
+        """Log the number of duplicates dropped from each file."""
+        for name, kinds in self.dropped.items():
+            details = ", ".join(f"{count} {kind}" for kind, count in kinds.items())
+            log.info(f"Dropped {sum(kinds.values())} record(s) of {name} already read from another file (overlapping periods): {details}")
+
+
+class FlexData:
+    """The records collected from a set of Flex Query files, in file order, without duplicates (see FlexDedup)."""
+
+    def __init__(self):
+        self.trades: List[FlexRecord] = []            # <Trade> and <Lot> from the Trades sections
+        self.all_trades: List[FlexRecord] = []        # every <Trade>, whatever the section
+        self.open_positions: List[tuple] = []         # (record, FlexStatement toDate)
+        self.cash_transactions: List[FlexRecord] = []
+        self.security_infos: List[FlexRecord] = []
+        self.statements: List[Dict[str, str]] = []
+        self.dedup = FlexDedup()
+
+    def register(self, dispatcher: FlexDispatcher):
+        unique = self.dedup.unique
+        dispatcher.register("Trade", unique("trades", TRADE_KEY, lambda r, c: self.trades.append(r)),
+                            section="Trades", attributes=TRADE_ATTRIBUTES)
+        dispatcher.register("Lot", unique("lots", LOT_KEY, lambda r, c: self.trades.append(r)),
+                            section="Trades", attributes=TRADE_ATTRIBUTES)
+        dispatcher.register("Trade", unique("all trades", TRADE_KEY, lambda r, c: self.all_trades.append(r), reported=False),
+                            attributes=TRADE_ATTRIBUTES)
+        dispatcher.register("OpenPosition", unique("open positions", OPEN_POSITION_KEY,
+                                                   lambda r, c: self.open_positions.append((r, c.statement.get("toDate", ""))),
+                                                   per_statement=True),
+                            attributes=OPEN_POSITION_ATTRIBUTES)
+        dispatcher.register("CashTransaction", unique("cash transactions", CASH_TRANSACTION_KEY,
+                                                      lambda r, c: self.cash_transactions.append(r)),
+                            attributes=CASH_TRANSACTION_ATTRIBUTES)
+        dispatcher.register("SecurityInfo", lambda r, c: self.security_infos.append(r), attributes=SECURITY_INFO_ATTRIBUTES)
+        dispatcher.register("FlexStatement", lambda r, c: self.statements.append(r.attrib))
+
+    def accounts(self) -> List[str]:
+        """The accounts of the records, sorted ("-", used by IBKR for SUMMARY rows, is not an account)."""
+        records = self.trades + self.all_trades + self.cash_transactions + [pos for pos, _ in self.open_positions]
+        return sorted({account for r in records if (account := r.get("accountId")) and account != "-"})
+
+    def by_account(self) -> Dict[str, "FlexData"]:
+        """
+        The records split by accountId, one FlexData per account (the shards
+        are independent, e.g. to be processed in parallel). Records without an
+        account (such as SUMMARY rows) are left out; the SecurityInfo records
+        describe instruments, not holdings, so every shard gets all of them.
+        """
+        shards = {}
+        for account in self.accounts():
+            shard = shards[account] = FlexData()
+            shard.security_infos = self.security_infos
+            shard.statements = [s for s in self.statements if s.get("accountId") in (account, None)]
+        for name in ("trades", "all_trades", "cash_transactions"):
+            for record in getattr(self, name):
+                if shard := shards.get(record.get("accountId")):
+                    getattr(shard, name).append(record)
+        for pos, to_date in self.open_positions:
+            if shard := shards.get(pos.get("accountId")):
+                shard.open_positions.append((pos, to_date))
+        return shards
+
+
+def collect_flex_data(files, jobs=None, cache=None, backend=DEFAULT_XML_BACKEND) -> FlexData:
+    """Read every file once (in parallel when jobs != 1) and collect all records the exporter needs."""
+    data = FlexData()
+    dispatcher = FlexDispatcher(backend)
+    data.register(dispatcher)
+    dispatcher.ingest(files, jobs=jobs, cache=cache)
+    data.dedup.report()
+    return data
@@ -2,16 +2,17 @@
 # ibkr_ods_exporter.py
 
 import os
-import xml.etree.ElementTree as ET
 import re
 import argparse
 import sys
 import json
+import logging
 from collections import defaultdict, OrderedDict
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
 from dateutil import parser
 from zoneinfo import ZoneInfo  # Python 3.9+
-from decimal import Decimal, ROUND_HALF_UP, getcontext
+from decimal import Decimal, ROUND_HALF_UP, InvalidOperation, getcontext
 from pathlib import Path
 from typing import List, Dict, Tuple, Callable, Optional
 
@@ -21,11 +22,19 @@ from odf.style import Style, TextProperties, TableCellProperties
 from odf.table import Table, TableRow, TableCell, TableColumn
 from odf.text import P
 
-# LXML for more advanced XML parsing (if needed, otherwise ET is usually sufficient)
-from lxml import etree 
-
 # Local imports
-from process_IBKR_dividends import look_for_currency_rate, round_decimal
+from process_IBKR_dividends import (currency_rate_files, currency_rates, defer_missing_currency_rates, look_for_currency_rate,
+                                    missing_currency_rates, missing_currency_rates_deferred, preload_currency_rates,
+                                    report_missing_currency_rates, resolve_currency_rates, round_decimal)
+from flex_ingest import DEFAULT_XML_BACKEND, XML_BACKENDS, FlexCache, FlexData, collect_flex_data, flex_query_files
+from log_setup import TRACE, WarningSummary, add_logging_arguments, configure_logging, recording_messages, replay_messages, verbosity_level
+from export_state import ExportState, fingerprint
+from lot_engine import FifoLotEngine, execution_time, lot_signature
+
+log = logging.getLogger(__name__)
+
+# Warnings repeated for many records are counted here and summarized at the end
+warning_summary = WarningSummary(log)
 
 
 # Set higher precision for Decimal
@@ -40,32 +49,38 @@ ASSET_CATS_IGNORE = {
     "CASH"
 }
 
+# Asset categories of the Open Positions sheet
+OPEN_POSITION_CATS = ("STK", "FUND")
+
+# The cache of parsed XML files (and the --incremental state) is kept next to
+# the script, not in the user's XML directory
+DEFAULT_CACHE_DIR = Path(__file__).resolve().parent / ".ibkr_cache"
+
 
 def parse_all_trades_from_dir(xml_dir):
     """
-    Load all <Trade> and <Lot> elements from XML files in a given directory.
-    Returns a list of ElementTree elements.
+    Load all <Trade> and <Lot> records from XML files in a given directory.
+    Returns a list of FlexRecord objects (in file order).
     """
-    all_elements = []
-
-    for fname in sorted(os.listdir(xml_dir)):
-        if not fname.lower().endswith(".xml"):
-            continue
+    return collect_flex_data(flex_query_files(xml_dir)).trades
 
-        print(f"[debug] Processing XML file at parse_all_trades_from_dir(): {fname}")
+class OpeningTrade:
+    """
+    An opening execution, as needed to match the closing lots against it.
+    Only the price is converted to Decimal; the other attributes (description,
+    isin, ...) are read from the underlying record when needed.
+    """
+    __slots__ = ("price", "currency", "trade_date", "date_time", "record")
 
-        fpath = os.path.join(xml_dir, fname)
-        try:
-            tree = ET.parse(fpath)
-            root = tree.getroot()
-            trades = root.findall('.//Trades/*')
-            all_elements.extend(trades)
-        except ET.ParseError as e:
-            print(f"[ERROR] Failed to parse XML file '{fname}': {e}")
-        except Exception as e:
-            print(f"[ERROR] Unexpected error processing file '{fname}': {e}")
+    def __init__(self, record):
+        self.price = Decimal(record.get("tradePrice", "0"))  # Default to 0 if not found
+        self.currency = record.get("currency")
+        self.trade_date = record.get("tradeDate")
+        self.date_time = record.get("dateTime")
+        self.record = record
 
-    return all_elements
+    def get(self, key, default=None):
+        return self.record.get(key, default)
 
 def index_opening_trades(elements):
     opens = {}
@@ -83,292 +98,519 @@ def index_opening_trades(elements):
             if asset_category in ASSET_CATS_IGNORE:
                 continue
             else:
-                print(f"WARNING: Unexpected assetCategory \"{asset_category}\": ",  ET.tostring(el, encoding="unicode") )
+                warning_summary.warn("Unexpected assetCategory", asset_category,
+                                     "WARNING: Unexpected assetCategory \"%s\": %s", asset_category, el)
 
         tid = el.get("transactionID")
         if not tid:
-            print("WARNING: Trade element missing transactionID. Skipping. Context: ", ET.tostring(el, encoding="unicode"))
+            warning_summary.warn("Trade without transactionID (skipped)", el.get("symbol"),
+                                 "WARNING: Trade element missing transactionID. Skipping. Context: %s", el)
             continue
 
-        # Extracting relevant attributes
-        symbol = el.get("symbol")
-        buy_sell = el.get("buySell")
-        trade_date = el.get("tradeDate")
         date_time = el.get("dateTime")
-        price = Decimal(el.get("tradePrice", "0"))  # Default to 0 if not found
-        currency = el.get("currency")
-        sub_category = el.get("subCategory")
-        description = el.get("description")
-        isin = el.get("isin")
-        exchange = el.get("exchange")
-        fx_rate = Decimal(el.get("fxRateToBase", "1") or "1")  # Default to 1 if not found
-
-        # New attributes to include
-        quantity = el.get("quantity", "0")  # Default to 0 if missing
-        cost = Decimal(el.get("cost", "0"))  # Default to 0 if missing
-        trade_money = Decimal(el.get("tradeMoney", "0"))  # Default to 0 if missing
-        proceeds = Decimal(el.get("proceeds", "0"))  # Default to 0 if missing
-        order_time = el.get("orderTime")
-        net_cash = Decimal(el.get("netCash", "0"))  # Default to 0 if missing
-        close_price = Decimal(el.get("closePrice", "0"))  # Default to 0 if missing
-        fifo_pnl_realized = Decimal(el.get("fifoPnlRealized", "0"))  # Default to 0 if missing
-        mtm_pnl = Decimal(el.get("mtmPnl", "0"))  # Default to 0 if missing
-        ib_commission = Decimal(el.get("ibCommission", "0"))  # Default to 0 if missing
-        settle_date_target = el.get("settleDateTarget")
-
         if not is_valid_timestamp(date_time):
-            print(f"WARNING: CHECK YOUR FLEX QUERY DATE SETTINGS! The dateTime format is unexpected (in index_opening_trades)! date_time = \"{date_time}\"")
-
+            warning_summary.warn("Unexpected dateTime format (opening trade)", el.get("symbol"),
+                                 "WARNING: CHECK YOUR FLEX QUERY DATE SETTINGS! The dateTime format is unexpected (in index_opening_trades)! date_time = \"%s\"", date_time)
 
         try:
-            # Add all collected data to the dictionary
-            opens[tid] = {
-                "symbol": symbol,
-                "buySell": buy_sell,
-                "tradeDate": trade_date,
-                "dateTime": date_time,
-                "price": price,
-                "currency": currency,
-                "assetCategory": asset_category,
-                "subCategory": sub_category,
-                "description": description,
-                "isin": isin,
-                "exchange": exchange,
-                "fxRate": fx_rate,
-                "quantity": Decimal(quantity),  # Ensuring it's a Decimal
-                "cost": cost,
-                "tradeMoney": trade_money,
-                "proceeds": proceeds,
-                "orderTime": order_time,
-                "netCash": net_cash,
-                "closePrice": close_price,
-                "fifoPnlRealized": fifo_pnl_realized,
-                "mtmPnl": mtm_pnl,
-                "ibCommission": ib_commission,
-                "settleDateTarget": settle_date_target
-            }
+            opens[tid] = OpeningTrade(el)
         except Exception as e:
-            print(f"[ERROR] Failed to process opening trade with transactionID={tid}: {e}")
+            log.error(f"[ERROR] Failed to process opening trade with transactionID={tid}: {e}")
 
     return opens
 
-def process_closing_trades(elements, opens, convert_date=False):
-    results = []
-    i = 0
-    while i < len(elements):
-        el = elements[i]
-        
-        # Skip non-Trade elements or non-closing trades
-        if el.tag != "Trade" or el.get("levelOfDetail") != "EXECUTION" or el.get("openCloseIndicator") != "C":
-            i += 1
+def add_fifo_openings(opens, engine):
+    """
+    Add to opens the executions that opened lots in the FIFO replay but were
+    not indexed by index_opening_trades() (openCloseIndicator "C;O" or
+    missing): the rebuilt lots refer to them and, unlike IBKR's <Lot>
+    records, carry no fifoPnlRealized to approximate the opening from.
+    """
+    for tid, trade in engine.openings.items():
+        if tid and tid not in opens:
+            try:
+                opens[tid] = OpeningTrade(trade)
+            except Exception as e:
+                log.error(f"[ERROR] Failed to process opening trade with transactionID={tid}: {e}")
+
+def closing_lot_keys(record):
+    """
+    The keys identifying the closing execution a <Trade> or <Lot> belongs to,
+    most specific first: ibExecID, then ibOrderID + dateTime.
+    """
+    keys = []
+    account = record.get("accountId")
+    exec_id = record.get("ibExecID")
+    if exec_id:
+        keys.append((account, exec_id))
+    order_id = record.get("ibOrderID")
+    if order_id:
+        keys.append((account, order_id, record.get("dateTime")))
+    return keys
+
+def is_closing_trade(el):
+    return el.tag == "Trade" and el.get("levelOfDetail") == "EXECUTION" and el.get("openCloseIndicator") == "C"
+
+def match_closing_lots(elements):
+    """
+    Pair every closing execution with its <Lot> records.
+    Returns a list of (trade, lots) tuples in the order of the trades.
+
+    The lots are looked up by closing_lot_keys() in a dict (O(1) per lot), so
+    they don't have to follow their trade. The lots directly following the
+    trade are used as a fallback when no key matches, or when the key is shared
+    by several closing executions (e.g. the same trade in overlapping files).
+    """
+    lots_by_key = defaultdict(list)
+    following = defaultdict(list)   # index of the <Trade> -> the <Lot>s right after it
+    closing = []
+    trades_per_key = defaultdict(int)
+
+    trade_index = None
+    for i, el in enumerate(elements):
+        if el.tag == "Lot":
+            following[trade_index].append(el)
+            for key in closing_lot_keys(el):
+                lots_by_key[key].append(el)
             continue
+        trade_index = i
+        if is_closing_trade(el):
+            keys = closing_lot_keys(el)
+            closing.append((i, el, keys))
+            for key in keys:
+                trades_per_key[key] += 1
+
+    pairs = []
+    for i, el, keys in closing:
+        lots = following.get(i, [])
+        for key in keys:
+            if trades_per_key[key] == 1 and key in lots_by_key:
+                lots = lots_by_key[key]
+                break
+        pairs.append((el, lots))
+    return pairs
 
-        # Validate asset category (NEW CODE)
-        asset_category = el.get("assetCategory")
-        if asset_category not in ASSET_CATS:
-            if asset_category not in ASSET_CATS_IGNORE:
-                print(f"WARNING: Unexpected assetCategory \"{asset_category}\" in closing trade: ", 
-                      ET.tostring(el, encoding="unicode"))
-            i += 1
+# Closing trades are computed by a pool of worker processes (--jobs) only when
+# there are at least this many; for fewer, starting the pool costs more
+MIN_PARALLEL_CLOSING_TRADES = 2000
+
+def process_closing_trades(elements, opens, convert_date=False, state=None, fifo=None, jobs=1):
+    """
+    The Realized Trades rows of all closing trades, one per closing lot. With
+    an ExportState (incremental runs) the rows of a closing trade whose trade,
+    lots and opening trades didn't change are taken from the previous run.
+
+    With a replayed FifoLotEngine, closing trades without <Lot> records use
+    the rebuilt FIFO lots, and the <Lot> records of the others are checked
+    against them.
+
+    With jobs != 1 (None = one per CPU) many closing trades are computed in
+    parallel, see process_closing_trades_parallel().
+    """
+    results = []
+    pairs = match_closing_lots(elements)
+    if fifo is not None:
+        pairs = apply_fifo_lots(pairs, fifo)
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs > 1 and len(pairs) >= MIN_PARALLEL_CLOSING_TRADES:
+        return process_closing_trades_parallel(pairs, opens, convert_date, state, jobs)
+
+    for el, lots in pairs:
+        if state is None:
+            results.extend(closing_trade_rows(el, lots, opens, convert_date))
             continue
+        results.extend(state.rows("closing trades", closing_trade_inputs(el, lots, opens),
+                                  lambda: closing_trade_rows(el, lots, opens, convert_date)))
+    return results
 
-        close_bs = el.get("buySell")
-        symbol = el.get("symbol")
-        close_date = el.get("tradeDate")
-        date_close_fmt = format_date(close_date)
-        close_dateTime = el.get("dateTime")
-
-        if close_date == close_dateTime:
-            print(f"WARNING: CHECK YOUR FLEX QUERY DATE SETTINGS! dateTime contains only a date (in process_closing_trades)! close_dateTime = \"{close_dateTime}\" close_date = \"{close_date}\"")
-
-        if not is_valid_timestamp(close_dateTime):
-            print(f"WARNING: CHECK YOUR FLEX QUERY DATE SETTINGS! The dateTime format is unexpected (in process_closing_trades)! close_dateTime = \"{close_dateTime}\"")
-
-        if close_dateTime:
-            if close_dateTime.split(";")[0] != close_date:
-                print(f"WARNING: dateTime does not match (in process_closing_trades)! close_dateTime = \"{close_dateTime}\" close_date = \"{close_date}\"")
-
-        close_price = Decimal(el.get("tradePrice"))
-        close_qty = abs(Decimal(el.get("quantity")))
-        close_currency = el.get("currency")
-        fx_close = Decimal(el.get("fxRateToBase", "1"))
-        pos_type = "LONG" if close_bs == "SELL" else "SHORT"
-
-        print_descr = el.get("description")
-        print(f"[debug] Found closing trade: {symbol} \"{print_descr}\" date_close_fmt={date_close_fmt} qty={close_qty}")
-
-        lots = []
-        j = i + 1
-        while j < len(elements) and elements[j].tag == "Lot":
-            lots.append(elements[j])
-            j += 1
-
-        if not lots:
-            print(f"[ERROR]    No <Lot> found for closing trade {symbol} \"{print_descr}\" on {date_close_fmt}. Get another FlexQuery with enabled \"Closed Lots\" subsection at the \"Trades\" section and try again.")
-
-        for lot in lots:
-            lot_close_date=lot.get("tradeDate")
-            if lot_close_date:
-                if lot_close_date != close_date:
-                    print("WARNING: tradeDate do not match (closing lot)!")
-            else:
-                print("WARNING: tradeDate is missing (closing lot).")
+def closing_trade_inputs(el, lots, opens):
+    """The records the rows of a closing trade are computed from (the key of the trade in an ExportState)."""
+    return (el.values, [lot.values for lot in lots],
+            [op.record.values if (op := opens.get(lot.get("transactionID"))) else None for lot in lots])
 
-            # fallback
-            close_dateTime_final = close_dateTime
+def process_closing_trades_parallel(pairs, opens, convert_date, state, jobs):
+    """
+    Same as process_closing_trades(), with the closing trades partitioned by
+    symbol (ISIN) and computed by a pool of jobs worker processes. Each task
+    is a list of whole symbols and carries only their closing trades, lots
+    and opening trades; the currency rate files already read (see
+    preload_currency_rates()) are handed to every worker once, when it starts.
+
+    The messages logged by the workers are sent back with the rows and logged
+    here in the order of the trades, so the rows and the output are the same
+    as when computed one by one. Repeated warnings are only counted by the
+    workers (and merged here), unless every one of them is needed: for
+    --dump-warnings and to store them in the ExportState.
+    """
+    entries = [None] * len(pairs)  # (rows, recorded messages) per closing trade
+    keys = [None] * len(pairs)
+    by_symbol = defaultdict(list)
+    for i, (el, lots) in enumerate(pairs):
+        if state is not None:
+            keys[i] = state.key(closing_trade_inputs(el, lots, opens))
+            entries[i] = state.previous("closing trades", keys[i])
+            if entries[i] is not None:
+                continue
+        by_symbol[el.get("isin") or el.get("symbol")].append(i)
+    reused = [entry is not None for entry in entries]
+
+    # A few tasks per worker, each with whole symbols, the largest symbols first
+    tasks = [[] for _ in range(min(jobs * 4, len(by_symbol)))]
+    for indexes in sorted(by_symbol.values(), key=len, reverse=True):
+        min(tasks, key=len).extend(indexes)
+    tasks = [sorted(task) for task in tasks]
+    # The slice of the records each task needs: its pairs and the opening trades of their lots
+    task_args = []
+    for task in tasks:
+        task_opens = {}
+        for i in task:
+            for lot in pairs[i][1]:
+                tid = lot.get("transactionID")
+                if tid in opens:
+                    task_opens[tid] = opens[tid]
+        task_args.append((task, [pairs[i] for i in task], task_opens, convert_date))
+
+    exits = {}
+    if tasks:
+        rate_files = set()
+        for task in tasks:
+            for i in task:
+                el, lots = pairs[i]
+                rate_files.add((el.get("currency", ""), el.get("tradeDate", "")[:4]))
+                for lot in lots:
+                    if op := opens.get(lot.get("transactionID")):
+                        rate_files.add((op.currency or "", (op.trade_date or "")[:4]))
+        preload_currency_rates(sorted(rate_files))
+
+        record_warnings = state is not None or warning_summary.dump
+        log.debug("[debug] Computing %s closing trades of %s symbols in %s processes", sum(map(len, tasks)), len(by_symbol), jobs)
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(log.getEffectiveLevel(), (currency_rate_files, currency_rates, missing_currency_rates_deferred()),
+                                           record_warnings)) as executor:
+            for fields, task_entries, (counts, samples), missing in executor.map(_closing_trade_entries, task_args):
+                warning_summary.merge(counts, samples)
+                missing_currency_rates.update(missing)
+                for i, (rows, messages), exit_code in task_entries:
+                    entries[i] = ([dict(zip(fields, values)) for values in rows], messages)
+                    if exit_code is not None:
+                        exits[i] = exit_code
 
-            lot_close_dateTime = lot.get("dateTime")
-            if lot_close_dateTime:
-                if lot_close_dateTime != close_dateTime:
-                    print("WARNING: dateTime do not match (closing lot)!")
-                close_dateTime_final = lot_close_dateTime
-            else:
-                print("WARNING: dateTime is missing (closing lot).")
-
-            date_close_fmt = format_date(close_dateTime_final)
-
-            orig_close, sofia_close = convert_to_sofia_date(close_dateTime_final)
-                            
-            if not orig_close or not sofia_close:
-                print(f"WARNING:   Close date timezone shift can't be computed. Context: {symbol} \"{print_descr}\" date_close_fmt={date_close_fmt} close_qty={close_qty}")
-            if orig_close != sofia_close:
-                print(f"WARNING:   Close date changes in Sofia timezone: {orig_close} → {sofia_close} Context: {symbol} \"{print_descr}\" date_close_fmt={date_close_fmt} close_qty={close_qty}")
-                if convert_date:
-                    print(f"           Calculations will be made with the date {sofia_close} (according to the Sofia time zone).")
-                    date_close_fmt = sofia_close
-            else:
-                print(f"[debug]:      No CLOSE date changes because of time zones. Context: {symbol} \"{print_descr}\" date_close_fmt={date_close_fmt} close_qty={close_qty}")
-
-            lot_qty = Decimal(lot.get("quantity"))
-            open_tid = lot.get("transactionID")
-            op = opens.get(open_tid)
-
-            gross_close = (close_price * lot_qty).quantize(Decimal("0.01"))
-            rate_close = look_for_currency_rate(close_currency, date_close_fmt)
-
-            open_date_fmt = None
-
-            currency_code = None
-
-            if op:
-                approx_open = False
-                open_price = op["price"]
-                open_currency = op["currency"]
-                open_date = op["tradeDate"]
-                open_dateTime = op["dateTime"] # precise date and time
-                if open_dateTime:
-                    if open_dateTime.split(";")[0] != open_date:
-                        print("WARNING: dateTime do not match (open lot)!")
-                currency_code = open_currency
-                gross_open = (open_price * lot_qty).quantize(Decimal("0.01"))
-            else:
-                approx_open = True
-                print("DEBUG: if not op")
-                realized_pnl_base = Decimal(lot.get("fifoPnlRealized") or lot.get("realizedPnL") or "0")
-                print("DEBUG: realized_pnl_base:", realized_pnl_base)
+    results = []
+    for i, entry in enumerate(entries):
+        replay_messages(log, entry[1], warning_summary)
+        if i in exits:
+            # look_for_currency_rate() stopped the worker, e.g. a rate is missing
+            sys.exit(exits[i])
+        if state is not None:
+            state.keep("closing trades", keys[i], entry, reused[i])
+        results.extend(entry[0])
+    return results
 
-                fx_to_base = fx_close if fx_close != 0 else Decimal("1")
-                print("DEBUG: fx_to_base:", fx_to_base)
-                realized_pnl_local = (realized_pnl_base / fx_to_base).quantize(Decimal("0.01"))
-                print("DEBUG: realized_pnl_local:", realized_pnl_local)
+# Whether the worker process records every repeated warning (see _init_worker())
+_worker = {}
 
-                if pos_type == "LONG":
-                    gross_open = (gross_close - realized_pnl_local).quantize(Decimal("0.01"))
-                else:
-                    gross_open = (gross_close + realized_pnl_local).quantize(Decimal("0.01"))
+def _init_worker(level, rates, record_warnings):
+    """
+    Worker process (closing trades or accounts): log nothing directly (the
+    messages are sent back), use the rate files and rates already looked up
+    (rates), defer missing rates like the main process and remember whether
+    the repeated warnings are recorded with the messages.
+    """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.setLevel(level)
+    warning_summary.dump = False
+    rate_files, known_rates, deferred = rates
+    currency_rate_files.update(rate_files)
+    currency_rates.update(known_rates)
+    defer_missing_currency_rates(deferred)
+    _worker.update(record_warnings=record_warnings)
+
+def _closing_trade_entries(task_args):
+    """
+    Worker process: the column names of the rows, (index, (rows, recorded
+    messages), exit code or None) for every closing trade of the task (its
+    indexes into all pairs, its pairs and the opening trades of their lots)
+    with the rows as tuples of values (smaller to send back than dicts), the
+    counts and samples of the repeated warnings that were not recorded and
+    the currency rates found missing (see defer_missing_currency_rates()).
+    """
+    task, pairs, opens, convert_date = task_args
+    warnings = warning_summary if _worker["record_warnings"] else None
+    level = logging.getLogger().getEffectiveLevel()
+    warning_summary.clear()
+
+    fields = ()
+    entries = []
+    for i, (el, lots) in zip(task, pairs):
+        exit_code = None
+        rows = []
+        with recording_messages(log, warnings, level) as messages:
+            try:
+                rows = closing_trade_rows(el, lots, opens, convert_date)
+            except SystemExit as e:
+                exit_code = e.code
+        if rows and not fields:
+            fields = tuple(rows[0])
+        entries.append((i, ([tuple(row.values()) for row in rows], messages), exit_code))
+        if exit_code is not None:
+            break
+    if warnings is not None:
+        # Recorded with the messages, counted when they are replayed
+        return fields, entries, ({}, {}), dict(missing_currency_rates)
+    return fields, entries, (warning_summary.counts, dict(warning_summary.samples)), dict(missing_currency_rates)
+
+def apply_fifo_lots(pairs, fifo):
+    """
+    Fill in the rebuilt lots for the closing trades without <Lot> records and
+    compare the <Lot> records of the others with them. Returns the new pairs.
+    The closing trades FIFO found no open lots for at all are reported here
+    and left out: they have no lots (no rows), and closing_trade_rows() would
+    report them again.
+    """
+    checked = differ = filled = 0
+    result = []
+    for el, lots in pairs:
+        fifo_lots = fifo.lots.get(el, [])
+        symbol = el.get("symbol")
+        if lots:
+            if el.get("assetCategory") in ASSET_CATS:
+                checked += 1
+                if lot_signature(lots) != lot_signature(fifo_lots):
+                    differ += 1
+                    warning_summary.warn("FIFO lots differ from the <Lot> records", symbol,
+                                         "WARNING: FIFO lots differ from the <Lot> records of closing trade %s on %s: <Lot> %s, FIFO %s",
+                                         symbol, el.get("dateTime"), lot_signature(lots), lot_signature(fifo_lots))
+        elif fifo_lots or el in fifo.unmatched:
+            if el in fifo.unmatched:
+                log.error(f"[ERROR]    FIFO lots: no opening trade found for {fifo.unmatched[el]} of closing trade {symbol} \"{el.get('description')}\" on {format_date(el.get('tradeDate'))}. "
+                          "Load the Flex Queries of the years in which the position was opened.")
+                if not fifo_lots:
+                    continue
+            filled += 1
+            lots = fifo_lots
+        result.append((el, lots))
+    log.info(f"FIFO lots: {checked} closing trades checked against their <Lot> records ({differ} differ), lots rebuilt for {filled} closing trades without <Lot>")
+    return result
+
+def closing_trade_rows(el, lots, opens, convert_date=False):
+    """The Realized Trades rows of one closing trade: one per closing lot."""
+    # Validate asset category (NEW CODE)
+    asset_category = el.get("assetCategory")
+    if asset_category not in ASSET_CATS:
+        if asset_category not in ASSET_CATS_IGNORE:
+            warning_summary.warn("Unexpected assetCategory", asset_category,
+                                 "WARNING: Unexpected assetCategory \"%s\" in closing trade: %s", asset_category, el)
+        return []
+
+    rows = []
+    close_bs = el.get("buySell")
+    symbol = el.get("symbol")
+    close_date = el.get("tradeDate")
+    date_close_fmt = format_date(close_date)
+    close_dateTime = el.get("dateTime")
+
+    if close_date == close_dateTime:
+        warning_summary.warn("dateTime contains only a date (closing trade)", symbol,
+                             "WARNING: CHECK YOUR FLEX QUERY DATE SETTINGS! dateTime contains only a date (in process_closing_trades)! close_dateTime = \"%s\" close_date = \"%s\"", close_dateTime, close_date)
+
+    if not is_valid_timestamp(close_dateTime):
+        warning_summary.warn("Unexpected dateTime format (closing trade)", symbol,
+                             "WARNING: CHECK YOUR FLEX QUERY DATE SETTINGS! The dateTime format is unexpected (in process_closing_trades)! close_dateTime = \"%s\"", close_dateTime)
+
+    if close_dateTime:
+        if close_dateTime.split(";")[0] != close_date:
+            warning_summary.warn("dateTime does not match tradeDate (closing trade)", symbol,
+                                 "WARNING: dateTime does not match (in process_closing_trades)! close_dateTime = \"%s\" close_date = \"%s\"", close_dateTime, close_date)
+
+    close_price = Decimal(el.get("tradePrice"))
+    close_qty = abs(Decimal(el.get("quantity")))
+    close_currency = el.get("currency")
+    fx_close = Decimal(el.get("fxRateToBase", "1"))
+    pos_type = "LONG" if close_bs == "SELL" else "SHORT"
+
+    print_descr = el.get("description")
+    log.debug("[debug] Found closing trade: %s \"%s\" date_close_fmt=%s qty=%s", symbol, print_descr, date_close_fmt, close_qty)
+
+    if not lots:
+        log.error(f"[ERROR]    No <Lot> found for closing trade {symbol} \"{print_descr}\" on {date_close_fmt}. Get another FlexQuery with enabled \"Closed Lots\" subsection at the \"Trades\" section and try again.")
+
+    for lot in lots:
+        lot_close_date=lot.get("tradeDate")
+        if lot_close_date:
+            if lot_close_date != close_date:
+                warning_summary.warn("tradeDate does not match (closing lot)", symbol,
+                                     "WARNING: tradeDate do not match (closing lot)! %s", lot)
+        else:
+            warning_summary.warn("tradeDate is missing (closing lot)", symbol,
+                                 "WARNING: tradeDate is missing (closing lot). %s", lot)
+
+        # fallback
+        close_dateTime_final = close_dateTime
+
+        lot_close_dateTime = lot.get("dateTime")
+        if lot_close_dateTime:
+            if lot_close_dateTime != close_dateTime:
+                warning_summary.warn("dateTime does not match (closing lot)", symbol,
+                                     "WARNING: dateTime do not match (closing lot)! %s", lot)
+            close_dateTime_final = lot_close_dateTime
+        else:
+            warning_summary.warn("dateTime is missing (closing lot)", symbol,
+                                 "WARNING: dateTime is missing (closing lot). %s", lot)
+
+        date_close_fmt = format_date(close_dateTime_final)
+
+        orig_close, sofia_close = convert_to_sofia_date(close_dateTime_final)
+                        
+        if not orig_close or not sofia_close:
+            warning_summary.warn("Close date timezone shift can't be computed", symbol,
+                                 "WARNING:   Close date timezone shift can't be computed. Context: %s \"%s\" date_close_fmt=%s close_qty=%s", symbol, print_descr, date_close_fmt, close_qty)
+        if orig_close != sofia_close:
+            warning_summary.warn("Close date changes in Sofia timezone", symbol,
+                                 "WARNING:   Close date changes in Sofia timezone: %s → %s Context: %s \"%s\" date_close_fmt=%s close_qty=%s%s",
+                                 orig_close, sofia_close, symbol, print_descr, date_close_fmt, close_qty,
+                                 f"\n           Calculations will be made with the date {sofia_close} (according to the Sofia time zone)." if convert_date else "")
+            if convert_date:
+                date_close_fmt = sofia_close
+        else:
+            log.log(TRACE, "[debug]:      No CLOSE date changes because of time zones. Context: %s \"%s\" date_close_fmt=%s close_qty=%s", symbol, print_descr, date_close_fmt, close_qty)
+
+        lot_qty = Decimal(lot.get("quantity"))
+        open_tid = lot.get("transactionID")
+        op = opens.get(open_tid)
+
+        gross_close = (close_price * lot_qty).quantize(Decimal("0.01"))
+        rate_close = look_for_currency_rate(close_currency, date_close_fmt)
+
+        open_date_fmt = None
+
+        currency_code = None
+
+        if op:
+            approx_open = False
+            open_price = op.price
+            open_currency = op.currency
+            open_date = op.trade_date
+            open_dateTime = op.date_time # precise date and time
+            if open_dateTime:
+                if open_dateTime.split(";")[0] != open_date:
+                    warning_summary.warn("dateTime does not match tradeDate (opening trade)", symbol,
+                                         "WARNING: dateTime do not match (open lot)! %s", op.record)
+            currency_code = open_currency
+            gross_open = (open_price * lot_qty).quantize(Decimal("0.01"))
+        else:
+            approx_open = True
+            log.log(TRACE, "DEBUG: if not op")
+            realized_pnl_base = Decimal(lot.get("fifoPnlRealized") or lot.get("realizedPnL") or "0")
+            log.log(TRACE, "DEBUG: realized_pnl_base: %s", realized_pnl_base)
 
-                print("DEBUG: gross_open:", gross_open)
-                open_price = None
+            fx_to_base = fx_close if fx_close != 0 else Decimal("1")
+            log.log(TRACE, "DEBUG: fx_to_base: %s", fx_to_base)
+            realized_pnl_local = (realized_pnl_base / fx_to_base).quantize(Decimal("0.01"))
+            log.log(TRACE, "DEBUG: realized_pnl_local: %s", realized_pnl_local)
 
-                open_dateTime = lot.get("openDateTime")  # Example: '20240702;113930 EDT'
-                if not open_dateTime:
-                    print("ERROR: open_dateTime can't be determined!")
+            if pos_type == "LONG":
+                gross_open = (gross_close - realized_pnl_local).quantize(Decimal("0.01"))
+            else:
+                gross_open = (gross_close + realized_pnl_local).quantize(Decimal("0.01"))
 
-                currency_code = close_currency
+            log.log(TRACE, "DEBUG: gross_open: %s", gross_open)
+            open_price = None
 
+            open_dateTime = lot.get("openDateTime")  # Example: '20240702;113930 EDT'
             if not open_dateTime:
-                print("ERROR: open_dateTime varialbe is not set!")
+                log.error("ERROR: open_dateTime can't be determined!")
 
-            open_date_fmt = format_date(open_dateTime) # simple formatting, without converting date
-            
-            orig_open, sofia_open = convert_to_sofia_date(open_dateTime)
-            if not orig_open or not sofia_open:
-                print(f"WARNING:   Open date timezone shift can't be computed. Context: {symbol} \"{print_descr}\" open_date_fmt: {open_date_fmt}")
-            if orig_open != sofia_open:
-                print(f"WARNING:   Open date changes in Sofia timezone: {orig_open} → {sofia_open} Context: {symbol} \"{print_descr}\" open_date_fmt: {open_date_fmt}")
-                if convert_date:
-                    print(f"           Calculations will be made with the date {sofia_open} (according to the Sofia time zone).")
-                    open_date_fmt = sofia_open
-            else:
-                print(f"[debug]:      No OPEN date changes because of time zones. Context: {symbol} \"{print_descr}\" open_date_fmt: {open_date_fmt}")
+            currency_code = close_currency
 
-            rate_open = look_for_currency_rate(currency_code, open_date_fmt)
+        if not open_dateTime:
+            log.error("ERROR: open_dateTime varialbe is not set!")
 
-            # Determine BuyCurrency and SellCurrency
-            if pos_type == "LONG":
-                buy_currency = op["currency"] if op else close_currency
-                sell_currency = close_currency
-                buy_rate = rate_open
-                sell_rate = rate_close
-            else:
-                buy_currency = close_currency
-                sell_currency = op["currency"] if op else close_currency
-                buy_rate = rate_close
-                sell_rate = rate_open
+        open_date_fmt = format_date(open_dateTime) # simple formatting, without converting date
+        
+        orig_open, sofia_open = convert_to_sofia_date(open_dateTime)
+        if not orig_open or not sofia_open:
+            warning_summary.warn("Open date timezone shift can't be computed", symbol,
+                                 "WARNING:   Open date timezone shift can't be computed. Context: %s \"%s\" open_date_fmt: %s", symbol, print_descr, open_date_fmt)
+        if orig_open != sofia_open:
+            warning_summary.warn("Open date changes in Sofia timezone", symbol,
+                                 "WARNING:   Open date changes in Sofia timezone: %s → %s Context: %s \"%s\" open_date_fmt: %s%s",
+                                 orig_open, sofia_open, symbol, print_descr, open_date_fmt,
+                                 f"\n           Calculations will be made with the date {sofia_open} (according to the Sofia time zone)." if convert_date else "")
+            if convert_date:
+                open_date_fmt = sofia_open
+        else:
+            log.log(TRACE, "[debug]:      No OPEN date changes because of time zones. Context: %s \"%s\" open_date_fmt: %s", symbol, print_descr, open_date_fmt)
 
-            # Compute BGN values (precisely first, then round to 0.01)
-            if pos_type == "LONG":
-                buy_bgn = gross_open * buy_rate
-                sell_bgn = gross_close * sell_rate
-            else:
-                sell_bgn = gross_open * sell_rate
-                buy_bgn = gross_close * buy_rate
-
-            # Round the computed gross values to 0.01
-            buy_bgn = buy_bgn.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-            sell_bgn = sell_bgn.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-
-            profit_bgn = None
-            loss_bgn = None
-            pl = (sell_bgn - buy_bgn).quantize(Decimal("0.01"))
-            if pl >= 0:
-                profit_bgn = pl
-            else:
-                loss_bgn = -pl
+        rate_open = look_for_currency_rate(currency_code, open_date_fmt)
 
-            description = el.get("description") if pos_type == "LONG" else op.get("description", "") if op else ""
-            
-            print(f"[debug]    Adding trade_data about closing trade: {symbol} \"{description}\" date_close_fmt={date_close_fmt} close_qty={close_qty} lot_qty={lot_qty}")
-          
-            trade_data = {
-                "PositionType": pos_type,
-                "Approximation": "Yes" if approx_open else "",
-                "OpenDate": open_date_fmt,
-                "CloseDate": date_close_fmt,
-                "BuyCurrency": buy_currency,
-                "SellCurrency": sell_currency,
-                "BuyCurrencyRate": str(buy_rate),
-                "SellCurrencyRate": str(sell_rate),
-                "Quantity": f"{lot_qty}",
-                "OpenPricePerShare": f"{open_price}" if open_price else "",
-                "ClosePricePerShare": f"{close_price}",
-                "OpenGrossTotal": f"{gross_open}",
-                "CloseGrossTotal": f"{gross_close}",
-                "BuyGrossBGN": f"{buy_bgn}",
-                "SellGrossBGN": f"{sell_bgn}",
-                "ProfitBGN": f"{profit_bgn}" if profit_bgn else "",
-                "LossBGN": f"{loss_bgn}" if loss_bgn else "",
-                "assetCategory": el.get("assetCategory") if pos_type == "LONG" else op.get("assetCategory", "") if op else "",
-                "subCategory": el.get("subCategory") if pos_type == "LONG" else op.get("subCategory", "") if op else "",
-                "symbol": el.get("symbol") if pos_type == "LONG" else op.get("symbol", "") if op else "",
-                "description": description,
-                "isin": el.get("isin") if pos_type == "LONG" else op.get("isin", "") if op else "",
-                "exchange": el.get("exchange") if pos_type == "LONG" else op.get("exchange", "") if op else ""
-            }
-
-            results.append(trade_data)
-        i = j
-    return results
+        # Determine BuyCurrency and SellCurrency
+        if pos_type == "LONG":
+            buy_currency = op.currency if op else close_currency
+            sell_currency = close_currency
+            buy_rate = rate_open
+            sell_rate = rate_close
+        else:
+            buy_currency = close_currency
+            sell_currency = op.currency if op else close_currency
+            buy_rate = rate_close
+            sell_rate = rate_open
+
+        # Compute BGN values (precisely first, then round to 0.01)
+        if pos_type == "LONG":
+            buy_bgn = gross_open * buy_rate
+            sell_bgn = gross_close * sell_rate
+        else:
+            sell_bgn = gross_open * sell_rate
+            buy_bgn = gross_close * buy_rate
+
+        # Round the computed gross values to 0.01
+        buy_bgn = buy_bgn.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+        sell_bgn = sell_bgn.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+        profit_bgn = None
+        loss_bgn = None
+        pl = (sell_bgn - buy_bgn).quantize(Decimal("0.01"))
+        if pl >= 0:
+            profit_bgn = pl
+        else:
+            loss_bgn = -pl
+
+        description = el.get("description") if pos_type == "LONG" else op.get("description", "") if op else ""
+        
+        log.log(TRACE, "[debug]    Adding trade_data about closing trade: %s \"%s\" date_close_fmt=%s close_qty=%s lot_qty=%s", symbol, description, date_close_fmt, close_qty, lot_qty)
+      
+        trade_data = {
+            "PositionType": pos_type,
+            "Approximation": "Yes" if approx_open else "",
+            "OpenDate": open_date_fmt,
+            "CloseDate": date_close_fmt,
+            "BuyCurrency": buy_currency,
+            "SellCurrency": sell_currency,
+            "BuyCurrencyRate": str(buy_rate),
+            "SellCurrencyRate": str(sell_rate),
+            "Quantity": f"{lot_qty}",
+            "OpenPricePerShare": f"{open_price}" if open_price else "",
+            "ClosePricePerShare": f"{close_price}",
+            "OpenGrossTotal": f"{gross_open}",
+            "CloseGrossTotal": f"{gross_close}",
+            "BuyGrossBGN": f"{buy_bgn}",
+            "SellGrossBGN": f"{sell_bgn}",
+            "ProfitBGN": f"{profit_bgn}" if profit_bgn else "",
+            "LossBGN": f"{loss_bgn}" if loss_bgn else "",
+            "assetCategory": el.get("assetCategory") if pos_type == "LONG" else op.get("assetCategory", "") if op else "",
+            "subCategory": el.get("subCategory") if pos_type == "LONG" else op.get("subCategory", "") if op else "",
+            "symbol": el.get("symbol") if pos_type == "LONG" else op.get("symbol", "") if op else "",
+            "description": description,
+            "isin": el.get("isin") if pos_type == "LONG" else op.get("isin", "") if op else "",
+            "exchange": el.get("exchange") if pos_type == "LONG" else op.get("exchange", "") if op else ""
+        }
+
+        rows.append(trade_data)
+    return rows
   
 def decimal_default(obj):
     if isinstance(obj, Decimal):
@@ -377,140 +619,216 @@ def decimal_default(obj):
    
 
 def collect_open_positions(flex_files, opens, convert_date=False):
+    return process_open_positions(collect_flex_data(sorted(flex_files)), opens, convert_date)
+
+def process_open_positions(data: FlexData, opens, convert_date=False):
 
     open_positions = []
 
+    # Collect all trades into map by originatingTransactionID
     trades_by_txn = {}
-    for file in flex_files:
-        if file.stat().st_size == 0:
-            print(f"[warning] Skipping empty file: {file}")
-            continue
+    for t in data.all_trades:
+        txn_id = t.get("transactionID") # not originatingTransactionID!
+        if txn_id:
+            trades_by_txn[txn_id] = t.attrib
 
-        try:
-            tree = etree.parse(str(file))
-        except etree.XMLSyntaxError as e:
-            print(f"[warning] Skipping malformed XML file: {file} - {e}")
+    for pos, to_date in data.open_positions:
+        if pos.get("side") != "Long" or pos.get("levelOfDetail") != "LOT" or pos.get("assetCategory") not in OPEN_POSITION_CATS:
             continue
 
-        print(f"[debug] Processing XML file at collect_open_positions(): {file}")
-
-        to_date_match = re.search(r'toDate="(\d{8})"', open(file, 'r').read())
-        to_date = to_date_match.group(1) if to_date_match else ""
-        to_date_formatted = format_date(to_date) if to_date else ""
-
-        # Collect all trades into map by originatingTransactionID
-        for t in tree.xpath("//Trade"):
-            txn_id = t.get("transactionID") # not originatingTransactionID!
-            if txn_id:
-                trades_by_txn[txn_id] = t.attrib
-
-        for pos in tree.xpath("//OpenPosition[@side='Long'][@levelOfDetail='LOT'][@assetCategory='STK' or @assetCategory='FUND']"):
-            isin = pos.get("isin")
-            symbol = pos.get("symbol")
-            position = Decimal(pos.get("position"))
-            country = pos.get("issuerCountryCode")
-            open_datetime = pos.get("openDateTime")
-            originating_txn_id = pos.get("originatingTransactionID")
-            currency = pos.get("currency")
-            description = pos.get("description", "")
-
-            if not is_valid_timestamp(open_datetime):
-                print(f"WARNING: CHECK YOUR FLEX QUERY DATE SETTINGS! openDateTime format is unexpected (in collect_open_positions)! open_datetime = \"{open_datetime}\"")
-
-            approx_flag = ""
-            price_in_currency = ""
-            date_formatted = ""
-            currency_output = ""
-            price_bgn = ""
-
-            print(f"[debug] Looking for trade {originating_txn_id}...")
-            trade = trades_by_txn.get(originating_txn_id)
-
-            if trade:
-                qty_str = trade.get("quantity")
-                if qty_str is None:
-                    print(f"[ERROR] Missing 'quantity' attribute in OpenPosition: {json.dumps(trade, indent=2, default=decimal_default)}")
-                    trade_qty = Decimal(0)
-                else:
-                    trade_qty = Decimal(qty_str)
-
-                trade_price = Decimal(trade.get("tradePrice"))
-                trade_money = Decimal(trade.get("tradeMoney"))
-                trade_currency = trade.get("currency")
-                trade_datetime = trade.get("dateTime")
-                trade_date = trade.get("tradeDate")
-                trade_isin = trade.get("isin")
-
-                gross_calc = trade_price * position
-                price_in_currency = gross_calc.quantize(Decimal("0.01"))
-
-                if abs(gross_calc - price_in_currency) > Decimal(0):
-                    print(f"[warning] Mismatch after rounding calculated gross value for {symbol} (ISIN {isin}): price_in_currency={price_in_currency}, gross_calc={gross_calc}, tradeMoney={trade_money}")
-
-                if abs(gross_calc - trade_money) > Decimal(0):
-                    print(f"[warning] (expected if partial sale) Mismatch in calculated gross value vs tradeMoney for {symbol} (ISIN {isin}): gross_calc={gross_calc}, tradeMoney={trade_money}")
-
-                if abs(position - trade_qty) > Decimal(0):
-                    print(f"[warning] (expected if partial sale) Mismatch in quantity for {symbol} (ISIN {isin}): OpenPosition={position}, Trade={trade_qty}")
-
-                if currency != trade_currency:
-                    print(f"[warning] Currency mismatch for {symbol} (ISIN {isin}): OpenPosition={currency}, Trade={trade_currency}")
-
-                if open_datetime != trade_datetime:
-                    print(f"[warning] DateTime mismatch for {symbol} (ISIN {isin}): OpenPosition={open_datetime}, Trade={trade_datetime}")
-
-                if isin != trade_isin:
-                    print(f"[warning] ISIN mismatch for {symbol}: OpenPosition={isin}, Trade={trade_isin}")
-
-                if trade_datetime:
-                    date_output = trade_datetime
-                else:
-                    date_output = trade_date
-                currency_output = trade_currency
+        isin = pos.get("isin")
+        symbol = pos.get("symbol")
+        position = Decimal(pos.get("position"))
+        country = pos.get("issuerCountryCode")
+        open_datetime = pos.get("openDateTime")
+        originating_txn_id = pos.get("originatingTransactionID")
+        currency = pos.get("currency")
+        description = pos.get("description", "")
+
+        if not is_valid_timestamp(open_datetime):
+            warning_summary.warn("Unexpected openDateTime format (open position)", symbol,
+                                 "WARNING: CHECK YOUR FLEX QUERY DATE SETTINGS! openDateTime format is unexpected (in collect_open_positions)! open_datetime = \"%s\"", open_datetime)
+
+        approx_flag = ""
+        price_in_currency = ""
+        date_formatted = ""
+        currency_output = ""
+        price_bgn = ""
+
+        log.log(TRACE, "[debug] Looking for trade %s...", originating_txn_id)
+        trade = trades_by_txn.get(originating_txn_id)
+
+        if trade:
+            qty_str = trade.get("quantity")
+            if qty_str is None:
+                log.error(f"[ERROR] Missing 'quantity' attribute in OpenPosition: {json.dumps(trade, indent=2, default=decimal_default)}")
+                trade_qty = Decimal(0)
             else:
-                # Fallback to costBasisMoney
-                print(f"[warning] No trade match for originatingTransactionID {originating_txn_id} — using fallback data for {symbol} \"{description}\" (ISIN {isin})")
-                approx_flag = "Yes"
-                price_in_currency = Decimal(pos.get("costBasisMoney")).quantize(Decimal("0.01"))
-                
-                date_output = open_datetime
-                currency_output = currency
+                trade_qty = Decimal(qty_str)
+
+            trade_price = Decimal(trade.get("tradePrice"))
+            trade_money = Decimal(trade.get("tradeMoney"))
+            trade_currency = trade.get("currency")
+            trade_datetime = trade.get("dateTime")
+            trade_date = trade.get("tradeDate")
+            trade_isin = trade.get("isin")
+
+            gross_calc = trade_price * position
+            price_in_currency = gross_calc.quantize(Decimal("0.01"))
+
+            if abs(gross_calc - price_in_currency) > Decimal(0):
+                warning_summary.warn("Gross value changes after rounding (open position)", symbol,
+                                     "[warning] Mismatch after rounding calculated gross value for %s (ISIN %s): price_in_currency=%s, gross_calc=%s, tradeMoney=%s", symbol, isin, price_in_currency, gross_calc, trade_money)
+
+            if abs(gross_calc - trade_money) > Decimal(0):
+                warning_summary.warn("Gross value != tradeMoney (expected if partial sale)", symbol,
+                                     "[warning] (expected if partial sale) Mismatch in calculated gross value vs tradeMoney for %s (ISIN %s): gross_calc=%s, tradeMoney=%s", symbol, isin, gross_calc, trade_money)
+
+            if abs(position - trade_qty) > Decimal(0):
+                warning_summary.warn("Quantity differs (expected if partial sale)", symbol,
+                                     "[warning] (expected if partial sale) Mismatch in quantity for %s (ISIN %s): OpenPosition=%s, Trade=%s", symbol, isin, position, trade_qty)
 
-            date_formatted = format_date(date_output) # simple formatting, without converting date
+            if currency != trade_currency:
+                warning_summary.warn("Currency differs from the opening trade (open position)", symbol,
+                                     "[warning] Currency mismatch for %s (ISIN %s): OpenPosition=%s, Trade=%s", symbol, isin, currency, trade_currency)
 
-            orig_date_output, sofia_date_output = convert_to_sofia_date(date_output)
+            if open_datetime != trade_datetime:
+                warning_summary.warn("dateTime differs from the opening trade (open position)", symbol,
+                                     "[warning] DateTime mismatch for %s (ISIN %s): OpenPosition=%s, Trade=%s", symbol, isin, open_datetime, trade_datetime)
 
-            if not orig_date_output or not sofia_date_output:
-                print(f"WARNING:   Open date (for Open Positions sheet) timezone shift can't be computed. Context: {symbol} \"{description}\" open_datetime={open_datetime} position={position}")
-                print(f"           orig_date_output={orig_date_output} sofia_date_output={sofia_date_output} date_output={date_output}")
-            if orig_date_output != sofia_date_output:
-                print(f"WARNING:   Open date (for Open Positions sheet) changes in Sofia timezone: {orig_date_output} → {sofia_date_output} Context: {symbol} \"{description}\" open_datetime={open_datetime} position={position}")
-                if convert_date:
-                    print(f"           Calculations will be made with the date {sofia_date_output} (according to the Sofia time zone).")
-                    date_formatted = sofia_date_output
+            if isin != trade_isin:
+                warning_summary.warn("ISIN differs from the opening trade (open position)", symbol,
+                                     "[warning] ISIN mismatch for %s: OpenPosition=%s, Trade=%s", symbol, isin, trade_isin)
+
+            if trade_datetime:
+                date_output = trade_datetime
             else:
-                print(f"[debug]:      No OPEN date (for Open Positions sheet) changes because of time zones. Context: {symbol} \"{description}\" open_datetime={open_datetime} position={position}")
-
-            currency_rate_output = Decimal(look_for_currency_rate(currency_output, date_formatted))
-            price_bgn = (currency_rate_output * Decimal(price_in_currency)).quantize(Decimal("0.01"))
-
-            open_positions.append({
-                "toDate": to_date_formatted,
-                "Approximation": approx_flag,
-                "currency": currency_output,
-                "currency rate": currency_rate_output,
-                "country": country,
-                "count": position,
-                "date": date_formatted,
-                "price_in_currency": price_in_currency,
-                "price": price_bgn,
-                "assetCategory": pos.get("assetCategory", ""),
-                "subCategory": pos.get("subCategory", ""),
-                "symbol": symbol,
-                "description": description,
-                "isin": isin
-            })
+                date_output = trade_date
+            currency_output = trade_currency
+        else:
+            # Fallback to costBasisMoney
+            warning_summary.warn("No opening trade found (open position, approximated)", symbol,
+                                 "[warning] No trade match for originatingTransactionID %s — using fallback data for %s \"%s\" (ISIN %s)", originating_txn_id, symbol, description, isin)
+            approx_flag = "Yes"
+            price_in_currency = Decimal(pos.get("costBasisMoney")).quantize(Decimal("0.01"))
+            
+            date_output = open_datetime
+            currency_output = currency
+
+        open_positions.append(open_position_row(pos, to_date, approx_flag, position, country, open_datetime,
+                                                date_output, currency_output, price_in_currency, convert_date))
+
+    return open_positions
 
+def open_position_row(record, to_date, approx_flag, position, country, open_datetime,
+                      date_output, currency_output, price_in_currency, convert_date=False):
+    """
+    The Open Positions row of a lot: record is the <OpenPosition> (or the
+    opening <Trade> of a reconstructed lot), date_output the date of the
+    opening trade used for the currency rate.
+    """
+    symbol = record.get("symbol")
+    description = record.get("description", "")
+    date_formatted = format_date(date_output) # simple formatting, without converting date
+
+    orig_date_output, sofia_date_output = convert_to_sofia_date(date_output)
+
+    if not orig_date_output or not sofia_date_output:
+        warning_summary.warn("Open date timezone shift can't be computed (open position)", symbol,
+                             "WARNING:   Open date (for Open Positions sheet) timezone shift can't be computed. Context: %s \"%s\" open_datetime=%s position=%s\n           orig_date_output=%s sofia_date_output=%s date_output=%s", symbol, description, open_datetime, position, orig_date_output, sofia_date_output, date_output)
+    if orig_date_output != sofia_date_output:
+        warning_summary.warn("Open date changes in Sofia timezone (open position)", symbol,
+                             "WARNING:   Open date (for Open Positions sheet) changes in Sofia timezone: %s → %s Context: %s \"%s\" open_datetime=%s position=%s%s",
+                             orig_date_output, sofia_date_output, symbol, description, open_datetime, position,
+                             f"\n           Calculations will be made with the date {sofia_date_output} (according to the Sofia time zone)." if convert_date else "")
+        if convert_date:
+            date_formatted = sofia_date_output
+    else:
+        log.log(TRACE, "[debug]:      No OPEN date (for Open Positions sheet) changes because of time zones. Context: %s \"%s\" open_datetime=%s position=%s", symbol, description, open_datetime, position)
+
+    currency_rate_output = Decimal(look_for_currency_rate(currency_output, date_formatted))
+    price_bgn = (currency_rate_output * Decimal(price_in_currency)).quantize(Decimal("0.01"))
+
+    return {
+        "toDate": format_date(to_date) if to_date else "",
+        "Approximation": approx_flag,
+        "currency": currency_output,
+        "currency rate": currency_rate_output,
+        "country": country,
+        "count": position,
+        "date": date_formatted,
+        "price_in_currency": price_in_currency,
+        "price": price_bgn,
+        "assetCategory": record.get("assetCategory", ""),
+        "subCategory": record.get("subCategory", ""),
+        "symbol": symbol,
+        "description": description,
+        "isin": record.get("isin")
+    }
+
+def local_module_files(directory: Path) -> List[Path]:
+    """The source files of the loaded modules that live in directory (this script and its local imports)."""
+    files = set()
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None)
+        if path and path.endswith(".py") and Path(path).resolve().parent == directory:
+            files.add(Path(path).resolve())
+    return sorted(files)
+
+def year_end_dates(years: str) -> List[str]:
+    """The 31 Decembers ("YYYY1231") of years given as "2023", "2015-2025" or "2019,2021-2023"."""
+    dates = []
+    for part in years.split(","):
+        first, _, last = part.strip().partition("-")
+        try:
+            first, last = int(first), int(last or first)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid years: \"{years}\" (expected e.g. 2024, 2015-2025 or 2019,2021-2023)")
+        if first > last:
+            raise argparse.ArgumentTypeError(f"invalid years: \"{part.strip()}\" (the first year is after the last)")
+        dates.extend(f"{year}1231" for year in range(first, last + 1))
+    return sorted(set(dates))
+
+def reconstruct_open_positions(data: FlexData, engine: FifoLotEngine, dates, convert_date=False):
+    """
+    Open Positions rows for the given dates ("YYYYMMDD") rebuilt from the
+    executions: the lots engine.replay() held at the end of each date (see
+    lot_engine). Dates for which a Flex Query with the open positions was
+    loaded are skipped, its <OpenPosition> records are used instead.
+    """
+    reported = {to_date for pos, to_date in data.open_positions if pos.get("levelOfDetail") == "LOT"}
+    skipped = [date for date in dates if date in reported]
+    if skipped:
+        log.info(f"Open positions as of {', '.join(format_date(d) for d in skipped)} are taken from the Flex Query, not reconstructed")
+    dates = [date for date in dates if date not in reported]
+    if not dates:
+        return []
+
+    # Trades don't always carry issuerCountryCode: fall back to SecurityInfo and OpenPosition records
+    countries = {}
+    for record in data.security_infos + [pos for pos, _ in data.open_positions]:
+        if record.get("isin") and record.get("issuerCountryCode"):
+            countries.setdefault(record.get("isin"), record.get("issuerCountryCode"))
+
+    for trade, quantity in engine.unmatched.items():
+        if trade.get("assetCategory") in OPEN_POSITION_CATS and execution_time(trade)[:8] <= dates[-1]:
+            symbol = trade.get("symbol")
+            warning_summary.warn("No opening trade (reconstructed positions incomplete)", symbol,
+                                 "[warning] No opening execution found for %s of %s \"%s\" sold on %s: the positions held before the loaded files are missing from the reconstructed open positions",
+                                 quantity, symbol, trade.get("description"), format_date(execution_time(trade)))
+
+    open_positions = []
+    for date in dates:
+        lots = [lot for lot in engine.holdings.get(date, ())
+                if lot.quantity > 0 and lot.trade.get("assetCategory") in OPEN_POSITION_CATS]
+        log.debug(f"[debug] Reconstructed {len(lots)} open lot(s) as of {format_date(date)}")
+        for lot in sorted(lots, key=lambda lot: (lot.trade.get("symbol") or "", execution_time(lot.trade))):
+            trade = lot.trade
+            price_in_currency = (Decimal(trade.get("tradePrice")) * lot.quantity).quantize(Decimal("0.01"))
+            country = trade.get("issuerCountryCode") or countries.get(trade.get("isin"), "")
+            open_positions.append(open_position_row(trade, date, "", lot.quantity, country, trade.get("dateTime"),
+                                                    trade.get("dateTime") or trade.get("tradeDate"), trade.get("currency"),
+                                                    price_in_currency, convert_date))
     return open_positions
 
 def process_dividends_from_xml(xml_dir: str, convert_date: bool = False) -> Tuple[List[Dict], List[Dict], List[Dict]]:
@@ -527,413 +845,444 @@ def process_dividends_from_xml(xml_dir: str, convert_date: bool = False) -> Tupl
         Tuple[List[Dict], List[Dict], List[Dict]]: Three lists of dictionaries
         for 'dividends-nap-autopilot', 'dividends-sheet', and 'dividends-table' sheets, respectively.
     """
-    securities_info_map: Dict[str, Dict] = {} # ISIN -> {'name': str, 'country': str}
-    transactions_by_action_id = defaultdict(lambda: {'dividends': [], 'taxes': [], 'raw_details': []})
-
-    all_xml_files = sorted([p for p in Path(xml_dir).iterdir() if p.suffix.lower() == '.xml'])
+    all_xml_files = flex_query_files(xml_dir)
 
     if not all_xml_files:
-        print(f"No XML files found in directory: {xml_dir}")
+        log.warning(f"No XML files found in directory: {xml_dir}")
         return [], [], []
 
-    print("\n[debug] Processing XML files for dividends and taxes...")
+    return process_dividends(collect_flex_data(all_xml_files), convert_date)
 
-    for fpath in all_xml_files:
-        print(f"[debug] Parsing {fpath.name} for dividend data...")
-        try:
-            tree = ET.parse(fpath)
-            root = tree.getroot()
-
-            # First pass: Collect SecuritiesInfo for name and country mapping
-            for sec_info in root.iter('SecurityInfo'):
-                isin = sec_info.get('isin')
-                description = sec_info.get('description')
-                issuer_country_code_sec = sec_info.get('issuerCountryCode') # Renamed to avoid conflict
-                if isin and description and issuer_country_code_sec:
-                    securities_info_map[isin] = {'name': description, 'country': issuer_country_code_sec}
-
-            # Second pass: Collect CashTransaction details
-            for transaction in root.iter('CashTransaction'):
-                if transaction.get('levelOfDetail') == 'DETAIL':
-                    action_id = transaction.get('actionID')
-                    transaction_type = transaction.get('type')
-                    amount_str = transaction.get('amount')
-
-                    if not action_id or not amount_str:
-                        continue # Skip entries without critical data
+def process_dividends(data: FlexData, convert_date: bool = False, state=None) -> Tuple[List[Dict], List[Dict], List[Dict]]:
+    """
+    Same as process_dividends_from_xml(), but works on already ingested Flex Query records.
+    With an ExportState, dividends whose transactions didn't change are taken from the previous run.
+    """
+    securities_info_map: Dict[str, Dict] = {} # ISIN -> {'name': str, 'country': str}
+    transactions_by_action_id = defaultdict(lambda: {'dividends': [], 'taxes': [], 'raw_details': []})
 
-                    try:
-                        amount = Decimal(amount_str)
-                    except InvalidOperation:
-                        print(f"Warning: Could not parse amount '{amount_str}' for actionID {action_id}. Skipping.")
-                        continue
+    log.debug("\n[debug] Processing XML files for dividends and taxes...")
 
-                    # Store the raw attributes for later common data extraction
-                    transactions_by_action_id[action_id]['raw_details'].append(transaction.attrib)
+    # Collect SecuritiesInfo for name and country mapping
+    for sec_info in data.security_infos:
+        isin = sec_info.get('isin')
+        description = sec_info.get('description')
+        issuer_country_code_sec = sec_info.get('issuerCountryCode') # Renamed to avoid conflict
+        if isin and description and issuer_country_code_sec:
+            securities_info_map[isin] = {'name': description, 'country': issuer_country_code_sec}
 
-                    if transaction_type == 'Dividends' or transaction_type == 'Payment In Lieu Of Dividends':
-                        transactions_by_action_id[action_id]['dividends'].append(amount)
-                    elif transaction_type == 'Withholding Tax':
-                        transactions_by_action_id[action_id]['taxes'].append(amount)
+    # Collect CashTransaction details
+    for transaction in data.cash_transactions:
+        if transaction.get('levelOfDetail') == 'DETAIL':
+            action_id = transaction.get('actionID')
+            transaction_type = transaction.get('type')
+            amount_str = transaction.get('amount')
 
-        except ET.ParseError as e:
-            print(f"Error parsing XML file {fpath.name}: {e}")
-            continue
-        except Exception as e:
-            print(f"An unexpected error occurred while processing {fpath.name}: {e}")
-            continue
+            if not action_id or not amount_str:
+                continue # Skip entries without critical data
+
+            try:
+                amount = Decimal(amount_str)
+            except InvalidOperation:
+                log.warning(f"Warning: Could not parse amount '{amount_str}' for actionID {action_id}. Skipping.")
+                continue
+
+            # Store the raw attributes for later common data extraction; the
+            # actionIDs are grouped per account, like the interest months
+            transactions = transactions_by_action_id[(transaction.get('accountId'), action_id)]
+            transactions['raw_details'].append(transaction.attrib)
+
+            if transaction_type == 'Dividends' or transaction_type == 'Payment In Lieu Of Dividends':
+                transactions['dividends'].append(amount)
+            elif transaction_type == 'Withholding Tax':
+                transactions['taxes'].append(amount)
 
     # Prepare data for different sheet formats
     dividends_nap_autopilot_data = []
     dividends_sheet_data = []
     dividends_table_data = []
 
-    for action_id, data in transactions_by_action_id.items():
-        total_dividend_amount = sum(data['dividends'])
-        total_tax_amount = sum(data['taxes'])
-
-        # Skip if no actual dividend (e.g., only tax correction entries)
-        # or if there are only tax entries that net to zero (pure corrections without a dividend)
-        if not data['dividends'] and not data['taxes']:
-            continue
-
-        # Find a representative detail record for common information (prefer dividend if available)
-        representative_detail = None
-        for detail in data['raw_details']:
-            if detail.get('type') == 'Dividends' or detail.get('type') == 'Payment In Lieu Of Dividends':
-                representative_detail = detail
-                break
-        if not representative_detail and data['raw_details']: # Fallback to first available detail
-            representative_detail = data['raw_details'][0]
-
-        if not representative_detail:
-            print(f"Warning: No valid detail record found for actionID {action_id}. Skipping.")
-            continue
-
-
-
-        # Extract common info
-        isin = representative_detail.get('isin', '')
-        symbol = representative_detail.get('symbol', '')
-        currency = representative_detail.get('currency', '')
-        date_time_raw = representative_detail.get('dateTime', '')
-        issuer_country_code = representative_detail.get('issuerCountryCode', '') # Use this for initial check
-
-        # Determine name and country
-        name = securities_info_map.get(isin, {}).get('name', symbol)
-        country = issuer_country_code if issuer_country_code else securities_info_map.get(isin, {}).get('country', '')
-
-
-        # --- Date Consistency Check ---
-        all_relevant_transaction_dates = set()
-
-        # Iterate through raw_details to collect dates from both dividend and tax types
-        for detail in data['raw_details']:
-            transaction_type = detail.get('type')
-            date_time = detail.get('dateTime')
-
-            if date_time:
-                # Only consider relevant types for the date consistency check
-                if transaction_type in ['Dividends', 'Payment In Lieu Of Dividends', 'Withholding Tax']:
-                    all_relevant_transaction_dates.add(date_time)
-
-        # A mismatch occurs if there's more than one unique date among all relevant transactions
-        if len(all_relevant_transaction_dates) > 1:
-            print(f"WARNING: Date mismatch for actionID {action_id}. "
-                  f"Found multiple unique dates: {', '.join(sorted(list(all_relevant_transaction_dates)))}. "
-                  f"Context: {symbol} \"{name}\"")
-        # --- END Date Consistency Check ---
-
-        dividend_date = format_date(date_time_raw) # simple formatting, without converting date
-        
-        orig_dividend_date, sofia_dividend_date = convert_to_sofia_date(date_time_raw)
-
-        if not orig_dividend_date or not sofia_dividend_date:
-            print(f"WARNING:   Dividend date timezone shift can't be computed. Context: {symbol} \"{name}\" date_time_raw: {date_time_raw}")
-        if orig_dividend_date != sofia_dividend_date:
-            print(f"WARNING:   Dividend date changes in Sofia timezone: {orig_dividend_date} → {sofia_dividend_date} Context: {symbol} \"{name}\" date_time_raw: {date_time_raw}")
-            if convert_date:
-                print(f"           Calculations will be made with the date {sofia_dividend_date} (according to the Sofia time zone).")
-                dividend_date = sofia_dividend_date
-            else:
-                dividend_date = orig_dividend_date
+    for (_, action_id), transactions in transactions_by_action_id.items():
+        if state is None:
+            rows = dividend_rows(action_id, transactions, securities_info_map, convert_date)
+        else:
+            inputs = (action_id, transactions['raw_details'],
+                      [securities_info_map.get(detail.get('isin', '')) for detail in transactions['raw_details']])
+            rows = state.rows("dividends", inputs,
+                              lambda: dividend_rows(action_id, transactions, securities_info_map, convert_date))
+        if rows:
+            nap_autopilot_row, dividends_sheet_row, dividends_table_row = rows
+            dividends_nap_autopilot_data.append(nap_autopilot_row)
+            dividends_sheet_data.append(dividends_sheet_row)
+            dividends_table_data.append(dividends_table_row)
+
+    log.debug("[debug] Finished processing dividend data. Found %s consolidated dividend events.", len(dividends_sheet_data))
+    return dividends_nap_autopilot_data, dividends_sheet_data, dividends_table_data
 
+def dividend_rows(action_id, transactions, securities_info_map, convert_date=False):
+    """
+    The dividends-nap-autopilot, dividends-sheet and dividends-table rows of
+    one dividend (the transactions of one actionID), or None if there is none.
+    """
+    total_dividend_amount = sum(transactions['dividends'])
+    total_tax_amount = sum(transactions['taxes'])
+
+    # Skip if no actual dividend (e.g., only tax correction entries)
+    # or if there are only tax entries that net to zero (pure corrections without a dividend)
+    if not transactions['dividends'] and not transactions['taxes']:
+        return None
+
+    # Find a representative detail record for common information (prefer dividend if available)
+    representative_detail = None
+    for detail in transactions['raw_details']:
+        if detail.get('type') == 'Dividends' or detail.get('type') == 'Payment In Lieu Of Dividends':
+            representative_detail = detail
+            break
+    if not representative_detail and transactions['raw_details']: # Fallback to first available detail
+        representative_detail = transactions['raw_details'][0]
+
+    if not representative_detail:
+        log.warning(f"Warning: No valid detail record found for actionID {action_id}. Skipping.")
+        return None
+
+
+
+    # Extract common info
+    isin = representative_detail.get('isin', '')
+    symbol = representative_detail.get('symbol', '')
+    currency = representative_detail.get('currency', '')
+    date_time_raw = representative_detail.get('dateTime', '')
+    issuer_country_code = representative_detail.get('issuerCountryCode', '') # Use this for initial check
+
+    # Determine name and country
+    name = securities_info_map.get(isin, {}).get('name', symbol)
+    country = issuer_country_code if issuer_country_code else securities_info_map.get(isin, {}).get('country', '')
+
+
+    # --- Date Consistency Check ---
+    all_relevant_transaction_dates = set()
+
+    # Iterate through raw_details to collect dates from both dividend and tax types
+    for detail in transactions['raw_details']:
+        transaction_type = detail.get('type')
+        date_time = detail.get('dateTime')
+
+        if date_time:
+            # Only consider relevant types for the date consistency check
+            if transaction_type in ['Dividends', 'Payment In Lieu Of Dividends', 'Withholding Tax']:
+                all_relevant_transaction_dates.add(date_time)
+
+    # A mismatch occurs if there's more than one unique date among all relevant transactions
+    if len(all_relevant_transaction_dates) > 1:
+        log.warning(f"WARNING: Date mismatch for actionID {action_id}. "
+                    f"Found multiple unique dates: {', '.join(sorted(list(all_relevant_transaction_dates)))}. "
+                    f"Context: {symbol} \"{name}\"")
+    # --- END Date Consistency Check ---
+
+    dividend_date = format_date(date_time_raw) # simple formatting, without converting date
+    
+    orig_dividend_date, sofia_dividend_date = convert_to_sofia_date(date_time_raw)
+
+    if not orig_dividend_date or not sofia_dividend_date:
+        warning_summary.warn("Dividend date timezone shift can't be computed", symbol,
+                             "WARNING:   Dividend date timezone shift can't be computed. Context: %s \"%s\" date_time_raw: %s", symbol, name, date_time_raw)
+    if orig_dividend_date != sofia_dividend_date:
+        warning_summary.warn("Dividend date changes in Sofia timezone", symbol,
+                             "WARNING:   Dividend date changes in Sofia timezone: %s → %s Context: %s \"%s\" date_time_raw: %s%s",
+                             orig_dividend_date, sofia_dividend_date, symbol, name, date_time_raw,
+                             f"\n           Calculations will be made with the date {sofia_dividend_date} (according to the Sofia time zone)." if convert_date else "")
+        if convert_date:
+            dividend_date = sofia_dividend_date
         else:
-            print(f"[debug]:      No dividend date changes because of time zones. Context: {symbol} \"{name}\" date_time_raw: {date_time_raw}")
-        
-        # Pass the DD.MM.YYYY formatted date to look_for_currency_rate
-        bgn_rate = Decimal(look_for_currency_rate(currency, dividend_date)) if currency != 'BGN' and dividend_date else Decimal('1.0')
+            dividend_date = orig_dividend_date
 
-        print(f"[debug]: Currency rate for {currency} at {dividend_date} is {bgn_rate}. Context: {symbol} \"{name}\" date_time_raw: {date_time_raw}")
+    else:
+        log.log(TRACE, "[debug]:      No dividend date changes because of time zones. Context: %s \"%s\" date_time_raw: %s", symbol, name, date_time_raw)
+    
+    # Pass the DD.MM.YYYY formatted date to look_for_currency_rate
+    bgn_rate = Decimal(look_for_currency_rate(currency, dividend_date)) if currency != 'BGN' and dividend_date else Decimal('1.0')
 
-        if total_tax_amount > 0:
-            print(f"ERROR: positive withholding tax encountered!  Context: {symbol} \"{name}\" date_time_raw: {date_time_raw}, withheld tax: {total_tax_amount}")
+    log.log(TRACE, "[debug]: Currency rate for %s at %s is %s. Context: %s \"%s\" date_time_raw: %s", currency, dividend_date, bgn_rate, symbol, name, date_time_raw)
 
-        total_tax_amount = abs(total_tax_amount) # the tax is negative in Flex Query data, but positive in the output data
+    if total_tax_amount > 0:
+        log.error(f"ERROR: positive withholding tax encountered!  Context: {symbol} \"{name}\" date_time_raw: {date_time_raw}, withheld tax: {total_tax_amount}")
 
-        dividend_bgn = (total_dividend_amount * bgn_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
-        withholding_tax_bgn = (total_tax_amount * bgn_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+    total_tax_amount = abs(total_tax_amount) # the tax is negative in Flex Query data, but positive in the output data
 
-        income_code = "8141" # hardcoded
+    dividend_bgn = (total_dividend_amount * bgn_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+    withholding_tax_bgn = (total_tax_amount * bgn_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
 
-        permitted_tax_credit = round_decimal(dividend_bgn * Decimal("0.05"))
+    income_code = "8141" # hardcoded
 
-        if withholding_tax_bgn == Decimal("0"):
-            tax_due = permitted_tax_credit
-        else:
-            tax_due = max(Decimal("0"), permitted_tax_credit - withholding_tax_bgn)
+    permitted_tax_credit = round_decimal(dividend_bgn * Decimal("0.05"))
 
-        applied_tax_credit = min(withholding_tax_bgn, permitted_tax_credit)
+    if withholding_tax_bgn == Decimal("0"):
+        tax_due = permitted_tax_credit
+    else:
+        tax_due = max(Decimal("0"), permitted_tax_credit - withholding_tax_bgn)
 
-        if withholding_tax_bgn == Decimal("0"):
-            method = "3"
-            permitted_tax_credit = 0 # for consistency with nap-autopilot
-        else:
-            method = "1"
-
-        # Data for dividends-nap-autopilot
-        dividends_nap_autopilot_data.append({
-            "name": name,
-            "country": country,
-            "sum": dividend_bgn,
-            "paidtax": withholding_tax_bgn
-        })
+    applied_tax_credit = min(withholding_tax_bgn, permitted_tax_credit)
 
-        # Data for dividends-sheet
-        dividends_sheet_data.append({
-            "name": name,
-            "ISIN": isin,
-            "currency code": currency,
-            "dividend": total_dividend_amount,
-            "withholding tax": total_tax_amount,
-            "date": dividend_date,
-            "currency rate": bgn_rate,
-            "dividend BGN": dividend_bgn,
-            "withholding tax BGN": withholding_tax_bgn,
-            "permitted tax credit": permitted_tax_credit,
-            "method": method,
-            "applied tax credit": applied_tax_credit,
-            "tax due": tax_due,
-            "country": country
-        })
+    if withholding_tax_bgn == Decimal("0"):
+        method = "3"
+        permitted_tax_credit = 0 # for consistency with nap-autopilot
+    else:
+        method = "1"
+
+    # Data for dividends-nap-autopilot
+    nap_autopilot_row = {
+        "name": name,
+        "country": country,
+        "sum": dividend_bgn,
+        "paidtax": withholding_tax_bgn
+    }
 
-        # Data for dividends-table
-        dividends_table_data.append({
-            "name": name,
-            "country": country,
-            "income code": income_code,
-            "method": method,
-            "dividend BGN": dividend_bgn,
-            "withholding tax BGN": withholding_tax_bgn,
-            "permitted tax credit": permitted_tax_credit,
-            "applied tax credit": applied_tax_credit,
-            "tax due": tax_due
-        })
+    # Data for dividends-sheet
+    dividends_sheet_row = {
+        "name": name,
+        "ISIN": isin,
+        "currency code": currency,
+        "dividend": total_dividend_amount,
+        "withholding tax": total_tax_amount,
+        "date": dividend_date,
+        "currency rate": bgn_rate,
+        "dividend BGN": dividend_bgn,
+        "withholding tax BGN": withholding_tax_bgn,
+        "permitted tax credit": permitted_tax_credit,
+        "method": method,
+        "applied tax credit": applied_tax_credit,
+        "tax due": tax_due,
+        "country": country
+    }
 
-    print(f"[debug] Finished processing dividend data. Found {len(dividends_sheet_data)} consolidated dividend events.")
-    return dividends_nap_autopilot_data, dividends_sheet_data, dividends_table_data
+    # Data for dividends-table
+    dividends_table_row = {
+        "name": name,
+        "country": country,
+        "income code": income_code,
+        "method": method,
+        "dividend BGN": dividend_bgn,
+        "withholding tax BGN": withholding_tax_bgn,
+        "permitted tax credit": permitted_tax_credit,
+        "applied tax credit": applied_tax_credit,
+        "tax due": tax_due
+    }
+
+    return nap_autopilot_row, dividends_sheet_row, dividends_table_row
 
 def process_interest_from_xml(xml_dir: str) -> List[Dict]:
     """
     Processes IBKR Flex Query XML files to extract interest and withholding tax info.
     Returns data for the 'Interest' sheet with proper separation between SYEP and cash interest.
     """
+    return process_interest(collect_flex_data(flex_query_files(xml_dir)))
+
+def process_interest(data: FlexData, state=None) -> List[Dict]:
+    """
+    Same as process_interest_from_xml(), but works on already ingested Flex Query records.
+    With an ExportState, months whose interest and taxes didn't change are taken from the previous run.
+    """
     interest_data = []
-    all_xml_files = sorted([p for p in Path(xml_dir).iterdir() if p.suffix.lower() == '.xml'])
 
-    # Separate storage for different interest types
+    # Separate storage for different interest types; the months are grouped per
+    # account, so the taxes of one account are never matched with the interest of another
     cash_interest_groups = defaultdict(lambda: {'interest': None, 'taxes': []})
     syep_interest_records = []
 
     account_ids = set()  # Track unique account IDs
 
-    for fpath in all_xml_files:
+    for tx in data.cash_transactions:
         try:
-            tree = ET.parse(fpath)
-            root = tree.getroot()
-
-            for tx in root.iter('CashTransaction'):
-                if tx.get('levelOfDetail') != 'DETAIL':
-                    continue
+            if tx.get('levelOfDetail') != 'DETAIL':
+                continue
 
-                tx_type = tx.get('type')
-                
-                interest_transaction_types = ["Broker Interest Received", "Withholding Tax"]
+            tx_type = tx.get('type')
+            
+            interest_transaction_types = ["Broker Interest Received", "Withholding Tax"]
 
-                if tx_type not in interest_transaction_types:
-                    continue
-               
-                desc = tx.get('description', '').upper()  # Normalize case
+            if tx_type not in interest_transaction_types:
+                continue
+           
+            desc = tx.get('description', '').upper()  # Normalize case
 
-                if "DIVIDEND" in desc:
-                    continue
+            if "DIVIDEND" in desc:
+                continue
 
-                # Only collect accountId from transactions we're keeping
-                if account_id := tx.get('accountId'):
-                    if account_id != "-":  # Skip SUMMARY records
-                        account_ids.add(account_id)
+            # Only collect accountId from transactions we're keeping
+            account_id = tx.get('accountId')
+            if account_id and account_id != "-":  # Skip SUMMARY records
+                account_ids.add(account_id)
 
-                currency = tx.get('currency', '')
-                date_time = tx.get('dateTime', '')
-                amount = Decimal(tx.get('amount', '0'))
+            currency = tx.get('currency', '')
+            date_time = tx.get('dateTime', '')
+            amount = Decimal(tx.get('amount', '0'))
+            
+            # --- Date Processing ---
+            date_formatted = ''
+            if date_time:
+                try:
+                    date_formatted = format_date(date_time)
+                    if ';' in date_time or ' ' in date_time:
+                        log.warning(f"WARNING: Time component in dateTime for {tx_type}: {desc}")
+                except Exception as e:
+                    log.warning(f"WARNING: Failed to format date '{date_time}' for {desc}: {str(e)}")
+
+            # --- Process SYEP Interest ---
+            if "SYEP" in desc and tx_type == "Broker Interest Received":
+                syep_record = {
+                    'description': desc,
+                    'date': date_formatted,
+                    'amount': amount,
+                    'currency': currency,
+                    'currency rate': '',
+                    'amount BGN': '',
+                    'withholding tax': '',
+                    'withholding tax BGN': '',
+                    'withholding tax date mismatch': ''
+                }
                 
-                # --- Date Processing ---
-                date_formatted = ''
-                if date_time:
+                # Attempt currency conversion for SYEP
+                if currency and date_formatted:
                     try:
-                        date_formatted = format_date(date_time)
-                        if ';' in date_time or ' ' in date_time:
-                            print(f"WARNING: Time component in dateTime for {tx_type}: {desc}")
+                        bgn_rate = Decimal(look_for_currency_rate(currency, date_formatted))
+                        syep_record['currency rate'] = bgn_rate
+                        syep_record['amount BGN'] = (amount * bgn_rate).quantize(Decimal('0.01'))
                     except Exception as e:
-                        print(f"WARNING: Failed to format date '{date_time}' for {desc}: {str(e)}")
-
-                # --- Process SYEP Interest ---
-                if "SYEP" in desc and tx_type == "Broker Interest Received":
-                    syep_record = {
-                        'description': desc,
-                        'date': date_formatted,
-                        'amount': amount,
-                        'currency': currency,
-                        'currency rate': '',
-                        'amount BGN': '',
-                        'withholding tax': '',
-                        'withholding tax BGN': '',
-                        'withholding tax date mismatch': ''
-                    }
-                    
-                    # Attempt currency conversion for SYEP
-                    if currency and date_formatted:
-                        try:
-                            bgn_rate = Decimal(look_for_currency_rate(currency, date_formatted))
-                            syep_record['currency rate'] = bgn_rate
-                            syep_record['amount BGN'] = (amount * bgn_rate).quantize(Decimal('0.01'))
-                        except Exception as e:
-                            print(f"WARNING: SYEP currency conversion failed for {currency}: {str(e)}")
-                    
-                    syep_interest_records.append(syep_record)
-                    continue
-
-                # --- Process Cash Interest and Taxes ---
-                month_year = extract_month_year(desc)
-                if not month_year:
-                    continue
+                        log.warning(f"WARNING: SYEP currency conversion failed for {currency}: {str(e)}")
+                
+                syep_interest_records.append(syep_record)
+                continue
 
-                key = (currency, month_year)
-
-                if tx_type == "Broker Interest Received" and "CREDIT INT" in desc:
-                    cash_interest_groups[key]['interest'] = {
-                        'description': desc,
-                        'date': date_formatted,
-                        'amount': amount,
-                        'currency': currency,
-                        'raw_date': date_time
-                    }
-                elif tx_type == "Withholding Tax" and "ON CREDIT INT" in desc:
-                    cash_interest_groups[key]['taxes'].append({
-                        'amount': amount,
-                        'date': date_formatted,
-                        'raw_date': date_time,
-                        'description': desc,
-                        'currency': currency
-                    })
+            # --- Process Cash Interest and Taxes ---
+            month_year = extract_month_year(desc)
+            if not month_year:
+                continue
 
+            key = (account_id, currency, month_year)
+
+            if tx_type == "Broker Interest Received" and "CREDIT INT" in desc:
+                cash_interest_groups[key]['interest'] = {
+                    'description': desc,
+                    'date': date_formatted,
+                    'amount': amount,
+                    'currency': currency,
+                    'raw_date': date_time
+                }
+            elif tx_type == "Withholding Tax" and "ON CREDIT INT" in desc:
+                cash_interest_groups[key]['taxes'].append({
+                    'amount': amount,
+                    'date': date_formatted,
+                    'raw_date': date_time,
+                    'description': desc,
+                    'currency': currency
+                })
         except Exception as e:
-            print(f"Error processing {fpath.name}: {e}")
+            log.error(f"Error processing CashTransaction {tx}: {e}")
 
     # --- Process Cash Interest Groups ---
-    for (currency, month_year), group in cash_interest_groups.items():
-        interest = group['interest']
-        taxes = group['taxes']
+    for (account_id, currency, month_year), group in cash_interest_groups.items():
+        if state is None:
+            row = interest_month_row(currency, month_year, group)
+        else:
+            row = state.rows("interest months", (account_id, currency, month_year, group['interest'], group['taxes']),
+                             lambda: interest_month_row(currency, month_year, group))
+        if row:
+            interest_data.append(row)
 
-        if not interest:
-            if taxes:
-                print(f"WARNING: Orphaned withholding taxes for {currency} {month_year}")
-            continue
+    # --- Add SYEP Records ---
+    interest_data.extend(syep_interest_records)
 
-        # --- Currency Conversion ---
-        bgn_rate = ''
-        amount_bgn = ''
-        if currency and interest['date']:
-            try:
-                bgn_rate = Decimal(look_for_currency_rate(currency, interest['date']))
-                amount_bgn = (interest['amount'] * bgn_rate).quantize(Decimal('0.01'))
-            except Exception as e:
-                print(f"WARNING: Currency conversion failed for {currency}: {str(e)}")
+    if not account_ids:
+        log.warning("WARNING: No valid account IDs found in DETAIL records for interest transactions")
+    elif len(account_ids) > 1:
+        log.debug("debug: Interest transactions from %s accounts (grouped per account): %s", len(account_ids), ", ".join(sorted(account_ids)))
+    elif len(account_ids) == 1:
+        log.debug("debug: All interest transactions from single account: %s", next(iter(account_ids)))
 
-        print(f"debug: === Processing {currency} {month_year} - {len(taxes)} tax record(s) ===")
+    return interest_data
 
-        # --- Tax Processing ---
-        total_tax = Decimal('0')
-        total_tax_bgn = Decimal('0')
-        date_mismatch = False
-        
-        for tax in taxes:
-            total_tax += tax['amount']
-            if tax['raw_date'] != interest['raw_date']:
-                date_mismatch = True
+def interest_month_row(currency: str, month_year: str, group: Dict) -> Optional[Dict]:
+    """The Interest row of one month of cash interest in one currency (with its withholding taxes)."""
+    interest = group['interest']
+    taxes = group['taxes']
 
-        if total_tax > 0:
-            print(f"WARNING: Positive tax of {total_tax} for {currency} {month_year}")
+    if not interest:
+        if taxes:
+            log.warning(f"WARNING: Orphaned withholding taxes for {currency} {month_year}")
+        return None
 
-        total_tax = abs(total_tax)
+    # --- Currency Conversion ---
+    bgn_rate = ''
+    amount_bgn = ''
+    if currency and interest['date']:
+        try:
+            bgn_rate = Decimal(look_for_currency_rate(currency, interest['date']))
+            amount_bgn = (interest['amount'] * bgn_rate).quantize(Decimal('0.01'))
+        except Exception as e:
+            log.warning(f"WARNING: Currency conversion failed for {currency}: {str(e)}")
 
-        tax_conversion_failed = False
+    log.debug("debug: === Processing %s %s - %s tax record(s) ===", currency, month_year, len(taxes))
 
-        if date_mismatch:
-            print("debug: calculating tax when date_mismatch is True... ")
+    # --- Tax Processing ---
+    total_tax = Decimal('0')
+    total_tax_bgn = Decimal('0')
+    date_mismatch = False
+    
+    for tax in taxes:
+        total_tax += tax['amount']
+        if tax['raw_date'] != interest['raw_date']:
+            date_mismatch = True
 
-            for tax in taxes:
-                try:
-                    tax_date = tax['date']
-                    tax_currency_rate = Decimal(look_for_currency_rate(currency, tax_date))
-                    tax_amount = tax['amount']
-                    tax_piece_bgn = (tax_amount * tax_currency_rate).quantize(Decimal('0.01'))
-                    tax_desc=tax.get('description', '')
-                    print(f"debug: {tax_amount} {currency} -> {tax_piece_bgn} BGN / currency rate: {tax_currency_rate} date: {tax_date} / {tax_desc}")
-                    total_tax_bgn += tax_piece_bgn
-                except Exception as e:
-                    print(f"WARNING: Tax conversion failed for tax on {tax['date']}: {str(e)}")
-                    tax_conversion_failed = True
+    if total_tax > 0:
+        log.warning(f"WARNING: Positive tax of {total_tax} for {currency} {month_year}")
 
-            if tax_conversion_failed:
-                total_tax_bgn = "COMPUTATION FAILED"
-            else:
-                if total_tax_bgn > 0:
-                    print(f"WARNING: Positive tax in BGN (total_tax_bgn) of {total_tax_bgn} for {currency} {month_year}")
-                total_tax_bgn = abs(total_tax_bgn)
+    total_tax = abs(total_tax)
 
+    tax_conversion_failed = False
 
-            print(f"debug: Net tax for {currency} {month_year}: {total_tax} {currency} (BGN: {total_tax_bgn})")
+    if date_mismatch:
+        log.log(TRACE, "debug: calculating tax when date_mismatch is True... ")
 
-        else:
+        for tax in taxes:
             try:
-                total_tax_bgn = (total_tax * bgn_rate).quantize(Decimal('0.01'))
-            except:
-                print(f"WARNING: Tax conversion failed for {currency} {month_year}")
-
-        interest_data.append({
-            'description': interest['description'],
-            'date': interest['date'],
-            'amount': interest['amount'],
-            'currency': currency,
-            'currency rate': bgn_rate,
-            'amount BGN': amount_bgn,
-            'withholding tax': total_tax if taxes else '',
-            'withholding tax BGN': total_tax_bgn if taxes else '',
-            'withholding tax date mismatch': 'yes' if date_mismatch else ''
-        })
+                tax_date = tax['date']
+                tax_currency_rate = Decimal(look_for_currency_rate(currency, tax_date))
+                tax_amount = tax['amount']
+                tax_piece_bgn = (tax_amount * tax_currency_rate).quantize(Decimal('0.01'))
+                tax_desc=tax.get('description', '')
+                log.log(TRACE, "debug: %s %s -> %s BGN / currency rate: %s date: %s / %s", tax_amount, currency, tax_piece_bgn, tax_currency_rate, tax_date, tax_desc)
+                total_tax_bgn += tax_piece_bgn
+            except Exception as e:
+                log.warning(f"WARNING: Tax conversion failed for tax on {tax['date']}: {str(e)}")
+                tax_conversion_failed = True
 
-    # --- Add SYEP Records ---
-    interest_data.extend(syep_interest_records)
+        if tax_conversion_failed:
+            total_tax_bgn = "COMPUTATION FAILED"
+        else:
+            if total_tax_bgn > 0:
+                log.warning(f"WARNING: Positive tax in BGN (total_tax_bgn) of {total_tax_bgn} for {currency} {month_year}")
+            total_tax_bgn = abs(total_tax_bgn)
 
-    if not account_ids:
-        print("WARNING: No valid account IDs found in DETAIL records for interest transactions")
-    elif len(account_ids) > 1:
-        print(f"CRITICAL: Found interest transactions from multiple accounts: {account_ids}")
-    elif len(account_ids) == 1:
-        print(f"debug: All interest transactions from single account: {account_ids.pop() if account_ids else 'None'}")
 
-    return interest_data
+        log.debug("debug: Net tax for %s %s: %s %s (BGN: %s)", currency, month_year, total_tax, currency, total_tax_bgn)
+
+    else:
+        try:
+            total_tax_bgn = (total_tax * bgn_rate).quantize(Decimal('0.01'))
+        except:
+            log.warning(f"WARNING: Tax conversion failed for {currency} {month_year}")
+
+    return {
+        'description': interest['description'],
+        'date': interest['date'],
+        'amount': interest['amount'],
+        'currency': currency,
+        'currency rate': bgn_rate,
+        'amount BGN': amount_bgn,
+        'withholding tax': total_tax if taxes else '',
+        'withholding tax BGN': total_tax_bgn if taxes else '',
+        'withholding tax date mismatch': 'yes' if date_mismatch else ''
+    }
 
 def extract_month_year(desc: str) -> Optional[str]:
     """Extracts month/year from descriptions like 'FOR MAR-2024'"""
@@ -945,32 +1294,91 @@ def extract_month_year(desc: str) -> Optional[str]:
     return None
 
 
+# UTC offsets (in seconds) of the time zone abbreviations used in Flex Query timestamps
+TZ_OFFSETS = {
+    "EST": -18000,  # UTC-5
+    "EDT": -14400,  # UTC-4
+    "CST": -21600,  # UTC-6
+    "CDT": -18000,  # UTC-5
+    "MST": -25200,  # UTC-7
+    "MDT": -21600,  # UTC-6
+    "PST": -28800,  # UTC-8
+    "PDT": -25200,  # UTC-7
+    "GMT": 0,
+    "UTC": 0,
+}
+FIXED_ZONES = {abbr: timezone(timedelta(seconds=offset)) for abbr, offset in TZ_OFFSETS.items()}
+SOFIA_TZ = ZoneInfo("Europe/Sofia")
+
+TIMESTAMP_PATTERN = re.compile(r'(\d{4})(0[1-9]|1[0-2])(0[1-9]|[12][0-9]|3[01]);([01][0-9]|2[0-3])([0-5][0-9])([0-5][0-9]) ([A-Z]{3})')
+
+# Upper bound for the memos of parsed timestamps and formatted dates
+MAX_CACHED_TIMESTAMPS = 100000
+_timestamp_cache = {}
+_date_cache = {}
+
+def parse_flex_timestamp(date_str):
+    """
+    Validate and decode a Flex Query timestamp 'YYYYMMDD;HHMMSS TZ' in one pass.
+    Returns (original date, Sofia date) as DD.MM.YYYY strings, with a Sofia date
+    of None when the time zone is not in TZ_OFFSETS, or None when date_str is
+    not a valid timestamp. The results are memoized.
+    """
+    try:
+        return _timestamp_cache[date_str]
+    except KeyError:
+        pass
+
+    result = None
+    match = TIMESTAMP_PATTERN.fullmatch(date_str) if date_str else None
+    if match:
+        year, month, day, hour, minute, second, tz_abbr = match.groups()
+        try:
+            dt = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                          tzinfo=FIXED_ZONES.get(tz_abbr))
+        except ValueError:
+            dt = None  # e.g. 20230230
+        if dt is not None:
+            sofia_date = None
+            if dt.tzinfo is not None:
+                dt_sofia = dt.astimezone(SOFIA_TZ)
+                sofia_date = f"{dt_sofia.day:02d}.{dt_sofia.month:02d}.{dt_sofia.year:04d}"
+            result = (f"{day}.{month}.{year}", sofia_date)
+
+    if len(_timestamp_cache) >= MAX_CACHED_TIMESTAMPS:
+        _timestamp_cache.clear()
+    _timestamp_cache[date_str] = result
+    return result
+
 def format_date(date_str, out_fmt="%d.%m.%Y"):
     """Convert 'YYYYMMDD' or 'YYYY-MM-DD' to 'DD.MM.YYYY' (or another desired format)."""
     date_str=date_str.split(";")[0]
+    key = (date_str, out_fmt)
+    formatted = _date_cache.get(key)
+    if formatted is not None:
+        return formatted
+
     if "-" in date_str:
         dt = datetime.strptime(date_str, "%Y-%m-%d")
     else:
         dt = datetime.strptime(date_str, "%Y%m%d")
-    return dt.strftime(out_fmt)
+    formatted = dt.strftime(out_fmt)
+
+    if len(_date_cache) >= MAX_CACHED_TIMESTAMPS:
+        _date_cache.clear()
+    _date_cache[key] = formatted
+    return formatted
 
 def convert_to_sofia_date(datetime_str):
     """
     Convert dateTime like '20240703;055739 EDT' to Sofia time.
     Returns (original_date, sofia_date) in format DD.MM.YYYY.
+    Timestamps in the usual layout with a known time zone are decoded by
+    parse_flex_timestamp(); anything else goes through dateutil.
     """
-    tzinfos = {
-        "EST": -18000,  # UTC-5
-        "EDT": -14400,  # UTC-4
-        "CST": -21600,  # UTC-6
-        "CDT": -18000,  # UTC-5
-        "MST": -25200,  # UTC-7
-        "MDT": -21600,  # UTC-6
-        "PST": -28800,  # UTC-8
-        "PDT": -25200,  # UTC-7
-        "GMT": 0,
-        "UTC": 0,
-    }
+    parsed = parse_flex_timestamp(datetime_str)
+    if parsed is not None and parsed[1] is not None:
+        return parsed
 
     try:
         if not datetime_str or ";" not in datetime_str:
@@ -982,21 +1390,21 @@ def convert_to_sofia_date(datetime_str):
         # Extract timezone abbreviation if present
         if len(parts) == 2:
             time_part, tz_abbr = parts
-            if tz_abbr not in tzinfos:
-                print(f"WARNING: Timezone abbreviation '{tz_abbr}' not recognized in tzinfos. May cause incorrect conversion.")
+            if tz_abbr not in TZ_OFFSETS:
+                log.warning(f"WARNING: Timezone abbreviation '{tz_abbr}' not recognized in tzinfos. May cause incorrect conversion.")
         else:
             time_part = parts[0]
             tz_abbr = ""
 
         dt_str = f"{date_part} {time_with_tz.strip()}"
-        dt = parser.parse(dt_str, tzinfos=tzinfos)
-        dt_sofia = dt.astimezone(ZoneInfo("Europe/Sofia"))
+        dt = parser.parse(dt_str, tzinfos=TZ_OFFSETS)
+        dt_sofia = dt.astimezone(SOFIA_TZ)
 
         fmt = "%d.%m.%Y"
         return dt.strftime(fmt), dt_sofia.strftime(fmt)
 
     except Exception as e:
-        print(f"Error converting '{datetime_str}': {e}")
+        log.error(f"Error converting '{datetime_str}': {e}")
         return None, None
 
 def is_valid_timestamp(date_str):
@@ -1009,30 +1417,99 @@ def is_valid_timestamp(date_str):
     Returns:
         bool: True if format is valid, False otherwise
     """
-    if not date_str:
-        return False
-    
-    pattern = r'^(\d{4})(0[1-9]|1[0-2])(0[1-9]|[12][0-9]|3[01]);([01][0-9]|2[0-3])([0-5][0-9]){2} [A-Z]{3}$'
-    
-    if not re.fullmatch(pattern, date_str):
-        return False
-    
-    # Additional date validation (check for invalid dates like 20230230)
-    try:
-        from datetime import datetime
-        date_part = date_str.split(';')[0]
-        datetime.strptime(date_part, '%Y%m%d')
-        return True
-    except ValueError:
-        return False
+    return parse_flex_timestamp(date_str) is not None
+
+
+def sheet_name(sheet_def):
+    """The name of a sheet in the ODS file: its title, prefixed with the account for the sheets of one account."""
+    account = sheet_def.get("account")
+    return f"{account} {sheet_def['title']}" if account else sheet_def["title"]
+
+def add_totals(totals_sheet, sheets):
+    """Add the totals of the Realized Trades and Interest sheets (of one account) to the Totals sheet."""
+    # Only based on "Realized Trades"
+    realized_sheet = next((s for s in sheets if s["title"] == "Realized Trades"), None)
+    if realized_sheet:
+        realized_name = sheet_name(realized_sheet)
+        headers = realized_sheet["headers"]
+        rows = realized_sheet["rows"] # Data rows, not including header
 
+        total_fields = ["BuyGrossBGN", "SellGrossBGN", "ProfitBGN", "LossBGN"]
+
+        for field in total_fields:
+            if field not in headers:
+                continue
+
+            row = TableRow()
+            # Label cell
+            cell = TableCell()
+            cell.addElement(P(text=f"Total {field}"))
+            row.addElement(cell)
+
+            # Formula cell
+            # Column index starts from 0, so convert to A, B, C...
+            col_letter = chr(65 + headers.index(field))
+            # Formulas are 1-based for rows, and header is row 1, so data starts from row 2
+            formula = f"=SUM('{realized_name}'.{col_letter}2:{col_letter}{len(rows)+1})"
+            cell = TableCell(valuetype="float", formula=formula)
+            row.addElement(cell)
+            totals_sheet.addElement(row)
+
+        # Total Net Profit (BGN)
+        if "ProfitBGN" in headers and "LossBGN" in headers:
+            row = TableRow()
+            # Label cell
+            cell = TableCell()
+            cell.addElement(P(text="Total Net Profit (BGN)"))
+            row.addElement(cell)
+
+            # Formula cell
+            p_col = chr(65 + headers.index("ProfitBGN"))
+            l_col = chr(65 + headers.index("LossBGN"))
+            formula = f"=SUM('{realized_name}'.{p_col}2:{p_col}{len(rows)+1}) - SUM('{realized_name}'.{l_col}2:{l_col}{len(rows)+1})"
+            cell = TableCell(valuetype="float", formula=formula)
+            row.addElement(cell)
+            totals_sheet.addElement(row)
+
+    # --- Add Total Interest BGN ---
+    # Find the "Interest" sheet
+    interest_sheet = next((s for s in sheets if s["title"] == "Interest"), None)
+    if interest_sheet:
+        interest_name = sheet_name(interest_sheet)
+        interest_headers = interest_sheet["headers"]
+        interest_rows = interest_sheet["rows"]
+
+        # Check if "amount BGN" column exists in the Interest sheet
+        if "amount BGN" in interest_headers:
+            # Add a blank row for spacing, as requested ("one line below other totals")
+            totals_sheet.addElement(TableRow())
+
+            interest_total_row = TableRow()
+            # Label cell
+            cell_label = TableCell()
+            cell_label.addElement(P(text="Total Interest (BGN)"))
+            interest_total_row.addElement(cell_label)
+
+            # Formula cell for "amount BGN"
+            interest_col_index = interest_headers.index("amount BGN")
+            interest_col_letter = chr(65 + interest_col_index)
+            # Assuming data starts from row 2 (after header)
+            interest_formula = f"=SUM('{interest_name}'.{interest_col_letter}2:{interest_col_letter}{len(interest_rows)+1})"
+            cell_formula = TableCell(valuetype="float", formula=interest_formula)
+            interest_total_row.addElement(cell_formula)
+            totals_sheet.addElement(interest_total_row)
+        else:
+            log.warning("Warning: 'amount BGN' column not found in 'Interest' sheet.")
+    else:
+        log.warning("Warning: 'Interest' sheet not found.")
 
 def write_ods_with_totals(output_dir, sheets, output_file_name):
     """
     Write data to ODS file with totals sheet
     Args:
         output_dir: Directory to save the file
-        sheets: List of sheet data
+        sheets: List of sheet data; the sheets of an account (with an "account" key)
+                get the account in their name and their own totals
         output_file_name: Base filename (without .ods extension)
     """
     # Create path WITHOUT adding .ods extension
@@ -1054,7 +1531,7 @@ def write_ods_with_totals(output_dir, sheets, output_file_name):
             # Generate headers from row keys if not provided, maintaining order
             headers = list(OrderedDict.fromkeys(k for row in rows for k in row.keys()))
 
-        sheet = Table(name=title)
+        sheet = Table(name=sheet_name(sheet_def))
         # Add columns based on the number of headers
         for _ in headers:
             sheet.addElement(TableColumn())
@@ -1098,125 +1575,81 @@ def write_ods_with_totals(output_dir, sheets, output_file_name):
     totals_sheet.addElement(TableColumn())
     totals_sheet.addElement(TableColumn())
 
-    # Only based on "Realized Trades"
-    realized_sheet = next((s for s in sheets if s["title"] == "Realized Trades"), None)
-    if realized_sheet:
-        headers = realized_sheet["headers"]
-        rows = realized_sheet["rows"] # Data rows, not including header
-
-        total_fields = ["BuyGrossBGN", "SellGrossBGN", "ProfitBGN", "LossBGN"]
-
-        for field in total_fields:
-            if field not in headers:
-                continue
-
-            row = TableRow()
-            # Label cell
-            cell = TableCell()
-            cell.addElement(P(text=f"Total {field}"))
-            row.addElement(cell)
-
-            # Formula cell
-            # Column index starts from 0, so convert to A, B, C...
-            col_letter = chr(65 + headers.index(field))
-            # Formulas are 1-based for rows, and header is row 1, so data starts from row 2
-            formula = f"=SUM('Realized Trades'.{col_letter}2:{col_letter}{len(rows)+1})"
-            cell = TableCell(valuetype="float", formula=formula)
-            row.addElement(cell)
-            totals_sheet.addElement(row)
-
-        # Total Net Profit (BGN)
-        if "ProfitBGN" in headers and "LossBGN" in headers:
+    accounts = list(OrderedDict.fromkeys(s.get("account") for s in sheets))
+    for account in accounts:
+        if account:
+            if account != accounts[0]:
+                totals_sheet.addElement(TableRow())
             row = TableRow()
-            # Label cell
-            cell = TableCell()
-            cell.addElement(P(text="Total Net Profit (BGN)"))
-            row.addElement(cell)
-
-            # Formula cell
-            p_col = chr(65 + headers.index("ProfitBGN"))
-            l_col = chr(65 + headers.index("LossBGN"))
-            formula = f"=SUM('Realized Trades'.{p_col}2:{p_col}{len(rows)+1}) - SUM('Realized Trades'.{l_col}2:{l_col}{len(rows)+1})"
-            cell = TableCell(valuetype="float", formula=formula)
+            cell = TableCell(stylename=bold_cell_style)
+            cell.addElement(P(text=f"Account {account}"))
             row.addElement(cell)
             totals_sheet.addElement(row)
-
-    # --- Add Total Interest BGN ---
-    # Find the "Interest" sheet
-    interest_sheet = next((s for s in sheets if s["title"] == "Interest"), None)
-    if interest_sheet:
-        interest_headers = interest_sheet["headers"]
-        interest_rows = interest_sheet["rows"]
-
-        # Check if "amount BGN" column exists in the Interest sheet
-        if "amount BGN" in interest_headers:
-            # Add a blank row for spacing, as requested ("one line below other totals")
-            totals_sheet.addElement(TableRow())
-
-            interest_total_row = TableRow()
-            # Label cell
-            cell_label = TableCell()
-            cell_label.addElement(P(text="Total Interest (BGN)"))
-            interest_total_row.addElement(cell_label)
-
-            # Formula cell for "amount BGN"
-            interest_col_index = interest_headers.index("amount BGN")
-            interest_col_letter = chr(65 + interest_col_index)
-            # Assuming data starts from row 2 (after header)
-            interest_formula = f"=SUM('Interest'.{interest_col_letter}2:{interest_col_letter}{len(interest_rows)+1})"
-            cell_formula = TableCell(valuetype="float", formula=interest_formula)
-            interest_total_row.addElement(cell_formula)
-            totals_sheet.addElement(interest_total_row)
-        else:
-            print("Warning: 'amount BGN' column not found in 'Interest' sheet.")
-    else:
-        print("Warning: 'Interest' sheet not found.")
+        add_totals(totals_sheet, [s for s in sheets if s.get("account") == account])
 
     doc.spreadsheet.addElement(totals_sheet)
 
     # Save the document
     doc.save(str(output_path), True)
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("xml_dir", help="Path to directory containing XML files")
-    parser.add_argument("--convert-date", action="store_true",
-                        help="Convert dates to Sofia timezone (DD.MM.YYYY HH:MM:SS format)")
-    args = parser.parse_args()
-
-    xml_dir = args.xml_dir
-    output_file_name = "ibkr_output" # without the .ods extension
-
-    output_path = Path(xml_dir) / f"{output_file_name}.ods"
-
-    # Check if file exists first
-    if output_path.exists():
-        print(f"\nERROR: Output file already exists at:\n{output_path}\n"
-              "Please remove it or rename the existing file before running this exporter.")
-        sys.exit(1)
-
-    convert_date = args.convert_date
+def required_currency_rates(data: FlexData, convert_date=False):
+    """
+    The (currency, DD.MM.YYYY) pairs the conversions to BGN will look up:
+    the trade, lot, open position and cash transaction dates (in Sofia time
+    with convert_date) in the currency of the record. A few of them may not
+    be needed (e.g. the open date of a lot whose opening trade is known).
+    """
+    pairs = set()
+    records = data.trades + data.all_trades + data.cash_transactions + [pos for pos, _ in data.open_positions]
+    for record in records:
+        currency = record.get("currency")
+        if not currency:
+            continue
+        for name in ("tradeDate", "dateTime", "openDateTime"):
+            value = record.get(name)
+            if not value:
+                continue
+            parsed = parse_flex_timestamp(value)  # no warnings here: the conversions report bad dates
+            if parsed is not None and parsed[1] is not None:
+                pairs.add((currency, parsed[1] if convert_date else parsed[0]))
+                continue
+            try:
+                pairs.add((currency, format_date(value)))
+            except ValueError:
+                pass
+    return pairs
 
-    # Process existing trades (assuming these functions are defined elsewhere in your file)
-    # You should have these functions already from your original ibkr_ods_exporter.py
+def export_sheets(data: FlexData, convert_date=False, state=None, fifo_lots=False, year_end_positions=(), jobs=1) -> List[Dict]:
+    """
+    The sheets (title, rows, headers) of the output computed from the records
+    of data; see main() for the options.
+    """
     try:
-        elements = parse_all_trades_from_dir(xml_dir)
+        elements = data.trades
         opens = index_opening_trades(elements)
         # Pass the callable to existing trade functions
-        results = process_closing_trades(elements, opens, convert_date)
-        xml_files = [p for p in Path(xml_dir).iterdir() if p.suffix.lower() == '.xml']
-        open_positions = collect_open_positions(xml_files, opens, convert_date)
+        engine = None
+        if fifo_lots or year_end_positions:
+            # One replay of the executions gives both the lots and the year-end holdings
+            engine = FifoLotEngine(ASSET_CATS)
+            engine.replay(elements, year_end_positions)
+        if fifo_lots:
+            add_fifo_openings(opens, engine)
+        results = process_closing_trades(elements, opens, convert_date, state, engine if fifo_lots else None, jobs)
+        open_positions = process_open_positions(data, opens, convert_date)
+        if year_end_positions:
+            open_positions += reconstruct_open_positions(data, engine, year_end_positions, convert_date)
     except Exception as e:
-        print(f"Error processing trades or open positions: {e}")
+        log.error(f"Error processing trades or open positions: {e}")
         # Initialize to empty lists/dicts to proceed gracefully if an error occurs in trade processing
         elements, opens, results, open_positions = [], {}, [], []
 
 
     # Process dividends and taxes, passing the boolean flag directly
-    dividends_nap, dividends_sheet, dividends_table = process_dividends_from_xml(xml_dir, convert_date)
+    dividends_nap, dividends_sheet, dividends_table = process_dividends(data, convert_date, state)
 
     # Process interest data
-    interest_data = process_interest_from_xml(xml_dir)
+    interest_data = process_interest(data, state)
 
     # Define headers for the new sheets
     headers_nap_autopilot = ["name", "country", "sum", "paidtax"]
@@ -1274,14 +1707,215 @@ def main():
             "headers": headers_interest
         })
 
+    return sheets
+
+def export_account_sheets(shards: Dict[str, FlexData], convert_date=False, state=None, fifo_lots=False, year_end_positions=(), jobs=1) -> Dict[str, List[Dict]]:
+    """
+    The sheets of every account, from the records split by account (see
+    FlexData.by_account()). The accounts don't share any rows or totals, so
+    with jobs != 1 (None = one per CPU) they are computed by a pool of worker
+    processes, one account per task. The messages of every account are
+    logged here, account by account, as when computed one after the other.
+
+    With an ExportState the accounts are computed one after the other (the
+    state is kept in this process).
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    sheets = {}
+    if jobs > 1 and len(shards) > 1 and state is None:
+        accounts = list(shards)
+        log.debug("[debug] Computing %s accounts in %s processes", len(accounts), min(jobs, len(accounts)))
+        options = (convert_date, fifo_lots, year_end_positions)
+        with ProcessPoolExecutor(max_workers=min(jobs, len(accounts)), initializer=_init_worker,
+                                 initargs=(log.getEffectiveLevel(), (currency_rate_files, currency_rates, missing_currency_rates_deferred()),
+                                           warning_summary.dump)) as executor:
+            tasks = [(shards[account], options) for account in accounts]
+            for account, (account_sheets, messages, exit_code, (counts, samples), missing) in zip(accounts, executor.map(_account_sheets, tasks)):
+                log.info(f"\nAccount {account}:")
+                warning_summary.merge(counts, samples)
+                missing_currency_rates.update(missing)
+                replay_messages(log, messages, warning_summary)
+                if exit_code is not None:
+                    # look_for_currency_rate() stopped the worker, e.g. a rate is missing
+                    sys.exit(exit_code)
+                sheets[account] = account_sheets
+        return sheets
+
+    for account, shard in shards.items():
+        log.info(f"\nAccount {account}:")
+        sheets[account] = export_sheets(shard, convert_date, state, fifo_lots, year_end_positions, jobs)
+    return sheets
+
+def _account_sheets(task):
+    """
+    Worker process: the sheets of the account (task is its records and the
+    options), the messages logged while computing them (by any module), the
+    exit code if the computation was stopped (or None), the counts and
+    samples of the repeated warnings that were not recorded and the currency
+    rates found missing.
+    """
+    shard, (convert_date, fifo_lots, year_end_positions) = task
+    warnings = warning_summary if _worker["record_warnings"] else None
+    root = logging.getLogger()
+    warning_summary.clear()
+
+    sheets = []
+    exit_code = None
+    with recording_messages(root, warnings, root.getEffectiveLevel()) as messages:
+        try:
+            sheets = export_sheets(shard, convert_date, None, fifo_lots, year_end_positions, jobs=1)
+        except SystemExit as e:
+            exit_code = e.code
+    if warnings is not None:
+        # Recorded with the messages, counted when they are replayed
+        return sheets, messages, exit_code, ({}, {}), dict(missing_currency_rates)
+    return sheets, messages, exit_code, (warning_summary.counts, dict(warning_summary.samples)), dict(missing_currency_rates)
+
+
+def check_output_path(output_path, incremental=False):
+    """Stop if output_path exists, unless it's regenerated by an incremental run."""
+    if output_path.exists() and not incremental:
+        log.error(f"\nERROR: Output file already exists at:\n{output_path}\n"
+                  "Please remove it or rename the existing file before running this exporter (or use --incremental).")
+        sys.exit(1)
+
+def write_output(output_dir, sheets, output_file_name, incremental=False):
+    """Write the ODS file; incremental runs replace the previous output only once the new one is complete."""
+    if incremental:
+        temp_name = f"{output_file_name}.tmp{os.getpid()}"
+        write_ods_with_totals(output_dir, sheets, temp_name)
+        os.replace(Path(output_dir) / f"{temp_name}.ods", Path(output_dir) / f"{output_file_name}.ods")
+    else:
+        write_ods_with_totals(output_dir, sheets, output_file_name)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("xml_dir", help="Path to directory containing XML files")
+    parser.add_argument("--convert-date", action="store_true",
+                        help="Convert dates to Sofia timezone (DD.MM.YYYY HH:MM:SS format)")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Number of processes used to parse the XML files and to compute the closing trades (default: number of CPUs, 1 = no parallel processing)")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directory for the cache of parsed XML files (default: .ibkr_cache next to this script)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Don't use the cache of parsed XML files")
+    parser.add_argument("--xml-backend", choices=XML_BACKENDS, default=DEFAULT_XML_BACKEND,
+                        help="XML parser: etree (ElementTree iterparse), lxml (low-memory option, needs lxml) "
+                             "or expat (constant-memory fallback) (default: etree)")
+    parser.add_argument("--fifo-lots", action="store_true",
+                        help="Rebuild the lots of the closing trades by replaying the executions (FIFO): used for closing trades "
+                             "without <Lot> records (no \"Closed Lots\" in the Flex Query), and checked against the <Lot> records of the others")
+    parser.add_argument("--year-end-positions", metavar="YEARS", type=year_end_dates, default=[],
+                        help="Add the open positions as of 31 December of these years (e.g. 2024, 2015-2025 or 2019,2021-2023), "
+                             "rebuilt from the executions, for years without a Flex Query of the open positions")
+    parser.add_argument("--accounts", choices=("together", "separate", "combined"), default="together",
+                        help="With the records of several accounts: compute them together in one ODS file, one ODS file per account "
+                             "(ibkr_output_<account>.ods) or one ODS file with the sheets and totals of every account; "
+                             "separate and combined compute the accounts in parallel (see --jobs) (default: together)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Keep the computed rows in the cache directory and on the next run only compute the trades, "
+                             "dividends and interest months that are new or changed; overwrites an existing ibkr_output.ods")
+    parser.add_argument("--dump-warnings", action="store_true",
+                        help="Print every repeated warning (with the record) instead of only the summary at the end")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+
+    if args.incremental and args.no_cache:
+        parser.error("--incremental needs the cache of parsed XML files, it can't be combined with --no-cache")
+
+    configure_logging(verbosity_level(args.verbose, args.quiet), args.log_file)
+    warning_summary.dump = args.dump_warnings
+
+    xml_dir = args.xml_dir
+    output_file_name = "ibkr_output" # without the .ods extension
+
+    output_path = Path(xml_dir) / f"{output_file_name}.ods"
+
+    # Check if file exists first (incremental runs regenerate it); the
+    # files of --accounts separate are only known once the records are read
+    if args.accounts != "separate":
+        check_output_path(output_path, args.incremental)
+
+    convert_date = args.convert_date
+
+    # Read every XML file once; all sheets are computed from the collected records
+    xml_files = flex_query_files(xml_dir)
+    cache_dir = Path(args.cache_dir or DEFAULT_CACHE_DIR)
+    cache = None if args.no_cache else FlexCache(cache_dir)
+    data = collect_flex_data(xml_files, jobs=args.jobs, cache=cache, backend=args.xml_backend)
+
+    state = None
+    if args.incremental:
+        # The rows depend on the scripts (every module loaded from this directory),
+        # the currency rate files and --convert-date
+        script_dir = Path(__file__).resolve().parent
+        run_fingerprint = fingerprint(convert_date,
+                                      files=local_module_files(script_dir),
+                                      directories=[script_dir / "currency_rates"])
+        state = ExportState(cache_dir / "export_state.pickle", run_fingerprint, log, warning_summary)
+        changed = state.changed_files(xml_files)
+        log.info(f"Incremental run: {len(changed)} new or modified XML file(s)" + (f": {', '.join(changed)}" if changed else ""))
+
+    if not xml_files:
+        log.warning(f"No XML files found in directory: {xml_dir}")
+
+    # The conversions to BGN in two phases: first every rate the records need
+    # is looked up at once, then the sheets are computed with the resolved
+    # rates. A rate still missing then doesn't stop the run: all missing rates
+    # are reported together at the end, before anything is written.
+    defer_missing_currency_rates()
+    pairs = required_currency_rates(data, convert_date)
+    unresolved = resolve_currency_rates(pairs)
+    log.debug(f"[debug] Resolved {len(pairs) - len(unresolved)} of {len(pairs)} currency rates needed by the records")
+
+    options = (convert_date, state, args.fifo_lots, args.year_end_positions)
+    accounts = data.accounts()
+    if args.accounts == "separate":
+        for name in ([f"{output_file_name}_{account}" for account in accounts] if len(accounts) > 1 else [output_file_name]):
+            check_output_path(Path(xml_dir) / f"{name}.ods", args.incremental)
+    if args.accounts == "together" or len(accounts) < 2:
+        if len(accounts) > 1:
+            log.info(f"Records of {len(accounts)} accounts ({', '.join(accounts)}), computed together (see --accounts)")
+        sheets = export_sheets(data, *options, args.jobs)
+    else:
+        log.info(f"Records of {len(accounts)} accounts ({', '.join(accounts)}), computed per account")
+        account_sheets = export_account_sheets(data.by_account(), *options, args.jobs)
+        if args.accounts == "combined":
+            sheets = [dict(sheet, account=account) for account, per_account in account_sheets.items() for sheet in per_account]
+
+    if report_missing_currency_rates():
+        sys.exit(1)
+
+    if state is not None:
+        state.save()
+        state.report()
+
+    if args.accounts == "separate" and len(accounts) > 1:
+        written = 0
+        for account, per_account in account_sheets.items():
+            if not per_account:
+                log.info(f"\nNo data to write for account {account}.")
+                continue
+            write_output(xml_dir, per_account, f"{output_file_name}_{account}", args.incremental)
+            written += 1
+        warning_summary.report()
+        if not written:
+            log.info("\nNo data to write to ODS. Exiting.")
+            sys.exit(0)
+        log.info(f"\nProcessing complete. Check the {written} generated ODS files ({output_file_name}_<account>.ods).")
+        return
+
     if not sheets:
-        print("\nNo data to write to ODS. Exiting.")
+        warning_summary.report()
+        log.info("\nNo data to write to ODS. Exiting.")
         sys.exit(0)
 
     # Write the ODS file with all collected sheets
-    write_ods_with_totals(xml_dir, sheets, output_file_name)
+    write_output(xml_dir, sheets, output_file_name, args.incremental)
 
-    print("\nProcessing complete. Check the generated ODS file.")
+    warning_summary.report()
+    log.info("\nProcessing complete. Check the generated ODS file.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+
+"""
+Logging setup shared by the command line scripts: -q / -v / -vv select the
+level, messages go to the console and optionally to a buffered log file.
+
+The messages keep their usual prefixes (WARNING:, [debug], ...), so the
+console shows them as they are, without level names.
+"""
+
+import logging
+import logging.handlers
+import sys
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+# More detailed than DEBUG: one message per processed row, lot or tax record (-vv)
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+# Example messages kept for every aggregated warning (see WarningSummary)
+MAX_WARNING_SAMPLES = 3
+
+# Number of records kept in memory before they are written to the log file
+# (errors are written immediately)
+LOG_FILE_BUFFER = 10000
+
+class ConsoleHandler(logging.StreamHandler):
+    """
+    StreamHandler that leaves flushing to the stream's own buffering (stdout is
+    line buffered on a terminal) instead of flushing after every record.
+    """
+
+    def flush(self):
+        pass
+
+    def close(self):
+        try:
+            if self.stream and hasattr(self.stream, "flush"):
+                self.stream.flush()
+        finally:
+            super().close()
+
+def verbosity_level(verbose=0, quiet=False):
+    """Map the -q / -v options to a logging level: WARNING, INFO (default), DEBUG or TRACE."""
+    if quiet:
+        return logging.WARNING
+    if verbose <= 0:
+        return logging.INFO
+    if verbose == 1:
+        return logging.DEBUG
+    return TRACE
+
+def add_logging_arguments(parser):
+    """Add -q/--quiet, -v/--verbose and --log-file to an argparse parser."""
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-q", "--quiet", action="store_true",
+                       help="Only print warnings and errors")
+    group.add_argument("-v", "--verbose", action="count", default=0,
+                       help="Print debug messages (-vv: also one message per processed record)")
+    parser.add_argument("--log-file",
+                        help="Also write the messages to this file (with time stamps and levels)")
+
+def configure_logging(level=logging.INFO, log_file=None, stream=None):
+    """Send the messages of the given level and above to stream (default: stdout) and log_file."""
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+
+    console = ConsoleHandler(stream or sys.stdout)
+    console.setFormatter(logging.Formatter("%(message)s"))
+    root.addHandler(console)
+
+    if log_file:
+        file_handler = logging.FileHandler(log_file, mode="w", encoding="utf-8")
+        file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        # Buffered: the file is written in blocks of LOG_FILE_BUFFER records (and at exit)
+        root.addHandler(logging.handlers.MemoryHandler(LOG_FILE_BUFFER, flushLevel=logging.ERROR, target=file_handler))
+
+    root.setLevel(level)
+
+    # None of the formats uses the caller, thread or process of a record; not
+    # collecting them makes every logging call cheaper (see "Optimization" in
+    # the logging HOWTO)
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+class WarningSummary:
+    """
+    Counts warnings that repeat for many records by (kind, key), e.g.
+    ("Unexpected assetCategory", "CASH") or (kind, symbol), and keeps the first
+    few messages of each as samples. report() prints one line per (kind, key)
+    at the end instead of one message per record. With dump=True every warning
+    is also logged in full as it happens.
+
+    The message is given as a %-format with arguments (like a logging call),
+    so it is only formatted when it is kept or printed.
+
+    While recorder is set to a list, every warning is also appended to it as
+    (WARNING, message, (kind, key)), to be passed to warn() again later (see
+    recording_messages()).
+    """
+
+    def __init__(self, logger, dump=False, max_samples=MAX_WARNING_SAMPLES):
+        self.logger = logger
+        self.dump = dump
+        self.max_samples = max_samples
+        self.counts = Counter()
+        self.samples = defaultdict(list)
+        self.recorder = None
+
+    def warn(self, kind, key, msg, *args):
+        entry = (kind, key)
+        self.counts[entry] += 1
+        if self.recorder is not None:
+            self.recorder.append((logging.WARNING, msg % args if args else msg, entry))
+        if self.dump:
+            self.logger.warning(msg, *args, extra={"warning_summary": True})
+        samples = self.samples[entry]
+        if len(samples) < self.max_samples:
+            samples.append(msg % args if args else msg)
+
+    def report(self, max_keys=5):
+        """
+        Log the summary table: one line per kind of warning with its count and
+        the categories/symbols it occurred for (the max_keys most frequent
+        ones), plus a few example messages with -v.
+        """
+        if not self.counts:
+            return
+        by_kind = defaultdict(Counter)
+        for (kind, key), count in self.counts.items():
+            by_kind[kind][key] += count
+
+        self.logger.warning("\nWarnings: %d in total (-v shows examples, --dump-warnings prints every one)",
+                            sum(self.counts.values()))
+        self.logger.warning("%8s  %-55s  %s", "count", "warning", "category/symbol (count)")
+        for kind in sorted(by_kind):
+            keys = by_kind[kind]
+            # Most frequent first, ties by name (the same order however the warnings were collected)
+            ranked = sorted(keys.items(), key=lambda item: (-item[1], str(item[0])))
+            shown = ", ".join(f"{key if key is not None else '-'} ({count})" for key, count in ranked[:max_keys])
+            if len(keys) > max_keys:
+                shown += f", ... {len(keys) - max_keys} more"
+            self.logger.warning("%8d  %-55s  %s", sum(keys.values()), kind, shown)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                samples = [sample for key, _ in ranked for sample in self.samples.get((kind, key), ())]
+                for sample in samples[:self.max_samples]:
+                    self.logger.debug("%8s  e.g. %s", "", sample)
+
+    def merge(self, counts, samples):
+        """Add the counts and samples of another WarningSummary (e.g. of a worker process)."""
+        self.counts.update(counts)
+        for entry, kept in samples.items():
+            mine = self.samples[entry]
+            mine.extend(kept[:self.max_samples - len(mine)])
+
+    def clear(self):
+        self.counts.clear()
+        self.samples.clear()
+
+class MessageRecorder(logging.Handler):
+    """
+    Appends (level, message, None) of the records it handles to messages, to
+    be logged again with replay_messages(). Warnings of a WarningSummary are
+    left out: the summary records them itself, as (level, message, (kind, key)).
+    """
+
+    def __init__(self, messages, level=logging.WARNING):
+        super().__init__(level)
+        self.messages = messages
+
+    def emit(self, record):
+        if not getattr(record, "warning_summary", False):
+            self.messages.append((record.levelno, record.getMessage(), None))
+
+@contextmanager
+def recording_messages(logger, warnings=None, level=logging.WARNING):
+    """
+    Record the messages of logger (of the given level and above) and the
+    warnings of the WarningSummary warnings inside the with block, in the
+    order they were issued. Yields the list of recorded messages, e.g. to
+    store them with a result computed once (export_state) or to pass them
+    from a worker process to the main one.
+    """
+    messages = []
+    recorder = MessageRecorder(messages, level)
+    logger.addHandler(recorder)
+    if warnings is not None:
+        warnings.recorder = messages
+    try:
+        yield messages
+    finally:
+        logger.removeHandler(recorder)
+        if warnings is not None:
+            warnings.recorder = None
+
+def replay_messages(logger, messages, warnings=None):
+    """Log the messages recorded by recording_messages() again (the summary warnings through warnings.warn())."""
+    for level, message, summary in messages:
+        if summary is not None and warnings is not None:
+            warnings.warn(*summary, "%s", message)
+        else:
+            logger.log(level, "%s", message)
@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+
+"""
+FIFO lot engine: rebuilds the closed lots of the closing executions from the
+executions themselves, for Flex Queries without the "Closed Lots" subsection
+(no <Lot> records) or to check the <Lot> records IBKR sent.
+
+Every EXECUTION <Trade> is replayed in chronological order per instrument
+(account, asset category, conid). The open lots of an instrument are kept in
+a deque, oldest first: an execution in the opposite direction of the open
+position closes lots from the front, the rest of it (if any) opens a new lot
+at the back. Each execution is handled in O(1) amortized time, so the replay
+is linear in the number of executions (plus the sort by time).
+
+The rebuilt lots are records like IBKR's <Lot>: the transactionID of the
+opening trade, the quantity closed (signed like the open position) and the
+date and time of the closing execution, so the exporter can use them in
+place of the missing ones.
+
+The same replay also yields the holdings as of any number of dates (e.g. every
+31 December), sweeping over the executions once: when the replay passes a
+date, the open lots at that moment are copied to holdings[date].
+"""
+
+from collections import defaultdict, deque
+from decimal import Decimal, InvalidOperation
+
+from flex_ingest import FlexRecord
+
+# Attributes of the closing execution copied to the rebuilt lots
+CLOSING_ATTRIBUTES = (
+    "accountId", "currency", "fxRateToBase", "assetCategory", "subCategory", "symbol", "description",
+    "conid", "isin", "exchange", "ibOrderID", "ibExecID", "tradeDate", "dateTime", "tradePrice", "buySell",
+)
+
+
+class OpenLot:
+    """The not yet closed part of an opening execution."""
+    __slots__ = ("trade", "quantity")
+
+    def __init__(self, trade, quantity: Decimal):
+        self.trade = trade
+        self.quantity = quantity  # signed: > 0 long, < 0 short
+
+
+def instrument_key(trade):
+    return (trade.get("accountId"), trade.get("assetCategory"), trade.get("conid") or trade.get("isin") or trade.get("symbol"))
+
+
+def execution_time(trade):
+    return trade.get("dateTime") or trade.get("tradeDate") or ""
+
+
+def only_closes(trade):
+    """True if the openCloseIndicator of the execution says it closes and doesn't open ("C", not "O" or "C;O")."""
+    indicator = {part.strip() for part in (trade.get("openCloseIndicator") or "").split(";")}
+    return "C" in indicator and "O" not in indicator
+
+
+def closed_lot(open_trade, closing_trade, quantity: Decimal) -> FlexRecord:
+    """A <Lot> record for quantity of open_trade closed by closing_trade."""
+    values = {name: closing_trade.get(name) for name in CLOSING_ATTRIBUTES if closing_trade.get(name) is not None}
+    values.update(transactionID=open_trade.get("transactionID"), openDateTime=open_trade.get("dateTime"),
+                  quantity=str(quantity), openCloseIndicator="C", levelOfDetail="CLOSED_LOT")
+    return FlexRecord("Lot", values)
+
+
+class FifoLotEngine:
+    """
+    Replays the executions (see the module docstring). After replay():
+    lots maps every closing execution (the <Trade> record) to its rebuilt
+    lots, unmatched maps the executions that should close a position but
+    found no (or not enough) open lots, e.g. because the opening trades are
+    older than the loaded files, to the quantity left unmatched, and holdings
+    maps every snapshot date to the open lots at the end of that day.
+    openings maps the transactionID of every execution that opened a lot to
+    the execution, whatever its openCloseIndicator says.
+
+    What is left of an execution after closing the open lots of the opposite
+    direction depends on its openCloseIndicator ("O", "C" or "C;O", the
+    parts separated by ";"): if it only closes ("C" without "O") the rest is
+    unmatched; otherwise ("O", "C;O" for a trade that closes a position and
+    opens the opposite one, or no indicator) the rest opens a new lot. Each
+    execution opens its own lot, also when one order is filled by several
+    executions: IBKR's <Lot> records refer to the transactionID of the
+    execution, not of the order.
+    """
+
+    def __init__(self, categories=None):
+        self.categories = categories  # asset categories to replay (None = all)
+        self.open_lots = defaultdict(deque)  # instrument -> open lots, oldest first
+        self.lots = {}
+        self.unmatched = {}
+        self.holdings = {}
+        self.openings = {}
+
+    def replay(self, trades, snapshot_dates=()):
+        """Replay trades; snapshot_dates are "YYYYMMDD" strings (see holdings)."""
+        executions = [t for t in trades
+                      if t.tag == "Trade" and t.get("levelOfDetail") == "EXECUTION"
+                      and (self.categories is None or t.get("assetCategory") in self.categories)]
+        # "YYYYMMDD;HHMMSS" sorts chronologically; sort() is stable for equal times
+        executions.sort(key=execution_time)
+        pending = sorted(set(snapshot_dates), reverse=True)  # the next date is the last one
+
+        for trade in executions:
+            while pending and execution_time(trade)[:8] > pending[-1]:
+                self._snapshot(pending.pop())
+            try:
+                quantity = Decimal(trade.get("quantity") or "0")
+            except InvalidOperation:
+                continue
+            queue = self.open_lots[instrument_key(trade)]
+            closed = []
+            # Close open lots of the opposite direction, oldest first
+            while quantity and queue and (queue[0].quantity > 0) != (quantity > 0):
+                open_lot = queue[0]
+                take = min(abs(quantity), abs(open_lot.quantity))
+                signed = take if open_lot.quantity > 0 else -take
+                closed.append(closed_lot(open_lot.trade, trade, signed))
+                open_lot.quantity -= signed
+                quantity += signed
+                if not open_lot.quantity:
+                    queue.popleft()
+            if closed:
+                self.lots[trade] = closed
+            if quantity:
+                if only_closes(trade):
+                    # Closes a position whose opening isn't in the loaded files
+                    self.unmatched[trade] = abs(quantity)
+                else:
+                    queue.append(OpenLot(trade, quantity))
+                    self.openings[trade.get("transactionID")] = trade
+        while pending:
+            self._snapshot(pending.pop())
+        return self.lots
+
+    def _snapshot(self, date):
+        self.holdings[date] = [OpenLot(lot.trade, lot.quantity) for queue in self.open_lots.values() for lot in queue]
+
+
+def lot_signature(lots):
+    """The (opening transactionID, quantity) pairs of lots, for comparing IBKR's <Lot> with rebuilt ones."""
+    return sorted((lot.get("transactionID"), Decimal(lot.get("quantity") or "0")) for lot in lots)
@@ -3,10 +3,15 @@ import csv
 import sys
 import os
 import re
+import logging
 from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
 from datetime import datetime
 from collections import Counter
 
+from log_setup import TRACE, configure_logging, verbosity_level
+
+log = logging.getLogger(__name__)
+
 ALLOWED_MODES = ["nap-autopilot", "table", "sheet"]
 
 duplicate_warning_count = 0
@@ -33,11 +38,17 @@ def parse_args():
         print(f"\nOptions:\n")
         print(f"  mode=      Output format: {', '.join(ALLOWED_MODES)}")
         print(f"  input=     Input mode: 'one' (single file) or 'two' (separate FII file)")
+        print(f"  log=       Also write the messages to this file")
+        print(f"  -q         Only print warnings and errors")
+        print(f"  -v, -vv    Print debug messages (-vv: also one message per processed row)")
         sys.exit(1)
 
     mode = ALLOWED_MODES[0]
     input_mode = "one"  # Default to single input file
     input_file = fii_file = output_file = None
+    verbose = 0
+    quiet = False
+    log_file = None
 
     # Separate arguments
     positional_args = []
@@ -46,8 +57,14 @@ def parse_args():
             mode = arg.split("=", 1)[1].strip()
         elif arg.startswith("input="):
             input_mode = arg.split("=", 1)[1].strip()
+        elif arg.startswith("log="):
+            log_file = arg.split("=", 1)[1].strip()
+        elif arg in ("-q", "--quiet"):
+            quiet = True
+        elif arg in ("-v", "-vv", "--verbose"):
+            verbose += 2 if arg == "-vv" else 1
         elif "=" in arg:
-            print(f"ERROR: Unexpected argument '{arg}'. Only mode= and input= are supported.")
+            print(f"ERROR: Unexpected argument '{arg}'. Only mode=, input= and log= are supported.")
             sys.exit(1)
         else:
             positional_args.append(arg)
@@ -87,7 +104,9 @@ def parse_args():
         'fii_file': fii_file if input_mode == "two" else None,
         'output_file': output_file,
         'mode': mode,
-        'input_mode': input_mode
+        'input_mode': input_mode,
+        'log_level': verbosity_level(verbose, quiet),
+        'log_file': log_file
     }
 
 def extract_instrument_names(rows):
@@ -225,51 +244,160 @@ def check_withholding_tax_rate(dividend_amount, tax_amount, country_code, isin,
 def round_decimal(value, rounding=ROUND_HALF_UP):
     return value.quantize(Decimal("0.01"), rounding=rounding)
 
-def look_for_currency_rate(code, date_str):
-    # date_str expected in DD.MM.YYYY format
-    code = code.upper()
-    if code == "BGN":
-        return Decimal("1")
-    if code == "EUR":
-        return Decimal("1.95583")
+# Rates read from the currency rate files: path -> {DD.MM.YYYY: rate string}.
+# Every file is read once per run; the exporter hands this table to its
+# worker processes (see preload_currency_rates()).
+currency_rate_files = {}
+
+# (currency code, year) -> path of the rate file used for it (None if there is none)
+_currency_rate_paths = {}
+
+# Rates looked up so far: (currency code, DD.MM.YYYY) -> Decimal (see resolve_currency_rates())
+currency_rates = {}
+
+# Rates not found while missing_rates_deferred: (code, date) -> error message (see defer_missing_currency_rates())
+missing_currency_rates = {}
+missing_rates_deferred = False
+
+def find_currency_rate_file(code, year):
+    """The first existing file among CODE_YEAR_corrected.csv, CODE_YEAR.csv and CODE.csv (in currency_rates, then the current directory)."""
+    key = (code, year)
+    if key not in _currency_rate_paths:
+        filenames = [f"{code}_{year}_corrected.csv", f"{code}_{year}.csv", f"{code}.csv"]
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        currency_dir = os.path.join(script_dir, "currency_rates")
+        paths_to_try = [os.path.join(currency_dir, fn) for fn in filenames] + filenames
+        _currency_rate_paths[key] = next((path for path in paths_to_try if os.path.isfile(path)), None)
+    return _currency_rate_paths[key]
+
+def read_currency_rate_file(path):
+    """The rates of one file as {DD.MM.YYYY: rate string}, read on first use."""
+    rates = currency_rate_files.get(path)
+    if rates is None:
+        with open(path, newline='', encoding='utf-8') as f:
+            rows = list(csv.reader(f))
 
-    year = date_str[-4:]
-    filenames = [f"{code}_{year}_corrected.csv", f"{code}_{year}.csv", f"{code}.csv"]
+        # Skip header if needed
+        if rows and not re.match(r'\d{2}\.\d{2}\.\d{4}', rows[0][0]):
+            rows = rows[1:]
 
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    currency_dir = os.path.join(script_dir, "currency_rates")
-    paths_to_try = [os.path.join(currency_dir, fn) for fn in filenames] + filenames
+        rates = {}
+        for r in rows:
+            if r:
+                rates.setdefault(r[0], r[1] if len(r) > 1 else "")
+        currency_rate_files[path] = rates
+    return rates
 
-    for path in paths_to_try:
-        if os.path.isfile(path):
+def preload_currency_rates(codes_and_years):
+    """
+    Read the rate files for the given (currency code, year) pairs into
+    currency_rate_files. Missing or unreadable files are skipped here; the
+    error is reported by look_for_currency_rate() when a rate is needed.
+    """
+    for code, year in codes_and_years:
+        code = code.upper()
+        if code in ("BGN", "EUR"):
+            continue
+        path = find_currency_rate_file(code, year)
+        if path is not None:
             try:
-                with open(path, newline='', encoding='utf-8') as f:
-                    reader = csv.reader(f)
-                    rows = list(reader)
-
-                    # Skip header if needed
-                    if rows and not re.match(r'\d{2}\.\d{2}\.\d{4}', rows[0][0]):
-                        rows = rows[1:]
-
-                    for r in rows:
-                        if r and r[0] == date_str:
-                            try:
-                                return Decimal(r[1])
-                            except InvalidOperation:
-                                print(f"ERROR: Invalid exchange rate value '{r[1]}' in {path} for date {date_str}")
-                                sys.exit(1)
-                            except Exception as e:
-                                print(f"ERROR: Unexpected issue converting exchange rate in {path} on {date_str}: {e}")
-                                sys.exit(1)
-
-                    print(f"ERROR: Rate not found for {code} on {date_str} in {path}")
-                    sys.exit(1)
+                read_currency_rate_file(path)
+            except Exception:
+                pass
+    return currency_rate_files
 
-            except Exception as e:
-                print(f"ERROR: Failed to read currency file '{path}': {e}")
-                sys.exit(1)
+def _resolve_currency_rate(code, date_str):
+    """(rate, None) for a currency code (upper case) on DD.MM.YYYY, or (None, error message) if there is none."""
+    if code == "BGN":
+        return Decimal("1"), None
+    if code == "EUR":
+        return Decimal("1.95583"), None
+
+    year = date_str[-4:]
+    path = find_currency_rate_file(code, year)
+    if path is None:
+        filenames = [f"{code}_{year}_corrected.csv", f"{code}_{year}.csv", f"{code}.csv"]
+        return None, f"ERROR: No currency rate file found for {code} among {filenames}"
+
+    try:
+        rates = read_currency_rate_file(path)
+    except Exception as e:
+        return None, f"ERROR: Failed to read currency file '{path}': {e}"
+
+    rate = rates.get(date_str)
+    if rate is None:
+        return None, f"ERROR: Rate not found for {code} on {date_str} in {path}"
+
+    try:
+        return Decimal(rate), None
+    except InvalidOperation:
+        return None, f"ERROR: Invalid exchange rate value '{rate}' in {path} for date {date_str}"
+
+def resolve_currency_rates(pairs):
+    """
+    Look up every distinct (currency code, DD.MM.YYYY) pair in one go (each
+    rate file is read once) and keep the rates in currency_rates, so the
+    conversions that follow find them there. Returns {pair: error message}
+    of the pairs without a rate; they are not reported here, only if a
+    conversion really needs them (see look_for_currency_rate()).
+    """
+    missing = {}
+    for code, date_str in sorted({(code.upper(), date_str) for code, date_str in pairs}):
+        if (code, date_str) in currency_rates:
+            continue
+        rate, error = _resolve_currency_rate(code, date_str)
+        if error is None:
+            currency_rates[(code, date_str)] = rate
+        else:
+            missing[(code, date_str)] = error
+    return missing
 
-    print(f"ERROR: No currency rate file found for {code} among {filenames}")
+def defer_missing_currency_rates(deferred=True):
+    """
+    While deferred, look_for_currency_rate() doesn't stop at the first missing
+    rate: it records it in missing_currency_rates and returns 0, so that all
+    missing rates can be reported at once (report_missing_currency_rates())
+    before anything is written.
+    """
+    global missing_rates_deferred
+    missing_rates_deferred = deferred
+    missing_currency_rates.clear()
+
+def missing_currency_rates_deferred():
+    return missing_rates_deferred
+
+def report_missing_currency_rates():
+    """Log every rate recorded as missing; returns True if there was any."""
+    if not missing_currency_rates:
+        return False
+    log.error(f"ERROR: {len(missing_currency_rates)} currency rate(s) missing, add them to the currency rate files and run again:")
+    # A missing file is the same error for all its dates: list the dates after it
+    dates_by_error = {}
+    for (code, date_str), error in sorted(missing_currency_rates.items(), key=lambda item: (item[0][0], item[0][1][-4:], item[0][1][3:5], item[0][1][:2])):
+        dates_by_error.setdefault(error, []).append(date_str)
+    for error, dates in dates_by_error.items():
+        if len(dates) == 1:
+            log.error(f"  {error}")
+        else:
+            shown = ", ".join(dates[:10]) + (f", ... {len(dates) - 10} more" if len(dates) > 10 else "")
+            log.error(f"  {error} (needed for {len(dates)} dates: {shown})")
+    return True
+
+def look_for_currency_rate(code, date_str):
+    # date_str expected in DD.MM.YYYY format
+    code = code.upper()
+    rate = currency_rates.get((code, date_str))
+    if rate is not None:
+        return rate
+
+    rate, error = _resolve_currency_rate(code, date_str)
+    if error is None:
+        currency_rates[(code, date_str)] = rate
+        return rate
+    if missing_rates_deferred:
+        missing_currency_rates.setdefault((code, date_str), error)
+        return Decimal("0")
+    log.error(error)
     sys.exit(1)
 
 def extract_base_desc(desc):
@@ -285,7 +413,7 @@ def extract_base_desc(desc):
         base = desc.split(" (")[0].strip()
     else:
         base = desc.strip()
-    print(f"DEBUG: extract_base_desc: Original: '{desc}' -> Base: '{base}'")
+    log.log(TRACE, "DEBUG: extract_base_desc: Original: '%s' -> Base: '%s'", desc, base)
     return base
 
 def extract_dividends_and_taxes(rows):
@@ -299,7 +427,7 @@ def extract_dividends_and_taxes(rows):
     tax_col_map = {}
 
     for i, row in enumerate(rows):
-        print(f"DEBUG: Processing row {i}: {row}")
+        log.log(TRACE, "DEBUG: Processing row %s: %s", i, row)
 
         if len(row) < 6:
             continue  # Skip short or malformed rows
@@ -333,7 +461,7 @@ def extract_dividends_and_taxes(rows):
                 continue
 
             if not date_str or not desc:
-                print("DEBUG: skipping the line because not date_str or not desc")
+                log.log(TRACE, "DEBUG: skipping the line because not date_str or not desc")
                 continue
 
             ticker_match = re.match(r'(.*?)\((.*?)\)', desc)
@@ -368,7 +496,7 @@ def extract_dividends_and_taxes(rows):
 
             seen_dividends.add(key)
 
-            print(f"DEBUG: Dividend row: Ticker: {ticker}, Date: {div_date.date()}, Base desc: '{base_desc}', Amount: {amount}")
+            log.log(TRACE, "DEBUG: Dividend row: Ticker: %s, Date: %s, Base desc: '%s', Amount: %s", ticker, div_date.date(), base_desc, amount)
             dividends.append({
                 "date": div_date,
                 "desc": base_desc,
@@ -410,7 +538,7 @@ def extract_dividends_and_taxes(rows):
                 print(f"WARNING: Duplicate withholding tax detected on {tax_date.date()} with description '{base_desc}' and amount {amount}")
             seen_taxes.add(key)
 
-            print(f"DEBUG: Tax row: Date: {tax_date.date()}, Base desc: '{base_desc}', Amount: {amount}")
+            log.log(TRACE, "DEBUG: Tax row: Date: %s, Base desc: '%s', Amount: %s", tax_date.date(), base_desc, amount)
             taxes.append({
                 "date": tax_date,
                 "desc": base_desc,
@@ -480,7 +608,7 @@ def extract_from_flexquery(rows):
         elif typ == "Withholding Tax":
             # Skip interest-related tax rows with no symbol
             if not ticker and ( desc.upper().startswith("WITHHOLDING") or desc.upper().startswith("CANCEL WITHHOLDING ON CREDIT INT") ):
-                print(f"DEBUG: Skipping interest-related tax row: {desc}")
+                log.debug("DEBUG: Skipping interest-related tax row: %s", desc)
                 continue
 
             key = (date, desc, amt)
@@ -576,8 +704,8 @@ def match_taxes_to_dividends(dividends, taxes):
             method_used = ("ActionID" if (div_action_id and selected_taxes 
                           and selected_taxes[0].get("action_id") == div_action_id)
                           else "desc/date")
-            print(f"DEBUG: Matched {len(selected_taxes)} tax(es) to {div['ticker']} "
-                  f"on {div['date'].date()} using {method_used}")
+            log.debug("DEBUG: Matched %s tax(es) to %s on %s using %s",
+                      len(selected_taxes), div['ticker'], div['date'].date(), method_used)
         else:
             print(f"notice: No tax found for {div['ticker']} on {div['date'].date()}")
         
@@ -744,6 +872,7 @@ def analyze_duplicate_dividends(duplicates):
 
 def main():
     args = parse_args()  # Get config dictionary
+    configure_logging(args['log_level'], args['log_file'])
     invalid_output = False
     input_is_FlexQuery = None
     serious_issues = False
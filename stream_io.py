@@ -0,0 +1,31 @@
+#!/usr/bin/python3
+
+"""
+Helpers for the date and rate utilities to read from / write to files or,
+when the file name is "-", to stdin / stdout (so they can be chained in a
+shell pipeline without temporary files).
+"""
+
+import sys
+
+BUFFER_SIZE = 1 << 20
+
+def open_input(path, newline=None):
+    """Open path for reading with a large buffer; "-" means stdin."""
+    if path == "-":
+        return open(sys.stdin.fileno(), 'r', buffering=BUFFER_SIZE, newline=newline, closefd=False)
+    return open(path, 'r', buffering=BUFFER_SIZE, newline=newline)
+
+def open_output(path, newline=None):
+    """Open path for writing with a large buffer; "-" means stdout."""
+    if path == "-":
+        sys.stdout.flush()
+        return open(sys.stdout.fileno(), 'w', buffering=BUFFER_SIZE, newline=newline, closefd=False)
+    return open(path, 'w', buffering=BUFFER_SIZE, newline=newline)
+
+def status_stream(output_path):
+    """Where to print progress messages: stderr when the data goes to stdout."""
+    return sys.stderr if output_path == "-" else sys.stdout
+
+def describe(path):
+    return "stdout" if path == "-" else path